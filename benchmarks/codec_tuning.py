@@ -0,0 +1,268 @@
+"""
+Measure encodings of the data array on sample tiles: compressor, level,
+shuffle, band layout and chunk size, for encode and decode throughput and
+stored size, and save the best one for ``main.py --encoding``.
+
+Tiles are sampled from an existing cube, or generated.
+
+python benchmarks/codec_tuning.py --save encoding.json
+python benchmarks/codec_tuning.py --store s3://bucket/cube.zarr --chunk-size 1200
+
+The best encoding writes a chunk in the least time: encoding it, uploading the
+compressed bytes at --upload-mbps and a fixed cost per object, among those that
+decode at least --min-decode-mbps.
+"""
+
+import itertools
+import os
+import sys
+from functools import partial
+from time import perf_counter
+
+import click
+import numpy as np
+import pandas as pd
+import zarr
+from numcodecs import blosc
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from encoding import LAYOUTS, SHUFFLES, Encoding, threaded_array  # noqa: E402
+from tuning import detect_resources  # noqa: E402
+
+MB = 1e6
+
+
+def synthetic_tile(size: int, num_bands: int, rng, nodata_fraction: float = 0.1):
+    """
+    A (y, x, band) uint16 tile that looks a bit like a median composite:
+    terrain at a few scales, correlated bands, sensor noise and an area of no
+    data (ocean).
+    """
+    field = np.zeros((size, size))
+    for scale in (size // 4, size // 32, 4):
+        scale = max(scale, 1)
+        coarse = rng.standard_normal((size // scale + 2, size // scale + 2))
+        field += np.sqrt(scale) * ndimage.zoom(coarse, scale, order=1)[:size, :size]
+    field = (field - field.min()) / np.ptp(field)
+    bands = [
+        300 + 2500 * field * rng.uniform(0.6, 1.0) + rng.normal(0, 30, field.shape)
+        for _ in range(num_bands)
+    ]
+    tile = np.clip(np.stack(bands, axis=-1), 1, 10_000).astype("uint16")
+    if nodata_fraction:
+        ocean = ndimage.zoom(rng.random((4, 4)), size / 4, order=1)[:size, :size]
+        tile[ocean < np.quantile(ocean, nodata_fraction)] = 0
+    return tile
+
+
+def cube_tiles(store: str, varname: str, size: int, count: int, rng) -> list:
+    """Up to ``count`` random windows of ``size`` pixels with data, from a cube."""
+    array = zarr.open_array(store, mode="r", path=varname)
+    nt, ny, nx, _ = array.shape
+    tiles = []
+    for _ in range(20 * count):
+        t = rng.integers(nt)
+        y0 = rng.integers(max(ny // size, 1)) * size
+        x0 = rng.integers(max(nx // size, 1)) * size
+        tile = array[t, y0 : y0 + size, x0 : x0 + size]
+        if tile.any():
+            tiles.append(tile)
+        if len(tiles) == count:
+            break
+    return tiles
+
+
+def zarr_chunks(tile: np.ndarray, layout: str) -> list[np.ndarray]:
+    """The bytes of each zarr chunk a tile is written as."""
+    if layout == "planar":
+        return [
+            np.ascontiguousarray(tile[..., b : b + 1]) for b in range(tile.shape[2])
+        ]
+    return [np.ascontiguousarray(tile)]
+
+
+def _best_time(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        tic = perf_counter()
+        func()
+        best = min(best, perf_counter() - tic)
+    return best
+
+
+def measure(encoding: Encoding, tiles: list[np.ndarray], repeat: int) -> dict:
+    """Single threaded throughput and size of ``encoding`` over ``tiles``."""
+    compressor = encoding.compressor()
+    raw = stored = objects = 0
+    encode_seconds = decode_seconds = 0.0
+    for tile in tiles:
+        for chunk in zarr_chunks(tile, encoding.layout):
+            encoded = compressor.encode(chunk)
+            raw += chunk.nbytes
+            stored += len(encoded)
+            objects += 1
+            encode_seconds += _best_time(partial(compressor.encode, chunk), repeat)
+            decode_seconds += _best_time(partial(compressor.decode, encoded), repeat)
+    return {
+        "ratio": raw / stored,
+        "encode_mbps": raw / MB / encode_seconds,
+        "decode_mbps": raw / MB / decode_seconds,
+        "raw_bytes": raw,
+        "stored_bytes": stored,
+        "objects": objects,
+        "encode_seconds": encode_seconds,
+    }
+
+
+def threaded_mbps(
+    encoding: Encoding, tiles: list[np.ndarray], threads: int, repeat: int
+) -> float:
+    """Throughput of writing ``tiles`` to an in-memory array with ``threads``."""
+    size, _, num_bands = tiles[0].shape
+    array = zarr.zeros(
+        (1, size, size, num_bands),
+        chunks=encoding.chunks((size, size), num_bands),
+        dtype="uint16",
+        compressor=encoding.compressor(),
+    )
+    array = threaded_array(array, threads)
+    seconds = sum(
+        _best_time(partial(array.__setitem__, 0, tile), repeat) for tile in tiles
+    )
+    return sum(tile.nbytes for tile in tiles) / MB / seconds
+
+
+@click.command()
+@click.option(
+    "--store",
+    help="Sample tiles from this (Zarr v2) cube instead of generating them.",
+)
+@click.option("--varname", default="rgb_median", show_default=True)
+@click.option("--samples", type=int, default=4, show_default=True)
+@click.option("--bands", type=int, default=3, show_default=True)
+@click.option("--cname", multiple=True, default=["zstd", "lz4"])
+@click.option("--clevel", type=int, multiple=True, default=[1, 5, 9])
+@click.option(
+    "--shuffle",
+    type=click.Choice(list(SHUFFLES)),
+    multiple=True,
+    default=list(SHUFFLES),
+)
+@click.option(
+    "--layout", type=click.Choice(LAYOUTS), multiple=True, default=list(LAYOUTS)
+)
+@click.option("--chunk-size", type=int, multiple=True, default=[600, 1200])
+@click.option("--repeat", type=int, default=3, show_default=True)
+@click.option(
+    "--upload-mbps",
+    type=float,
+    default=100,
+    show_default=True,
+    help="Upload bandwidth of a worker.",
+)
+@click.option(
+    "--request-seconds",
+    type=float,
+    default=0.02,
+    show_default=True,
+    help="Fixed cost of writing an object.",
+)
+@click.option(
+    "--min-decode-mbps",
+    type=float,
+    default=200,
+    show_default=True,
+    help="Only pick encodings that read back at least this fast.",
+)
+@click.option("--top", type=int, default=15, show_default=True)
+@click.option("--save", type=click.Path(dir_okay=False), help="Save the best as JSON.")
+@click.option(
+    "--results", type=click.Path(dir_okay=False), help="Save all the results as CSV."
+)
+@click.option("--seed", type=int, default=0, show_default=True)
+def main(
+    store: str | None,
+    varname: str,
+    samples: int,
+    bands: int,
+    cname: list[str],
+    clevel: list[int],
+    shuffle: list[str],
+    layout: list[str],
+    chunk_size: list[int],
+    repeat: int,
+    upload_mbps: float,
+    request_seconds: float,
+    min_decode_mbps: float,
+    top: int,
+    save: str | None,
+    results: str | None,
+    seed: int,
+):
+    # compare the codecs themselves on one thread; Blosc would otherwise pick
+    # its own number of threads on the main thread
+    blosc.use_threads = False
+    rows = []
+    tiles_by_size = {}
+    for size in chunk_size:
+        rng = np.random.default_rng(seed)
+        if store:
+            tiles = cube_tiles(store, varname, size, samples, rng)
+            if not tiles:
+                raise click.UsageError(f"No tiles with data in {store}")
+        else:
+            tiles = [synthetic_tile(size, bands, rng) for _ in range(samples)]
+        tiles_by_size[size] = tiles
+
+        for cn, cl, sh, lo in itertools.product(cname, clevel, shuffle, layout):
+            encoding = Encoding(cname=cn, clevel=cl, shuffle=sh, layout=lo)
+            stats = measure(encoding, tiles, repeat)
+            # seconds to write a GB of the cube
+            scale = 1e9 / stats["raw_bytes"]
+            write_seconds = scale * (
+                stats["encode_seconds"]
+                + stats["stored_bytes"] / MB / upload_mbps
+                + stats["objects"] * request_seconds
+            )
+            rows.append(
+                {
+                    "encoding": encoding.label,
+                    "chunk_size": size,
+                    "ratio": stats["ratio"],
+                    "encode_mbps": stats["encode_mbps"],
+                    "decode_mbps": stats["decode_mbps"],
+                    "write_s_per_gb": write_seconds,
+                    "_encoding": encoding,
+                }
+            )
+
+    df = pd.DataFrame(rows).sort_values("write_s_per_gb")
+    if results:
+        df.drop(columns="_encoding").to_csv(results, index=False)
+    click.echo(df.drop(columns="_encoding").head(top).to_string(index=False))
+
+    eligible = df[df.decode_mbps >= min_decode_mbps]
+    if eligible.empty:
+        raise click.UsageError("Nothing decodes as fast as --min-decode-mbps")
+    best = eligible.iloc[0]
+    encoding = best["_encoding"]
+    click.echo(f"\nBest: {encoding.label} with --chunk-size {best.chunk_size}")
+
+    threads = detect_resources().cpus
+    if threads > 1:
+        tiles = tiles_by_size[best.chunk_size]
+        single = threaded_mbps(encoding, tiles, 1, repeat)
+        multi = threaded_mbps(encoding, tiles, threads, repeat)
+        click.echo(
+            f"Writing it: {single:.0f} MB/s on 1 thread, {multi:.0f} MB/s on {threads}"
+        )
+
+    if save:
+        encoding.save(save)
+        click.echo(f"Saved to {save}; pass it as --encoding")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Time and size of serializing jobs for dispatch: the context pickled along with
+every job (how jobs used to be sent) vs. compact job descriptors plus the
+context sent once.
+
+python benchmarks/dispatch.py --num-jobs 100000
+"""
+
+import os
+import pickle
+import sys
+import tempfile
+from datetime import datetime
+from itertools import islice
+from time import perf_counter
+
+import click
+import zarr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from lib import ChunkProcessingJob, JobConfig, JobContext, pack_context  # noqa: E402
+
+
+def make_context(store_dir: str) -> JobContext:
+    config = JobConfig(
+        dx=1 / 3600,
+        epsg=4326,
+        bounds=(-126, 24, -66, 50),
+        start_date=datetime(2020, 1, 1),
+        end_date=datetime(2020, 12, 31),
+        time_frequency_months=1,
+        bands=["red", "green", "blue"],
+        varname="rgb_median",
+        chunk_size=600,
+    )
+    array = zarr.open(
+        zarr.storage.FSStore(store_dir),
+        mode="w",
+        path=config.varname,
+        shape=(12,) + config.geobox.shape + (3,),
+        chunks=(1, 600, 600, 3),
+        dtype="uint16",
+    )
+    return JobContext(config=config, target_array=array)
+
+
+def make_jobs(num_jobs: int) -> list[ChunkProcessingJob]:
+    # don't need real land tiles to measure serialization
+    def gen():
+        y = 0
+        while True:
+            for x in range(360):
+                for t in range(12):
+                    yield ChunkProcessingJob(tile_index=(y, x), time_index=t)
+            y += 1
+
+    return list(islice(gen(), num_jobs))
+
+
+@click.command()
+@click.option("--num-jobs", type=int, default=100_000, show_default=True)
+def main(num_jobs: int):
+    jobs = make_jobs(num_jobs)
+    with tempfile.TemporaryDirectory() as store_dir:
+        context = make_context(store_dir)
+
+        tic = perf_counter()
+        per_job = sum(len(pickle.dumps((job, context, False))) for job in jobs)
+        per_job_time = perf_counter() - tic
+
+        tic = perf_counter()
+        _, payload = pack_context(context)
+        compact = len(payload) + sum(
+            len(pickle.dumps((job, "0" * 16, False))) for job in jobs
+        )
+        compact_time = perf_counter() - tic
+
+    click.echo(f"{num_jobs} jobs        seconds       MiB")
+    click.echo(f"context per job  {per_job_time:>8.2f}  {per_job / 2**20:>8.1f}")
+    click.echo(f"context once     {compact_time:>8.2f}  {compact / 2**20:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
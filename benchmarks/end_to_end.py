@@ -0,0 +1,416 @@
+"""
+Offline benchmark of the whole chunk pipeline (search, load, mask, median,
+Zarr write) on a synthetic Sentinel-2 catalog of local COGs, writing to a
+local store. No network access needed.
+
+Use it as the regression gate for performance changes to lib.py: save a
+baseline before the change, then compare against it after.
+
+python benchmarks/end_to_end.py --save-baseline baseline.json
+python benchmarks/end_to_end.py --baseline baseline.json --tolerance 0.1
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import click
+import numpy as np
+import pandas as pd
+import pystac
+import rasterio
+import shapely.geometry
+import zarr
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from lib import ChunkProcessingJob, JobConfig, JobContext  # noqa: E402
+from profiling import STAGES  # noqa: E402
+from pyramid import Pyramid  # noqa: E402
+from search import COLLECTION  # noqa: E402
+from storage import ZarrFSSpecStorage  # noqa: E402
+from tuning import TUNING_MODES  # noqa: E402
+
+# north-west corner of the synthetic area
+ORIGIN = (10.0, 46.0)
+BANDS = ["red", "green", "blue"]
+# SCL classes: clear (vegetation / not vegetated) and cloud (medium / high)
+CLEAR_CLASSES = (4, 5)
+CLOUD_CLASSES = (8, 9)
+
+STAC_EXTENSIONS = [
+    "https://stac-extensions.github.io/projection/v1.1.0/schema.json",
+    "https://stac-extensions.github.io/raster/v1.1.0/schema.json",
+]
+
+
+@dataclass(frozen=True)
+class CatalogParams:
+    # output grid: tiles x tiles chunks of chunk_size pixels at dx degrees
+    tiles: int
+    chunk_size: int
+    dx: float
+    # scene pixels are scene_zoom times finer than the output; SCL is half that
+    scene_zoom: int
+    # granules per side covering the area, and how far they overlap their
+    # neighbours, as a fraction of their size
+    granules: int
+    overlap: float
+    # acquisitions per month, and months
+    scenes: int
+    periods: int
+    # mean cloud fraction of a scene
+    cloudiness: float
+    # internal tile size of the COGs
+    blocksize: int
+    seed: int = 0
+
+    @property
+    def bounds(self) -> tuple[float, float, float, float]:
+        size = self.tiles * self.chunk_size * self.dx
+        west, north = ORIGIN
+        return (west, north - size, west + size, north)
+
+    def key(self) -> str:
+        return hashlib.sha256(json.dumps(asdict(self)).encode()).hexdigest()[:12]
+
+
+def _blobs(rng, shape: tuple[int, int], scale: int) -> np.ndarray:
+    """Smooth random field in [0, 1): noise on a coarse grid, upsampled."""
+    coarse = rng.random((shape[0] // scale + 2, shape[1] // scale + 2))
+    field = coarse.repeat(scale, axis=0).repeat(scale, axis=1)
+    return field[: shape[0], : shape[1]]
+
+
+def _write_cog(path: str, data: np.ndarray, transform, blocksize: int) -> None:
+    with rasterio.open(
+        path,
+        "w",
+        driver="COG",
+        width=data.shape[1],
+        height=data.shape[0],
+        count=1,
+        dtype=data.dtype,
+        crs="epsg:4326",
+        transform=transform,
+        nodata=0,
+        compress="deflate",
+        blocksize=blocksize,
+    ) as dst:
+        dst.write(data, 1)
+
+
+def _granule_item(
+    rng, root: str, params: CatalogParams, when: datetime, gy: int, gx: int
+) -> pystac.Item:
+    west, south, east, north = params.bounds
+    step = (east - west) / params.granules
+    pad = step * params.overlap
+    g_west, g_north = west + gx * step - pad, north - gy * step + pad
+    size = step + 2 * pad
+
+    res = params.dx / params.scene_zoom
+    n = int(round(size / res))
+    scl_n = n // 2
+    cloud_fraction = float(np.clip(rng.normal(params.cloudiness, 0.15), 0, 1))
+
+    item_id = f"S2X_SYN_{gy}{gx}_{when:%Y%m%d}"
+    scl_blobs = _blobs(rng, (scl_n, scl_n), scale=max(scl_n // 16, 1))
+    cloudy = scl_blobs < np.quantile(scl_blobs, cloud_fraction)
+    scl = np.where(
+        cloudy,
+        rng.choice(CLOUD_CLASSES, size=cloudy.shape),
+        np.where(_blobs(rng, cloudy.shape, 32) < 0.5, *CLEAR_CLASSES),
+    ).astype("uint8")
+
+    assets = {}
+    rasters = {"scl": (scl, from_origin(g_west, g_north, 2 * res, 2 * res))}
+    for band in BANDS:
+        # smooth surface plus sensor noise, so it compresses like real imagery
+        surface = 500 + 2500 * _blobs(rng, (n, n), scale=64)
+        data = surface + rng.normal(0, 30, size=(n, n))
+        rasters[band] = (
+            np.clip(data, 1, 10_000).astype("uint16"),
+            from_origin(g_west, g_north, res, res),
+        )
+    for name, (data, transform) in rasters.items():
+        path = os.path.join(root, f"{item_id}_{name}.tif")
+        _write_cog(path, data, transform, params.blocksize)
+        assets[name] = pystac.Asset(
+            href=path,
+            media_type=pystac.MediaType.COG,
+            roles=["data"],
+            extra_fields={
+                "proj:shape": list(data.shape),
+                "proj:transform": list(transform)[:6],
+                "raster:bands": [{"data_type": str(data.dtype), "nodata": 0}],
+            },
+        )
+
+    footprint = shapely.geometry.box(g_west, g_north - size, g_west + size, g_north)
+    item = pystac.Item(
+        id=item_id,
+        geometry=shapely.geometry.mapping(footprint),
+        bbox=list(footprint.bounds),
+        datetime=when,
+        properties={
+            "eo:cloud_cover": 100 * cloud_fraction,
+            "s2:nodata_pixel_percentage": 0.0,
+            "grid:code": f"SYN-{gy}-{gx}",
+            "sat:relative_orbit": 1,
+            "proj:epsg": 4326,
+        },
+        stac_extensions=STAC_EXTENSIONS,
+        collection=COLLECTION,
+    )
+    for name, asset in assets.items():
+        item.add_asset(name, asset)
+    return item
+
+
+def make_catalog(params: CatalogParams, workdir: str) -> str:
+    """
+    Write the COGs and an ItemCollection for ``params`` under ``workdir``,
+    unless they're already there. Returns the path of the ItemCollection.
+    """
+    root = os.path.join(workdir, f"catalog-{params.key()}")
+    path = os.path.join(root, "items.json")
+    if os.path.exists(path):
+        return path
+    os.makedirs(root, exist_ok=True)
+
+    rng = np.random.default_rng(params.seed)
+    items = []
+    for period in range(params.periods):
+        month = datetime(2020 + period // 12, 1 + period % 12, 1)
+        days_between = 28 // params.scenes
+        for scene in range(params.scenes):
+            when = month + timedelta(days=scene * days_between, hours=10)
+            for gy in range(params.granules):
+                for gx in range(params.granules):
+                    items.append(_granule_item(rng, root, params, when, gy, gx))
+
+    # written last, so an interrupted run doesn't leave a partial catalog
+    with open(path, "w") as f:
+        json.dump(pystac.ItemCollection(items).to_dict(), f)
+    return path
+
+
+def run(
+    params: CatalogParams, catalog: str, store: str, **options
+) -> tuple[pd.DataFrame, float]:
+    """Process every chunk in this process; the results and the wall time."""
+    config = JobConfig(
+        dx=params.dx,
+        epsg=4326,
+        bounds=params.bounds,
+        start_date=datetime(2020, 1, 1),
+        end_date=datetime(
+            2020 + (params.periods - 1) // 12, 1 + (params.periods - 1) % 12, 1
+        ),
+        time_frequency_months=1,
+        bands=BANDS,
+        varname="rgb_median",
+        chunk_size=params.chunk_size,
+        stac_catalog=catalog,
+        **options,
+    )
+    storage = ZarrFSSpecStorage(store)
+    config.create_dataset_schema(storage)
+    target_array = zarr.open(storage.get_zarr_store(), path=config.varname)
+
+    ny, nx = config.tiles.shape
+    jobs = [
+        ChunkProcessingJob(tile_index=(y, x), time_index=t)
+        for t in range(len(config.time_data))
+        for y in range(ny)
+        for x in range(nx)
+    ]
+    overviews = None
+    if config.overview_levels:
+        overviews = Pyramid(
+            storage.get_zarr_store(),
+            storage.zarr_version,
+            config.varname,
+            config.overview_levels,
+            config.chunk_shape,
+            {job.tile_index for job in jobs},
+        )
+    context = JobContext(config=config, target_array=target_array, overviews=overviews)
+    tic = perf_counter()
+    results = [job.process(context) for job in jobs]
+    wall = perf_counter() - tic
+    return pd.DataFrame([asdict(r) for r in results]), wall
+
+
+def summarize(df: pd.DataFrame, wall: float) -> dict:
+    return {
+        "chunks": len(df),
+        "chunks_with_data": int(df.success.sum()),
+        "wall_seconds": wall,
+        "seconds_per_chunk": wall / len(df),
+        "stage_seconds": {s: float(df[f"{s}_seconds"].mean()) for s in STAGES},
+        "peak_rss_MiB": float(df.peak_rss_bytes.max() / 2**20),
+        "MiB_written": float(df.bytes_written.sum() / 2**20),
+        "load_block_size": sorted(df.load_block_size.unique().tolist()),
+        "compute_threads": sorted(df.compute_threads.unique().tolist()),
+    }
+
+
+def _ratio(new: float, old: float) -> str:
+    return f"{new / old:>6.2f}x" if old else "      -"
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Print the comparison; returns what regressed by more than ``tolerance``."""
+    click.echo(f"\n{'':<18} {'baseline':>9} {'now':>9} {'ratio':>7}")
+    rows = [("seconds/chunk", "seconds_per_chunk"), ("peak RSS MiB", "peak_rss_MiB")]
+    regressions = []
+    for label, key in rows:
+        old, new = baseline[key], summary[key]
+        click.echo(f"{label:<18} {old:>9.3f} {new:>9.3f} {_ratio(new, old)}")
+        if old and new > old * (1 + tolerance):
+            regressions.append(label)
+    for stage in STAGES:
+        old = baseline["stage_seconds"][stage]
+        new = summary["stage_seconds"][stage]
+        click.echo(f"  {stage:<16} {old:>9.3f} {new:>9.3f} {_ratio(new, old)}")
+    return regressions
+
+
+@click.command()
+@click.option("--tiles", type=int, default=2, show_default=True, help="Tiles per side.")
+@click.option("--chunk-size", type=int, default=600, show_default=True)
+@click.option("--resolution", type=float, default=1 / 3600, show_default=True)
+@click.option(
+    "--scene-zoom",
+    type=int,
+    default=1,
+    show_default=True,
+    help="How many times finer the scene pixels are than the output.",
+)
+@click.option("--granules", type=int, default=2, show_default=True)
+@click.option("--overlap", type=float, default=0.1, show_default=True)
+@click.option(
+    "--scenes", type=int, default=6, show_default=True, help="Acquisitions per month."
+)
+@click.option("--periods", type=int, default=1, show_default=True)
+@click.option("--cloudiness", type=float, default=0.4, show_default=True)
+@click.option("--blocksize", type=int, default=512, show_default=True)
+@click.option("--tuning", type=click.Choice(TUNING_MODES), default="auto")
+@click.option("--load-block-size", type=int)
+@click.option("--compute-threads", type=int)
+@click.option("--reducer", type=click.Choice(["dask", "streaming"]), default="dask")
+@click.option("--two-phase-load", is_flag=True)
+@click.option("--overview-levels", type=int, default=0, show_default=True)
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False),
+    default=os.path.join(tempfile.gettempdir(), "datacube-benchmark"),
+    show_default=True,
+    help="Where the synthetic catalogs are kept between runs.",
+)
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False))
+@click.option("--save-baseline", type=click.Path(dir_okay=False))
+@click.option(
+    "--tolerance",
+    type=float,
+    default=0.1,
+    show_default=True,
+    help="Fail if seconds per chunk or peak RSS grow by more than this fraction.",
+)
+def main(
+    tiles: int,
+    chunk_size: int,
+    resolution: float,
+    scene_zoom: int,
+    granules: int,
+    overlap: float,
+    scenes: int,
+    periods: int,
+    cloudiness: float,
+    blocksize: int,
+    tuning: str,
+    load_block_size: int | None,
+    compute_threads: int | None,
+    reducer: str,
+    two_phase_load: bool,
+    overview_levels: int,
+    workdir: str,
+    baseline: str | None,
+    save_baseline: str | None,
+    tolerance: float,
+):
+    params = CatalogParams(
+        tiles=tiles,
+        chunk_size=chunk_size,
+        dx=resolution,
+        scene_zoom=scene_zoom,
+        granules=granules,
+        overlap=overlap,
+        scenes=scenes,
+        periods=periods,
+        cloudiness=cloudiness,
+        blocksize=blocksize,
+    )
+    options = {
+        "reducer": reducer,
+        "two_phase_load": two_phase_load,
+        "tuning": tuning,
+        "load_block_size": load_block_size,
+        "compute_threads": compute_threads,
+        "overview_levels": overview_levels,
+    }
+
+    reference = None
+    if baseline:
+        with open(baseline) as f:
+            reference = json.load(f)
+        if reference["params"] != asdict(params) or reference["options"] != options:
+            raise click.UsageError("Baseline was run with different parameters")
+
+    tic = perf_counter()
+    catalog = make_catalog(params, workdir)
+    click.echo(f"Catalog ready in {perf_counter() - tic:.1f}s: {catalog}")
+
+    with tempfile.TemporaryDirectory() as store:
+        df, wall = run(params, catalog, store, **options)
+    summary = summarize(df, wall)
+
+    click.echo(
+        f"{summary['chunks']} chunks ({summary['chunks_with_data']} with data) "
+        f"in {wall:.1f}s, {summary['seconds_per_chunk']:.2f}s per chunk, "
+        f"peak RSS {summary['peak_rss_MiB']:.0f} MiB"
+    )
+    click.echo(
+        f"Block size {summary['load_block_size']}, threads {summary['compute_threads']}"
+    )
+    click.echo("Mean seconds per chunk by stage (dask stages are thread-seconds):")
+    for stage, seconds in summary["stage_seconds"].items():
+        click.echo(f"  {stage:<10} {seconds:>8.3f}")
+
+    if save_baseline:
+        with open(save_baseline, "w") as f:
+            json.dump(
+                {"params": asdict(params), "options": options, **summary}, f, indent=2
+            )
+        click.echo(f"Saved baseline to {save_baseline}")
+
+    if reference is not None:
+        regressions = compare(summary, reference, tolerance)
+        if regressions:
+            click.echo(
+                f"\nRegressed by more than {tolerance:.0%}: {', '.join(regressions)}"
+            )
+            sys.exit(1)
+        click.echo("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
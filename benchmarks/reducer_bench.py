@@ -0,0 +1,78 @@
+"""
+Compare the dask median with the streaming histogram median on synthetic stacks.
+
+python benchmarks/reducer_bench.py --scenes 20 --scenes 100 --size 1200
+"""
+
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+import click
+import dask
+import dask.array
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from reducers import StreamingMedian  # noqa: E402
+
+
+def synthetic_stack(
+    num_scenes: int, size: int, num_bands: int, cloud_fraction: float, seed: int = 0
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    stack = rng.integers(1, 10_000, size=(num_scenes, size, size, num_bands))
+    stack = stack.astype("uint16")
+    stack[rng.random(stack.shape[:3]) < cloud_fraction] = 0
+    return stack
+
+
+def dask_median(stack: np.ndarray) -> np.ndarray:
+    # same chunking and reduction as lib._dask_median
+    data = dask.array.from_array(stack, chunks=(1, 600, 600, -1))
+    da = xr.DataArray(data, dims=("time", "y", "x", "band"))
+    return da.where(da > 0).median(dim="time").astype("uint16").values
+
+
+def streaming_median(stack: np.ndarray) -> np.ndarray:
+    with StreamingMedian(stack.shape[1:]) as reducer:
+        for scene in stack:
+            reducer.add(scene)
+        return reducer.result()
+
+
+def measure(func, stack) -> tuple[np.ndarray, float, float]:
+    tracemalloc.start()
+    tic = perf_counter()
+    result = func(stack)
+    duration = perf_counter() - tic
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak / 2**20
+
+
+@click.command()
+@click.option("--scenes", multiple=True, type=int, default=[10, 50, 100])
+@click.option("--size", type=int, default=1200, show_default=True)
+@click.option("--bands", type=int, default=3, show_default=True)
+@click.option("--cloud-fraction", type=float, default=0.4, show_default=True)
+def main(scenes: list[int], size: int, bands: int, cloud_fraction: float):
+    click.echo("reducer    scenes  seconds  peak MiB")
+    for num_scenes in scenes:
+        stack = synthetic_stack(num_scenes, size, bands, cloud_fraction)
+        expected = None
+        for name, func in (("dask", dask_median), ("streaming", streaming_median)):
+            with dask.config.set(scheduler="threads"):
+                result, duration, peak = measure(func, stack)
+            if expected is None:
+                expected = result
+            else:
+                np.testing.assert_array_equal(result, expected)
+            click.echo(f"{name:<10} {num_scenes:>6} {duration:>8.2f} {peak:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Pack many small jobs into fewer, longer serverless invocations.
+
+Every invocation pays for a container start, heavy imports and client setup,
+so rather than one invocation per (tile, month) the jobs are grouped into
+bundles that each run for roughly a target amount of time.
+"""
+
+import glob
+import logging
+from collections.abc import Container, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+from lib import (
+    ChunkProcessingJob,
+    ChunkProcessingResult,
+    JobContext,
+    TileProcessingJob,
+    read_output_log,
+)
+
+logger = logging.getLogger(__name__)
+
+# how long one invocation should run for, in seconds.
+# Lambda (Lithops) has a hard 15 minute limit; the local backend doesn't pay
+# per-invocation overhead, so it isn't bundled by default.
+DEFAULT_TARGET_SECONDS = {
+    "coiled": 600.0,
+    "modal": 300.0,
+    "lithops": 300.0,
+    "local": 0.0,
+}
+
+# used until there are logs from a previous run
+DEFAULT_SCENES_PER_CHUNK = 12.0
+DEFAULT_SECONDS_PER_SCENE = 2.0
+DEFAULT_SECONDS_PER_CHUNK = 5.0
+
+
+@dataclass(frozen=True)
+class RuntimeModel:
+    """
+    Expected time to compute a chunk: a fixed cost plus a cost per scene, with
+    the number of scenes per chunk estimated per tile.
+    """
+
+    seconds_per_chunk: float = DEFAULT_SECONDS_PER_CHUNK
+    seconds_per_scene: float = DEFAULT_SECONDS_PER_SCENE
+    scenes_per_chunk: float = DEFAULT_SCENES_PER_CHUNK
+    tile_scenes: dict[tuple[int, int], float] = field(default_factory=dict)
+
+    @classmethod
+    def from_logs(cls, paths: Iterable[str], grid: str | None = None) -> "RuntimeModel":
+        """
+        Fit the model to the logs of previous runs (see ``save_output_log``).
+        Given a ``grid``, only runs of it are used, as tile indexes from
+        another grid are other places; logs without one are left out then.
+        """
+        frames = [read_output_log(p) for p in paths]
+        if grid is not None:
+            frames = [df[df.grid == grid] for df in frames if "grid" in df]
+        frames = [df for df in frames if len(df)]
+        if not frames:
+            return cls()
+        df = pd.concat(frames, ignore_index=True)
+        df = df[df.success]
+        if len(df) < 2:
+            return cls()
+
+        duration = df.search_duration + df.load_duration + df.write_duration
+        # least-squares fit of duration = a + b * num_scenes
+        if df.num_scenes.nunique() > 1:
+            b = duration.cov(df.num_scenes) / df.num_scenes.var()
+            a = duration.mean() - b * df.num_scenes.mean()
+        else:
+            a, b = 0.0, duration.mean() / max(df.num_scenes.mean(), 1)
+
+        tile_scenes = df.groupby(["tile_y", "tile_x"]).num_scenes.mean()
+        return cls(
+            seconds_per_chunk=max(float(a), 0.0),
+            seconds_per_scene=max(float(b), 0.0),
+            scenes_per_chunk=float(df.num_scenes.mean()),
+            tile_scenes={
+                (int(y), int(x)): float(n) for (y, x), n in tile_scenes.items()
+            },
+        )
+
+    @classmethod
+    def from_log_glob(cls, pattern: str, grid: str | None = None) -> "RuntimeModel":
+        paths = sorted(glob.glob(pattern))
+        logger.info("Estimating job runtimes from %d previous logs", len(paths))
+        return cls.from_logs(paths, grid=grid)
+
+    def chunk_seconds(self, tile_index: tuple[int, int]) -> float:
+        scenes = self.tile_scenes.get(tuple(tile_index), self.scenes_per_chunk)
+        return self.seconds_per_chunk + self.seconds_per_scene * scenes
+
+    def job_seconds(self, job: ChunkProcessingJob | TileProcessingJob) -> float:
+        num_chunks = len(job.time_indexes) if isinstance(job, TileProcessingJob) else 1
+        return num_chunks * self.chunk_seconds(job.tile_index)
+
+
+# rounds of resubmitting the jobs that failed inside bundles
+BUNDLE_RETRIES = 3
+
+
+@dataclass(frozen=True)
+class JobFailure:
+    """
+    A job of a bundle that raised. Handed back with the rest of the bundle's
+    results, for the driver to run it again (see ``retry_bundles``).
+    """
+
+    job: ChunkProcessingJob | TileProcessingJob
+    error: str
+
+    @property
+    def num_chunks(self) -> int:
+        if isinstance(self.job, TileProcessingJob):
+            return len(self.job.time_indexes)
+        return 1
+
+
+def _run_one(
+    job: ChunkProcessingJob | TileProcessingJob, context: JobContext, debug: bool
+):
+    try:
+        return job.process(context, debug=debug)
+    except Exception as e:
+        # one bad chunk shouldn't throw away the rest of the bundle
+        logger.exception("Job for tile %s failed", job.tile_index)
+        return JobFailure(job, repr(e))
+
+
+@dataclass(frozen=True)
+class JobBundle:
+    """Several jobs run one after the other (or a few at a time) in one worker."""
+
+    jobs: tuple[ChunkProcessingJob | TileProcessingJob, ...]
+    concurrency: int = 1
+
+    @property
+    def tile_index(self) -> tuple[int, int]:
+        # for log messages about the bundle
+        return self.jobs[0].tile_index
+
+    def process(
+        self, context: JobContext, debug: bool = False
+    ) -> list[ChunkProcessingResult | JobFailure]:
+        """
+        Results of every job, in order. A job that fails gives a ``JobFailure``
+        rather than failing the whole bundle, so the backend's retries don't
+        run the jobs that succeeded again.
+        """
+        if self.concurrency > 1:
+            with ThreadPoolExecutor(self.concurrency) as executor:
+                outputs = list(
+                    executor.map(lambda job: _run_one(job, context, debug), self.jobs)
+                )
+        else:
+            outputs = [_run_one(job, context, debug) for job in self.jobs]
+
+        results = []
+        for output in outputs:
+            if isinstance(output, list):
+                results.extend(output)
+            else:
+                results.append(output)
+        return results
+
+
+def bundle_jobs(
+    jobs: Iterable[ChunkProcessingJob | TileProcessingJob],
+    target_seconds: float,
+    model: RuntimeModel | None = None,
+    concurrency: int = 1,
+    max_jobs: int | None = None,
+) -> list[JobBundle]:
+    """
+    Greedily pack ``jobs``, in order, into bundles with an expected runtime of
+    about ``target_seconds`` each (divided by ``concurrency`` when jobs run
+    concurrently in a bundle). A job longer than the target gets a bundle to
+    itself.
+    """
+    model = model or RuntimeModel()
+    bundles = []
+    current: list = []
+    current_seconds = 0.0
+    for job in jobs:
+        seconds = model.job_seconds(job) / concurrency
+        full = current_seconds + seconds > target_seconds or (
+            max_jobs is not None and len(current) >= max_jobs
+        )
+        if current and full:
+            bundles.append(JobBundle(tuple(current), concurrency=concurrency))
+            current, current_seconds = [], 0.0
+        current.append(job)
+        current_seconds += seconds
+
+    if current:
+        bundles.append(JobBundle(tuple(current), concurrency=concurrency))
+    return bundles
+
+
+def retry_bundles(
+    failures: Iterable[JobFailure],
+    target_seconds: float,
+    model: RuntimeModel | None = None,
+    concurrency: int = 1,
+    heavy: Container[tuple[int, int]] = frozenset(),
+) -> tuple[list[JobBundle], list[JobBundle]]:
+    """
+    The jobs that failed inside bundles, bundled again: those for ``heavy``
+    tiles on their own (for the larger workers), and the rest.
+    """
+    jobs = [failure.job for failure in failures]
+    return tuple(
+        bundle_jobs(
+            [job for job in jobs if (job.tile_index in heavy) == is_heavy],
+            target_seconds,
+            model=model,
+            concurrency=concurrency,
+        )
+        for is_heavy in (True, False)
+    )
@@ -1,21 +1,81 @@
+from collections.abc import Container, Generator
+
 import coiled
-import zarr
-from lib import ChunkProcessingJob, ChunkProcessingResult
+import distributed
 from tqdm import tqdm
 
-
-@coiled.function(
-    cpu=4, region="us-west-2", environ={"ZARR_V3_EXPERIMENTAL_API": "1"}, keepalive="5m"
+from bundling import JobBundle
+from encoding import COMPRESSION_THREADS_ENV
+from lib import (
+    ChunkProcessingJob,
+    ChunkProcessingResult,
+    JobContext,
+    TileProcessingJob,
+    flatten_results,
 )
-def process_chunk(
-    job: ChunkProcessingJob, array: zarr.Array, debug: bool
-) -> ChunkProcessingResult | None:
-    return job.process(array, debug=debug)
+from speculation import LatencyTracker, run_speculatively
+from tuning import Resources
+
+WORKER = Resources(cpus=4, memory_bytes=16 * 2**30)
+# for jobs predicted not to fit on WORKER (see scheduling.heavy_tiles)
+LARGE_WORKER = Resources(cpus=4, memory_bytes=32 * 2**30)
+ENVIRON = {
+    "ZARR_V3_EXPERIMENTAL_API": "1",
+    # dask runs several jobs at once on each worker, which already
+    # compress in parallel; Blosc threads are per process
+    COMPRESSION_THREADS_ENV: "1",
+}
+
+
+def _process_chunk(
+    job: ChunkProcessingJob | TileProcessingJob | JobBundle,
+    context: JobContext,
+    debug: bool,
+) -> ChunkProcessingResult | list[ChunkProcessingResult] | None:
+    return job.process(context, debug=debug)
+
+
+# keep the plain function around to submit directly to the cluster
+process_chunk = coiled.function(
+    cpu=WORKER.cpus,
+    memory=f"{WORKER.memory_bytes // 2**30} GiB",
+    region="us-west-2",
+    environ=ENVIRON,
+    keepalive="5m",
+)(_process_chunk)
+# a second cluster, only started when there are heavy jobs
+process_chunk_large = coiled.function(
+    cpu=LARGE_WORKER.cpus,
+    memory=f"{LARGE_WORKER.memory_bytes // 2**30} GiB",
+    region="us-west-2",
+    environ=ENVIRON,
+    keepalive="5m",
+)(_process_chunk)
+
+
+def _wait_first(futures: list[distributed.Future], timeout: float) -> set:
+    try:
+        return distributed.wait(
+            futures, timeout=timeout, return_when="FIRST_COMPLETED"
+        ).done
+    except distributed.TimeoutError:
+        return set()
+
+
+def _large_results(futures: list[distributed.Future]) -> Generator:
+    for future in distributed.as_completed(futures):
+        # failed after all retries; reported as None, like the other backends
+        yield from flatten_results([None if future.exception() else future.result()])
 
 
 def spawn_coiled_jobs(
-    jobs: list[ChunkProcessingJob], array: zarr.Array, debug: bool
-) -> list[ChunkProcessingResult]:
+    jobs: list[ChunkProcessingJob | TileProcessingJob | JobBundle],
+    context: JobContext,
+    debug: bool,
+    tracker: LatencyTracker | None = None,
+    max_inflight: int = 1000,
+    large_jobs: Container = frozenset(),
+) -> Generator[ChunkProcessingResult | None, None, None]:
     # futures = []
     # for job in jobs:
     #     future = process_chunk.submit(job, array, debug=debug)
@@ -24,12 +84,45 @@ def spawn_coiled_jobs(
 
     # map does not return futures - hard to monitor progress
     jobs = list(jobs)
-    results = list(
-        tqdm(
-            process_chunk.map(jobs, array=array, debug=debug, retries=5),
-            total=len(jobs),
-            desc="Jobs Completed",
+    large_futures = []
+    if large_jobs:
+        # submitted up front, to run alongside the rest on the large cluster
+        # (without speculation)
+        large_client = process_chunk_large.client
+        large_context = large_client.scatter(context, broadcast=True)
+        large_futures = [
+            large_client.submit(_process_chunk, job, large_context, debug, retries=5)
+            for job in jobs
+            if job in large_jobs
+        ]
+        jobs = [job for job in jobs if job not in large_jobs]
+
+    # copy the context to every worker once; the jobs only reference it
+    client = process_chunk.client
+    context_future = client.scatter(context, broadcast=True)
+
+    if tracker is not None:
+        # map can't relaunch stragglers, so submit the jobs one by one.
+        # pure=False so a duplicate gets its own key instead of the same future
+        yield from run_speculatively(
+            jobs,
+            submit=lambda job: client.submit(
+                _process_chunk, job, context_future, debug, pure=False
+            ),
+            wait=_wait_first,
+            result=lambda f: f.result(),
+            tracker=tracker,
+            max_inflight=max_inflight,
         )
+        yield from _large_results(large_futures)
+        return
+
+    results = tqdm(
+        process_chunk.map(jobs, context=context_future, debug=debug, retries=5),
+        total=len(jobs),
+        desc="Jobs Completed",
     )
 
-    return results
+    # yield as they come back, rather than waiting for the whole run
+    yield from flatten_results(results)
+    yield from _large_results(large_futures)
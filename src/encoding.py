@@ -0,0 +1,167 @@
+"""
+How the data array of the cube is encoded, and compressing its chunks with
+several threads on the workers.
+
+The default is what the cube has always used: Blosc zstd at level 5 with byte
+shuffle, all the bands of a pixel next to each other in one chunk.
+``benchmarks/codec_tuning.py`` measures the alternatives on sample tiles and
+saves the pick as JSON, to pass to ``--encoding``. The encoding is recorded in
+the attributes of the array.
+"""
+
+import copy
+import json
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+import numcodecs
+import zarr
+from numcodecs import blosc
+
+SHUFFLES = {
+    "none": numcodecs.Blosc.NOSHUFFLE,
+    "byte": numcodecs.Blosc.SHUFFLE,
+    "bit": numcodecs.Blosc.BITSHUFFLE,
+}
+# "interleaved" chunks hold every band, "planar" ones a single band
+LAYOUTS = ("interleaved", "planar")
+
+# below this, a chunk compresses about as fast on one thread
+BYTES_PER_THREAD = 2**21
+# overrides the number of compression threads (1 turns threading off)
+COMPRESSION_THREADS_ENV = "DATACUBE_COMPRESSION_THREADS"
+
+
+@dataclass(frozen=True)
+class Encoding:
+    cname: str = "zstd"
+    clevel: int = 5
+    shuffle: str = "byte"
+    layout: str = "interleaved"
+
+    def compressor(self) -> numcodecs.Blosc:
+        return numcodecs.Blosc(
+            cname=self.cname, clevel=self.clevel, shuffle=SHUFFLES[self.shuffle]
+        )
+
+    def chunks(self, chunk_shape: tuple[int, int], num_bands: int) -> tuple:
+        """Zarr chunks of the (time, y, x, band) array."""
+        bands = 1 if self.layout == "planar" else num_bands
+        return (1,) + tuple(chunk_shape) + (bands,)
+
+    @property
+    def label(self) -> str:
+        return f"{self.cname}-{self.clevel}-{self.shuffle}-{self.layout}"
+
+    def save(self, fname: str) -> None:
+        with open(fname, "w") as f:
+            json.dump(asdict(self), f, indent=2)
+
+    @classmethod
+    def load(cls, fname: str) -> "Encoding":
+        with open(fname) as f:
+            return cls(**json.load(f))
+
+
+def compression_threads(chunk_bytes: int, cpus: int) -> int:
+    """Threads to compress a chunk of ``chunk_bytes`` with."""
+    if COMPRESSION_THREADS_ENV in os.environ:
+        return int(os.environ[COMPRESSION_THREADS_ENV])
+    return max(1, min(cpus, chunk_bytes // BYTES_PER_THREAD))
+
+
+class _BloscGate:
+    """
+    Blosc's threads use its global context, which is global to the process:
+    any thread that sees ``blosc.use_threads`` on (de)compresses with it, and
+    resizing the pool under one of those crashes. So a threaded encode runs
+    alone, while single threaded calls, which each get their own context, can
+    run together.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        # waiting exclusive callers go first, so a stream of decodes can't
+        # hold them off
+        self._waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not (self._exclusive or self._waiting))
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._waiting += 1
+            self._cond.wait_for(lambda: not (self._exclusive or self._shared))
+            self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+_BLOSC_GATE = _BloscGate()
+
+
+class _ThreadedBlosc:
+    """
+    Compresses with ``threads`` Blosc threads; otherwise ``compressor``, but
+    never while another chunk has the threads.
+    """
+
+    def __init__(self, compressor: numcodecs.Blosc, threads: int):
+        self.compressor = compressor
+        self.threads = threads
+
+    def encode(self, buf):
+        if self.threads <= 1:
+            with _BLOSC_GATE.shared():
+                return self.compressor.encode(buf)
+        with _BLOSC_GATE.exclusive():
+            use_threads = blosc.use_threads
+            # by default Blosc only uses threads on the main thread
+            blosc.use_threads = True
+            previous = blosc.set_nthreads(self.threads)
+            try:
+                return self.compressor.encode(buf)
+            finally:
+                blosc.set_nthreads(previous)
+                blosc.use_threads = use_threads
+
+    def decode(self, buf, out=None):
+        with _BLOSC_GATE.shared():
+            return self.compressor.decode(buf, out=out)
+
+    def __getattr__(self, name):
+        return getattr(self.compressor, name)
+
+
+def threaded_array(array: zarr.Array, threads: int = 1) -> zarr.Array:
+    """
+    A view of ``array`` whose chunk writes are compressed with ``threads``.
+
+    Every Blosc array a worker uses goes through this, with one thread if
+    need be, so its chunks aren't (de)compressed while another array's
+    threaded encode has Blosc's global state changed.
+    """
+    if not isinstance(array.compressor, numcodecs.Blosc):
+        return array
+    threaded = copy.copy(array)
+    threaded._compressor = _ThreadedBlosc(array.compressor, threads)
+    return threaded
@@ -2,26 +2,53 @@
 All the geospatial and data processing stuff goes here.
 """
 
-import logging
+import hashlib
+import math
 import os
-import sys
-import warnings
-from concurrent.futures import ThreadPoolExecutor
+import pickle
+from collections.abc import Container, Generator, Iterable
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import cached_property
 from time import perf_counter, time
-from typing import Generator
 
-import dask
 import numpy as np
 import odc.stac
 import pandas as pd
-import pystac_client
+import shapely
+import xarray as xr
 import zarr
-from cartopy.feature import LAND
-from odc.algo import erase_bad, mask_cleanup
 from odc.geo.geobox import GeoBox, GeoboxTiles
-from odc.geo.xr import xr_zeros
+from xarray.coding.times import encode_cf_datetime
+
+from encoding import Encoding, compression_threads, threaded_array
+from masking import (
+    DEFAULT_VALID_CLASSES,
+    clean_cloud_mask,
+    erase_usable_blocks,
+    fused_cloud_mask,
+)
+from memory import (
+    MAX_SPLITS,
+    MemoryPlan,
+    estimate_peak_bytes,
+    estimate_scratch_bytes,
+    fits,
+    split_windows,
+)
+from profiling import DaskStages, Profile, timed_array
+from pruning import prune_items
+from pyramid import Pyramid, overview_path, partial_path
+from reducers import StreamingMedian
+from runtime import compute_pool, init_worker
+from schema import write_schema
+from search import AbstractSearch, SearchStats, get_search_backend
+from tiling import land_tiles
+from tuning import LoadSettings, Resources, detect_resources, tune
+
+# number of threads used to compute each chunk; the local backend sets this
+# per worker process when --local-threads is given, otherwise it's tuned
+COMPUTE_THREADS_ENV = "DATACUBE_COMPUTE_THREADS"
 
 
 @dataclass(frozen=True)
@@ -35,12 +62,53 @@ class JobConfig:
     bands: list[str]
     varname: str
     chunk_size: int
+    # optional area of interest in lat/lon; tiles outside it are skipped
+    aoi: shapely.Geometry | None = None
+    # static STAC catalog on disk to search instead of Earth Search
+    stac_catalog: str | None = None
+    # local directory or fsspec uri for caching search results
+    search_cache_uri: str | None = None
+    search_cache_ttl: float | None = None
+    # first time step of the cube, when appending to an existing one;
+    # defaults to start_date
+    time_origin: datetime | None = None
+    # how to compute the median over time; one of REDUCERS
+    reducer: str = "dask"
+    # SCL classes to keep, and the cloud mask cleanup radii in pixels
+    scl_valid_classes: tuple[int, ...] = DEFAULT_VALID_CLASSES
+    mask_closing_radius: int = 5
+    mask_opening_radius: int = 5
+    # metadata-based scene pruning; see pruning.prune_items
+    max_cloud_cover: float | None = None
+    max_nodata: float | None = None
+    min_scene_overlap: float = 0.0
+    max_scenes: int | None = None
+    dedupe_scenes: bool = False
+    # adaptive early stopping: stop reading scenes once adaptive_target_fraction
+    # of the pixels have at least adaptive_min_clear clear observations
+    adaptive_min_clear: int | None = None
+    adaptive_target_fraction: float = 0.95
+    adaptive_batch_size: int = 8
+    # load and clean the SCL mask first, then only fetch usable RGB blocks
+    two_phase_load: bool = False
+    # dask block size and compute threads: "auto" derives them from the tile
+    # and the worker (see tuning.tune), "fixed" is 600 pixels and 16 threads;
+    # either is overridden by setting them here
+    tuning: str = "auto"
+    load_block_size: int | None = None
+    compute_threads: int | None = None
+    # levels of 2x overviews written next to the cube (see pyramid.py)
+    overview_levels: int = 0
+    # compressor and band layout of the cube (see encoding.py)
+    encoding: Encoding = Encoding()
 
     @property
     def crs(self) -> str:
         return f"epsg:{self.epsg}"
 
-    @property
+    # the geometry is derived from the fields, and the config is immutable,
+    # so it's computed once per instance
+    @cached_property
     def geobox(self) -> GeoBox:
         return GeoBox.from_bbox(self.bounds, crs=self.crs, resolution=self.dx)
 
@@ -48,16 +116,68 @@ class JobConfig:
     def chunk_shape(self) -> tuple[int, int]:
         return (self.chunk_size, self.chunk_size)
 
-    @property
+    @cached_property
     def tiles(self) -> GeoboxTiles:
         return GeoboxTiles(self.geobox, self.chunk_shape)
 
     @property
+    def grid(self) -> str:
+        """
+        Identifies the tile grid, so run logs of other cubes (whose tile
+        indexes mean other places) can be told apart.
+        """
+        return f"{self.crs} {tuple(self.bounds)} dx={self.dx} chunk={self.chunk_size}"
+
+    @cached_property
     def num_tiles(self) -> int:
         tiles = self.tiles
         return tiles.shape[0] * tiles.shape[1]
 
-    @property
+    def memory_plan(
+        self, tile_shape: tuple[int, int], num_items: int, resources: Resources
+    ) -> MemoryPlan:
+        """
+        How to compute a chunk of ``tile_shape`` from ``num_items`` scenes on a
+        worker with ``resources``: whole if it fits, otherwise in the fewest
+        sub-windows that do (see memory.py), in memory and on scratch disk.
+        """
+        scenes_in_memory = _scenes_in_memory(self, num_items)
+        if self.adaptive_min_clear:
+            # the dask median keeps every scene read; streaming a batch
+            scenes_kept = num_items if self.reducer == "dask" else scenes_in_memory
+        elif self.reducer == "streaming":
+            scenes_kept = scenes_in_memory
+        else:
+            scenes_kept = 0
+        # the streaming median spills every scene it reads to disk
+        scenes_spilled = num_items if self.reducer == "streaming" else 0
+        for splits in range(1, MAX_SPLITS + 1):
+            margin = 2 * _window_margin(self) if splits > 1 else 0
+            shape = tuple(math.ceil(n / splits) + margin for n in tile_shape)
+            settings = _load_settings(self, shape, num_items, resources)
+            estimate = estimate_peak_bytes(
+                shape,
+                len(self.bands),
+                settings,
+                scenes_in_memory,
+                scenes_kept=scenes_kept,
+                mask_scenes=num_items if self.two_phase_load else 0,
+            )
+            scratch = estimate_scratch_bytes(shape, len(self.bands), scenes_spilled)
+            if fits(estimate, resources.memory_bytes) and fits(
+                scratch, resources.scratch_bytes
+            ):
+                break
+        return MemoryPlan(splits, settings, estimate, scratch)
+
+    def search_backend(self) -> AbstractSearch:
+        return get_search_backend(
+            catalog=self.stac_catalog,
+            cache_uri=self.search_cache_uri,
+            cache_ttl=self.search_cache_ttl,
+        )
+
+    @cached_property
     def time_data(self) -> pd.DatetimeIndex:
         return pd.date_range(
             start=self.start_date,
@@ -65,76 +185,147 @@ class JobConfig:
             freq=f"{self.time_frequency_months}MS",
         )
 
+    @cached_property
+    def full_time_data(self) -> pd.DatetimeIndex:
+        """The whole time axis of the cube, including periods before start_date."""
+        return pd.date_range(
+            start=self.time_origin or self.start_date,
+            end=self.end_date,
+            freq=f"{self.time_frequency_months}MS",
+        )
+
     @property
     def num_jobs(self) -> int:
         # not exact; some of the tiles are over ocean and won't generate jobs
         return len(self.time_data) * self.num_tiles
 
-    def create_dataset_schema(self, storage) -> None:
-        storage.initialize()
+    def period_dates(self, year: int, month: int) -> tuple[datetime, datetime]:
+        """First and last day of the time period starting at year / month."""
+        start_date = datetime(year, month, 1)
+        next_month = ((month + self.time_frequency_months - 1) % 12) + 1
+        next_year = year + (month + self.time_frequency_months - 1) // 12
+        end_date = datetime(next_year, next_month, 1) - timedelta(days=1)
+        return start_date, end_date
 
-        big_ds = (
-            xr_zeros(self.geobox, chunks=-1, dtype="uint16")
-            .expand_dims(
-                {
-                    "band": self.bands,
-                    "time": self.time_data,
-                }
-            )
-            .transpose(..., "band")
-        ).to_dataset(name=self.varname)
-        big_ds.attrs["title"] = "Sentinel 2 Data Cube"
-
-        lon_encoding = optimize_coord_encoding(big_ds.longitude.values, self.dx)
-        lat_encoding = optimize_coord_encoding(big_ds.latitude.values, -self.dx)
-        encoding = {
-            "longitude": {"chunks": big_ds.longitude.shape, **lon_encoding},
-            "latitude": {"chunks": big_ds.latitude.shape, **lat_encoding},
-            "time": {
-                "chunks": big_ds.time.shape,
-                "compressor": zarr.Blosc(cname="zstd"),
-            },
-            "rgb_median": {
-                "chunks": (1,) + self.chunk_shape + (len(self.bands),),
-                "compressor": zarr.Blosc(cname="zstd"),
-                # workaround to create a fill value for the underlying zarr array
-                # since Xarray doesn't let us specify one explicitly
-                "_FillValue": 0,
-                "dtype": "uint16",
-            },
+    def time_index(self, year: int, month: int) -> int:
+        # not writing with xarray, so have to reverse engineer the time index
+        origin = self.time_origin or self.start_date
+        return (
+            12 * (year - origin.year) + (month - origin.month)
+        ) // self.time_frequency_months
+
+    def populated_chunks(self, storage) -> set[tuple[int, int, int, int]]:
+        """
+        (tile_y, tile_x, year, month) keys of the chunks already present in the
+        target array, suitable for passing as ``done`` to ``generate_jobs``.
+        """
+        dates = self.full_time_data
+        return {
+            (y, x, dates[t].year, dates[t].month)
+            for t, y, x, *_ in storage.list_chunks(self.varname)
+            if t < len(dates)
         }
 
-        print(big_ds)
-        big_ds.to_zarr(
+    def create_dataset_schema(self, storage) -> None:
+        storage.initialize()
+        group = write_schema(
             storage.get_zarr_store(),
-            encoding=encoding,
-            compute=False,
-            zarr_version=storage.zarr_version,
+            storage.zarr_version,
+            self.geobox,
+            self.time_data,
+            self.bands,
+            self.varname,
+            self.chunk_shape,
+            attrs={"title": "Sentinel 2 Data Cube"},
+            overview_levels=self.overview_levels,
+            encoding=self.encoding,
         )
+        array = group[self.varname]
+        print(f"Created {self.varname} {array.shape}, chunks {array.chunks}")
         storage.commit("Wrote initial dataset schema")
 
+    def extend_time_axis(self, storage) -> None:
+        """
+        Grow the time dimension of an existing cube in place so that it reaches
+        end_date. Existing data is left untouched.
+        """
+        group = zarr.open_group(
+            storage.get_zarr_store(), mode="r+", zarr_version=storage.zarr_version
+        )
+        time_array = group["time"]
+        data_array = group[self.varname]
+
+        full_time = self.full_time_data
+        old_len = time_array.shape[0]
+        encoded, _, _ = encode_cf_datetime(
+            full_time,
+            units=time_array.attrs["units"],
+            calendar=time_array.attrs.get("calendar", "proleptic_gregorian"),
+        )
+
+        time_array.resize(len(full_time))
+        time_array[old_len:] = encoded[old_len:].astype(time_array.dtype)
+        data_array.resize((len(full_time),) + data_array.shape[1:])
+        for level in range(1, self.overview_levels + 1):
+            for path in (
+                overview_path(self.varname, level),
+                partial_path(self.varname, level),
+            ):
+                overview = group[path]
+                overview.resize((len(full_time),) + overview.shape[1:])
+
+        if storage.zarr_version == 2:
+            # otherwise xarray will keep seeing the old shapes
+            zarr.consolidate_metadata(storage.get_zarr_store())
+        storage.commit(f"Extended time axis from {old_len} to {len(full_time)}")
+
     def generate_jobs(
-        self, limit: int = 0
-    ) -> Generator["ChunkProcessingJob", None, None]:
+        self,
+        limit: int = 0,
+        tile_major: bool = False,
+        done: Container[tuple[int, int, int, int]] = frozenset(),
+    ) -> Generator["ChunkProcessingJob | TileProcessingJob", None, None]:
+        """
+        Jobs for every land tile. They only hold indexes; the config goes to
+        the workers separately, in a ``JobContext``.
+
+        With ``tile_major``, emit one ``TileProcessingJob`` per tile covering all
+        time periods instead of one ``ChunkProcessingJob`` per (tile, period).
+        Chunks whose (tile_y, tile_x, year, month) key is in ``done`` are skipped.
+        ``limit`` counts chunks either way.
+        """
         count = 0
-        for idx in self.tiles._all_tiles():
-            tile = self.tiles[idx]
-            bbox = tile.boundingbox
-            extent = bbox.left, bbox.right, bbox.bottom, bbox.top
-            igeoms = list(LAND.intersecting_geometries(extent))
-            is_land = len(igeoms) > 0
-            if is_land:
-                for date in self.time_data:
-                    yield ChunkProcessingJob(
-                        self, tile_index=idx, year=date.year, month=date.month
-                    )
-                    count += 1
-                    if limit and count >= limit:
-                        return
+        periods = [
+            (self.time_index(date.year, date.month), date.year, date.month)
+            for date in self.time_data
+        ]
+        for idx in land_tiles(self.geobox, self.chunk_shape, aoi=self.aoi):
+            time_indexes = tuple(
+                t for t, year, month in periods if (*idx, year, month) not in done
+            )
+            if not time_indexes:
+                continue
+            if tile_major:
+                if limit:
+                    time_indexes = time_indexes[: limit - count]
+                yield TileProcessingJob(tile_index=idx, time_indexes=time_indexes)
+                count += len(time_indexes)
+                if limit and count >= limit:
+                    return
+                continue
+            for t in time_indexes:
+                yield ChunkProcessingJob(tile_index=idx, time_index=t)
+                count += 1
+                if limit and count >= limit:
+                    return
 
 
 @dataclass(frozen=True)
 class ChunkProcessingResult:
+    tile_y: int
+    tile_x: int
+    year: int
+    month: int
     success: bool
     num_scenes: int
     start_time: float
@@ -143,168 +334,658 @@ class ChunkProcessingResult:
     write_duration: float
     region: str | None
     cloud_provider: str | None
+    search_cache_hits: int = 0
+    search_cache_misses: int = 0
+    num_pruned: int = 0
+    pruned_bytes_estimate: int = 0
+    # may be less than num_scenes with adaptive early stopping
+    num_scenes_read: int = 0
+    # only counted by the two-phase loader
+    rgb_blocks_read: int = 0
+    rgb_blocks_total: int = 0
+    # first job in a fresh worker process, and time spent setting it up
+    cold_start: bool = False
+    setup_duration: float = 0.0
+    # per-stage timings; dask stages are thread-seconds (see profiling.py)
+    search_seconds: float = 0.0
+    metadata_seconds: float = 0.0
+    read_seconds: float = 0.0
+    mask_seconds: float = 0.0
+    reduce_seconds: float = 0.0
+    encode_seconds: float = 0.0
+    upload_seconds: float = 0.0
+    search_pages: int = 0
+    # COG bytes downloaded; None without the GDAL python bindings
+    bytes_read: int | None = None
+    bytes_written: int = 0
+    http_requests: int = 0
+    peak_rss_bytes: int = 0
+    cpu_seconds: float = 0.0
+    # how the chunk was loaded, and what the worker had (see tuning.py)
+    load_block_size: int = 0
+    compute_threads: int = 0
+    tuning_source: str | None = None
+    worker_cpus: int = 0
+    worker_memory_bytes: int = 0
+    # overview chunks this chunk completed, and the time spent on them
+    overview_chunks: int = 0
+    overview_duration: float = 0.0
+    # Blosc threads the chunk was compressed with
+    compression_threads: int = 0
+    # estimated peak memory (of one sub-window), to check against
+    # peak_rss_bytes, and how many sub-windows the chunk was computed in
+    memory_estimate_bytes: int = 0
+    sub_windows: int = 0
+    # scratch disk the streaming median spills to (of one sub-window)
+    scratch_estimate_bytes: int = 0
 
 
-@dataclass(frozen=True)
-class ChunkProcessingJob:
-    config: JobConfig
-    tile_index: tuple[int, int]
-    year: int
-    month: int
+def _date_query(start_date: datetime, end_date: datetime) -> str:
+    return start_date.strftime("%Y-%m-%d") + "/" + end_date.strftime("%Y-%m-%d")
 
-    def process(
-        self,
-        target_array: zarr.Array,
-        debug: bool = False,
-    ) -> "ChunkProcessingResult":
-        start_time = time()
 
-        warnings.filterwarnings("ignore")  # suppress warnings from rasterio
+@dataclass
+class LoadStats:
+    """What was actually read while computing a chunk, how and how long it took."""
 
-        if debug:
-            logger = logging.getLogger("arraylake")
-            logger.setLevel(logging.DEBUG)
-            stderr_handler = logging.StreamHandler(sys.stderr)
-            formatter = logging.Formatter(
-                "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-            )
-            stderr_handler.setFormatter(formatter)
-            logger.addHandler(stderr_handler)
+    profile: Profile
+    settings: LoadSettings
+    bands: list[str]
+    scenes_read: int = 0
+    rgb_blocks_read: int = 0
+    rgb_blocks_total: int = 0
 
-        odc.stac.configure_rio(cloud_defaults=True, aws={"aws_unsigned": True})
+    def compute(self, array: xr.DataArray, rest: str = "reduce") -> np.ndarray:
+        """
+        The values of ``array``, computed on this chunk's threads and timed
+        into its profile, with tasks that aren't reads or the cloud mask
+        counted as ``rest``. The scheduler, pool and callbacks are passed here
+        rather than set in dask's config, which concurrent jobs would share.
+        """
+        stages = DaskStages(self.profile, self.bands, rest=rest)
+        # the threaded scheduler, not a cluster (in Coiled)
+        return array.compute(
+            scheduler="threads",
+            pool=compute_pool(self.settings.threads),
+            callbacks=[stages._callback],
+        ).values
 
-        geobox = self.config.tiles[self.tile_index]
-        geom = geobox.geographic_extent
 
-        start_date = datetime(self.year, self.month, 1)
-        next_month = ((self.month + self.config.time_frequency_months - 1) % 12) + 1
-        next_year = (
-            self.year + (self.month + self.config.time_frequency_months - 1) // 12
-        )
-        end_date = datetime(next_year, next_month, 1) - timedelta(days=1)
-        date_query = (
-            start_date.strftime("%Y-%m-%d") + "/" + end_date.strftime("%Y-%m-%d")
-        )
+def _load_chunks(stats: LoadStats) -> dict[str, int]:
+    block = stats.settings.block_size
+    return {"time": 1, "x": block, "y": block}
 
-        tic1 = perf_counter()
-        items = (
-            pystac_client.Client.open("https://earth-search.aws.element84.com/v1")
-            .search(
-                intersects=geom,
-                collections=["sentinel-2-c1-l2a"],
-                datetime=date_query,
-                limit=400,
-            )
-            .item_collection()
-        )
 
-        tic2 = perf_counter()
+# native resolution of the Sentinel-2 SCL band (20 m), in degrees
+SCL_NATIVE_RES_DEG = 20 / 111_320
 
-        if len(items) == 0:
-            return ChunkProcessingResult(
-                success=False,
-                num_scenes=0,
-                start_time=start_time,
-                search_duration=tic2 - tic1,
-                load_duration=0,
-                write_duration=0,
-                region=os.environ.get("MODAL_REGION", None),
-                cloud_provider=os.environ.get("MODAL_CLOUD_PROVIDER", None),
-            )
 
+def _load_masked(
+    items, geobox: GeoBox, config: JobConfig, nan_fill: bool, stats: LoadStats
+) -> xr.DataArray:
+    """
+    Lazily load the scenes as a (time, band, y, x) array with cloudy and nodata
+    pixels set to NaN (``nan_fill``) or 0.
+    """
+    stats.scenes_read += len(items)
+    if config.two_phase_load:
+        return _load_masked_two_phase(items, geobox, config, nan_fill, stats)
+
+    # building the graph is all metadata; no pixels are read until compute
+    with stats.profile.stage("metadata"):
         ds = odc.stac.load(
             items,
-            bands=["scl"] + list(self.config.bands),
-            chunks={"time": 1, "x": 600, "y": 600},
+            bands=["scl"] + list(config.bands),
+            chunks=_load_chunks(stats),
             geobox=geobox,
             resampling="bilinear",
             groupby="solar_day",
         )
 
-        VEGETATION = 4
-        NOT_VEGETATED = 5
-        allowed_values = [VEGETATION, NOT_VEGETATED]
+    return fused_cloud_mask(
+        ds.scl,
+        ds[list(config.bands)],
+        valid_classes=config.scl_valid_classes,
+        closing_radius=config.mask_closing_radius,
+        opening_radius=config.mask_opening_radius,
+        nan_fill=nan_fill,
+    )
+
 
-        cloud_mask = ~ds.scl.isin(allowed_values)
-        cloud_mask = mask_cleanup(cloud_mask, [("closing", 5), ("opening", 5)])
-        ds_masked = erase_bad(ds[["red", "green", "blue"]], cloud_mask)
+def _load_masked_two_phase(
+    items, geobox: GeoBox, config: JobConfig, nan_fill: bool, stats: LoadStats
+) -> xr.DataArray:
+    """
+    Load the categorical SCL band first, with nearest resampling and no finer
+    than its native resolution, and only fetch the RGB blocks of each scene that
+    have at least one usable pixel.
+    """
+    factor = int(SCL_NATIVE_RES_DEG // abs(geobox.resolution.x))
+    scl_geobox = geobox.zoom_out(factor) if factor >= 2 else geobox
 
-        rgb_median = (
-            ds_masked.where(ds_masked > 0)
-            .to_dataarray(dim="band")
-            .median(dim="time")
-            .astype("uint16")
-            .transpose(..., "band")
+    profile = stats.profile
+    with profile.stage("metadata"):
+        scl = odc.stac.load(
+            items,
+            bands=["scl"],
+            chunks=_load_chunks(stats),
+            geobox=scl_geobox,
+            resampling="nearest",
+            groupby="solar_day",
+        ).scl
+    scl = stats.compute(scl, rest="read")
+    with profile.stage("mask"):
+        bad = clean_cloud_mask(
+            scl,
+            valid_classes=config.scl_valid_classes,
+            closing_radius=config.mask_closing_radius,
+            opening_radius=config.mask_opening_radius,
         )
+        if factor >= 2:
+            ny, nx = geobox.shape
+            bad = bad.repeat(factor, axis=1).repeat(factor, axis=2)[:, :ny, :nx]
+
+    with profile.stage("metadata"):
+        ds = odc.stac.load(
+            items,
+            bands=list(config.bands),
+            chunks=_load_chunks(stats),
+            geobox=geobox,
+            resampling="bilinear",
+            groupby="solar_day",
+        )
+    stack, blocks_read, blocks_total = erase_usable_blocks(ds, bad, nan_fill=nan_fill)
+    stats.rgb_blocks_read += blocks_read
+    stats.rgb_blocks_total += blocks_total
+    return stack
+
+
+def _dask_median(stack: xr.DataArray, stats: LoadStats) -> np.ndarray:
+    # the reduction runs inside dask, where DaskStages times it
+    rgb_median = stack.median(dim="time").astype("uint16").transpose(..., "band")
+    return stats.compute(rgb_median)
+
+
+# scenes held in memory at a time by the streaming median
+STREAMING_BATCH_SIZE = 4
+
+
+def _streaming_median(
+    stack: xr.DataArray, stats: LoadStats, batch_size: int = STREAMING_BATCH_SIZE
+) -> np.ndarray:
+    # only a few scenes are in memory at once, however many there are in total
+    stack = stack.transpose("time", ..., "band")
+    with StreamingMedian(stack.shape[1:], num_scenes=stack.sizes["time"]) as reducer:
+        for t0 in range(0, stack.sizes["time"], batch_size):
+            # the mask is fused with picking out the scenes
+            batch = stats.compute(
+                stack.isel(time=slice(t0, t0 + batch_size)), rest="mask"
+            )
+            with stats.profile.stage("reduce"):
+                for scene in batch:
+                    reducer.add(scene)
+        with stats.profile.stage("reduce"):
+            return reducer.result()
+
+
+REDUCERS = {"dask": _dask_median, "streaming": _streaming_median}
+
+
+def _solar_day_groups(items, geobox: GeoBox) -> list[list]:
+    """
+    ``items`` grouped by solar day the way ``odc.stac.load`` groups them (at
+    the longitude of the middle of ``geobox``), in order of their first item.
+    """
+    ((lon, _),) = geobox.extent.centroid.to_crs("epsg:4326").points
+    offset = timedelta(hours=int(lon / 15))
+    groups = {}
+    for item in items:
+        groups.setdefault((item.datetime + offset).date(), []).append(item)
+    return list(groups.values())
+
+
+def _adaptive_median(
+    items, geobox: GeoBox, config: JobConfig, stats: LoadStats
+) -> np.ndarray:
+    """
+    Read scenes in batches, best first, until enough pixels have enough clear
+    observations.
+    """
+    nan_fill = config.reducer == "dask"
+    shape = geobox.shape + (len(config.bands),)
+    clear_counts = np.zeros(geobox.shape, dtype="uint32")
+    scenes = []
+    # granules of the same solar day are fused into one scene when loaded, so
+    # they have to be in the same batch not to count their overlap twice
+    days = _solar_day_groups(items, geobox)
+
+    with StreamingMedian(shape, num_scenes=0 if nan_fill else len(days)) as streaming:
+        for b0 in range(0, len(days), config.adaptive_batch_size):
+            batch = [
+                item
+                for day in days[b0 : b0 + config.adaptive_batch_size]
+                for item in day
+            ]
+            stack = _load_masked(batch, geobox, config, nan_fill, stats)
+            data = stats.compute(stack.transpose("time", ..., "band"), rest="mask")
+
+            with stats.profile.stage("reduce"):
+                if nan_fill:
+                    clear = ~np.isnan(data).any(axis=-1)
+                    scenes.append(data)
+                else:
+                    clear = (data > 0).all(axis=-1)
+                    for scene in data:
+                        streaming.add(scene)
 
-        # oversubscribe the thread pool to saturate IO
-        # make sure we are using the threaded scheduler and not a cluster (in Coiled)
-        with dask.config.set(pool=ThreadPoolExecutor(16), scheduler="threads"):
-            raw_data = rgb_median.values
-        tic3 = perf_counter()
+                clear_counts += clear.sum(axis=0, dtype="uint32")
+                satisfied = np.mean(clear_counts >= config.adaptive_min_clear)
+            if satisfied >= config.adaptive_target_fraction:
+                break
 
-        # target_array = zarr.open(repo.store, path=varname)
+        with stats.profile.stage("reduce"):
+            if nan_fill:
+                median = np.nanmedian(np.concatenate(scenes), axis=0)
+                return median.astype("uint16")
+            return streaming.result()
 
-        xy_slice = tuple(
-            slice(cs * ci, cs * (ci + 1))
-            for cs, ci in zip(geobox.shape, self.tile_index)
+
+def _scenes_in_memory(config: JobConfig, num_items: int) -> int:
+    if config.adaptive_min_clear:
+        return config.adaptive_batch_size
+    if config.reducer == "streaming":
+        return STREAMING_BATCH_SIZE
+    # the dask median reduces each block over all the scenes at once
+    return num_items
+
+
+def _load_settings(
+    config: JobConfig,
+    tile_shape: tuple[int, int],
+    num_items: int,
+    resources: Resources | None = None,
+) -> LoadSettings:
+    threads = config.compute_threads
+    if threads is None and COMPUTE_THREADS_ENV in os.environ:
+        threads = int(os.environ[COMPUTE_THREADS_ENV])
+    return tune(
+        tile_shape,
+        num_bands=len(config.bands),
+        scenes_in_memory=_scenes_in_memory(config, num_items),
+        resources=resources or detect_resources(),
+        mode=config.tuning,
+        block_size=config.load_block_size,
+        threads=threads,
+    )
+
+
+def _compute_median(
+    items, geobox: GeoBox, config: JobConfig, profile: Profile
+) -> tuple[np.ndarray, LoadStats]:
+    """The median composite, and what was read to compute it."""
+    settings = _load_settings(config, geobox.shape, len(items))
+    stats = LoadStats(profile, settings, config.bands)
+    if config.adaptive_min_clear:
+        return _adaptive_median(items, geobox, config, stats), stats
+
+    # the dask median skips NaNs; the streaming one treats zeros as missing
+    nan_fill = config.reducer == "dask"
+    stack = _load_masked(items, geobox, config, nan_fill, stats)
+    return REDUCERS[config.reducer](stack, stats), stats
+
+
+def _window_margin(config: JobConfig) -> int:
+    # as far as the cloud mask cleanup reaches (see masking.fused_cloud_mask)
+    return 2 * (config.mask_closing_radius + config.mask_opening_radius)
+
+
+def _compute_in_windows(
+    items, geobox: GeoBox, config: JobConfig, profile: Profile, splits: int
+) -> tuple[np.ndarray, LoadStats]:
+    """
+    The median composite computed in ``splits`` x ``splits`` sub-windows, one
+    after the other. Each is read with a margin, so the cloud mask cleanup
+    comes out as it would for the whole chunk.
+    """
+    margin = _window_margin(config)
+    out = np.zeros(geobox.shape + (len(config.bands),), dtype="uint16")
+    stats = None
+    for window in split_windows(geobox.shape, splits):
+        padded = tuple(
+            slice(max(s.start - margin, 0), min(s.stop + margin, n))
+            for s, n in zip(window, geobox.shape, strict=True)
         )
+        data, window_stats = _compute_median(items, geobox[padded], config, profile)
+        inner = tuple(
+            slice(s.start - p.start, s.stop - p.start)
+            for s, p in zip(window, padded, strict=True)
+        )
+        out[window] = data[inner]
+        if stats is None:
+            stats = window_stats
+        else:
+            # every window reads the same scenes
+            stats.scenes_read = max(stats.scenes_read, window_stats.scenes_read)
+            stats.rgb_blocks_read += window_stats.rgb_blocks_read
+            stats.rgb_blocks_total += window_stats.rgb_blocks_total
+    return out, stats
 
-        # not writing with xarray, so have to reverse engineer the time index
-        time_index = (
-            12 * (self.year - self.config.start_date.year)
-            + (self.month - self.config.start_date.month)
-        ) // self.config.time_frequency_months
 
-        # all elements of the selector need to be slices
-        # https://github.com/zarr-developers/zarr-python/issues/1730
-        target_slice = (slice(time_index, time_index + 1),) + xy_slice
+def _write_chunk(
+    target_array: zarr.Array,
+    raw_data: np.ndarray,
+    time_index: int,
+    tile_index: tuple[int, int],
+    chunk_shape: tuple[int, int],
+) -> None:
+    xy_slice = tuple(
+        slice(cs * ci, cs * ci + n)
+        for cs, ci, n in zip(chunk_shape, tile_index, raw_data.shape[:2], strict=True)
+    )
+
+    # all elements of the selector need to be slices
+    # https://github.com/zarr-developers/zarr-python/issues/1730
+    target_slice = (slice(time_index, time_index + 1),) + xy_slice
+
+    # need to expand out the time dimension
+    target_array[target_slice] = raw_data[None, ...]
 
-        # need to expand out the time dimension
-        target_array[target_slice] = raw_data[None, ...]
 
-        tic4 = perf_counter()
+def _add_overview(
+    overviews: Pyramid | None,
+    config: JobConfig,
+    tile_index: tuple[int, int],
+    year: int,
+    month: int,
+    raw_data: np.ndarray | None = None,
+) -> dict:
+    """Add the chunk to the overviews; returns its result fields."""
+    if overviews is None:
+        return {}
+    tic = perf_counter()
+    written = overviews.add(config.time_index(year, month), tile_index, raw_data)
+    return dict(overview_chunks=written, overview_duration=perf_counter() - tic)
+
+
+def _process_period(
+    config: JobConfig,
+    target_array: zarr.Array,
+    tile_index: tuple[int, int],
+    year: int,
+    month: int,
+    items,
+    start_time: float,
+    search_duration: float,
+    search_stats: SearchStats,
+    cold_start: bool = False,
+    setup_duration: float = 0.0,
+    overviews: Pyramid | None = None,
+) -> ChunkProcessingResult:
+    """Compute and write a single chunk from the items found for its period."""
+    profile = Profile()
+    profile.add("search", search_duration)
+    profile.add_search_pages(search_stats.pages)
+
+    geobox = config.tiles[tile_index]
+    with profile.stage("metadata"):
+        items, prune_stats = prune_items(
+            items,
+            geobox.geographic_extent,
+            tile_pixels=geobox.shape[0] * geobox.shape[1],
+            num_bands=len(config.bands) + 1,
+            max_cloud_cover=config.max_cloud_cover,
+            max_nodata=config.max_nodata,
+            min_overlap=config.min_scene_overlap,
+            max_scenes=config.max_scenes,
+            dedupe=config.dedupe_scenes,
+        )
+
+    common = dict(
+        tile_y=tile_index[0],
+        tile_x=tile_index[1],
+        year=year,
+        month=month,
+        start_time=start_time,
+        search_duration=search_duration,
+        region=os.environ.get("MODAL_REGION", None),
+        cloud_provider=os.environ.get("MODAL_CLOUD_PROVIDER", None),
+        search_cache_hits=search_stats.hits,
+        search_cache_misses=search_stats.misses,
+        num_pruned=prune_stats.num_pruned,
+        pruned_bytes_estimate=prune_stats.bytes_avoided,
+        cold_start=cold_start,
+        setup_duration=setup_duration,
+        worker_cpus=detect_resources().cpus,
+        worker_memory_bytes=detect_resources().memory_bytes,
+    )
 
+    if len(items) == 0:
+        # the parents still need to know this chunk is empty
+        overview_stats = _add_overview(overviews, config, tile_index, year, month)
+        profile.finish()
         return ChunkProcessingResult(
-            success=True,
-            num_scenes=len(items),
+            success=False,
+            num_scenes=0,
+            load_duration=0,
+            write_duration=0,
+            **common,
+            **overview_stats,
+            **profile.columns(),
+        )
+
+    plan = config.memory_plan(geobox.shape, len(items), detect_resources())
+    tic1 = perf_counter()
+    if plan.splits > 1:
+        raw_data, load_stats = _compute_in_windows(
+            items, geobox, config, profile, plan.splits
+        )
+    else:
+        raw_data, load_stats = _compute_median(items, geobox, config, profile)
+    tic2 = perf_counter()
+    chunk_bytes = math.prod(target_array.chunks) * target_array.dtype.itemsize
+    threads = compression_threads(chunk_bytes, detect_resources().cpus)
+    _write_chunk(
+        threaded_array(timed_array(target_array, profile), threads),
+        raw_data,
+        config.time_index(year, month),
+        tile_index,
+        config.chunk_shape,
+    )
+    tic3 = perf_counter()
+    # whatever part of the write wasn't the upload itself
+    profile.add("encode", (tic3 - tic2) - profile.seconds["upload"])
+    overview_stats = _add_overview(overviews, config, tile_index, year, month, raw_data)
+    profile.finish()
+
+    return ChunkProcessingResult(
+        success=True,
+        num_scenes=len(items),
+        num_scenes_read=load_stats.scenes_read,
+        rgb_blocks_read=load_stats.rgb_blocks_read,
+        rgb_blocks_total=load_stats.rgb_blocks_total,
+        load_duration=tic2 - tic1,
+        write_duration=tic3 - tic2,
+        load_block_size=load_stats.settings.block_size,
+        compute_threads=load_stats.settings.threads,
+        tuning_source=load_stats.settings.source,
+        compression_threads=threads,
+        memory_estimate_bytes=plan.estimate_bytes,
+        scratch_estimate_bytes=plan.scratch_bytes,
+        sub_windows=plan.splits**2,
+        **common,
+        **overview_stats,
+        **profile.columns(),
+    )
+
+
+@dataclass(frozen=True)
+class JobContext:
+    """
+    Everything the jobs of a run share. Sent to each worker once (see
+    ``pack_context``), rather than pickled along with every job.
+    """
+
+    config: JobConfig
+    target_array: zarr.Array
+    # set when the run builds overviews as it goes
+    overviews: Pyramid | None = None
+
+
+def pack_context(context: JobContext) -> tuple[str, bytes]:
+    """A content key for the context, and the context pickled."""
+    payload = pickle.dumps(context)
+    return hashlib.sha256(payload).hexdigest()[:16], payload
+
+
+@dataclass(frozen=True)
+class ChunkProcessingJob:
+    """A single (tile, time period) chunk."""
+
+    tile_index: tuple[int, int]
+    # position on the time axis of the cube
+    time_index: int
+
+    def process(
+        self,
+        context: JobContext,
+        debug: bool = False,
+    ) -> "ChunkProcessingResult":
+        start_time = time()
+        cold_start, setup_duration = init_worker(debug)
+
+        config = context.config
+        geobox = config.tiles[self.tile_index]
+        geom = geobox.geographic_extent
+
+        date = config.full_time_data[self.time_index]
+        start_date, end_date = config.period_dates(date.year, date.month)
+        search_stats = SearchStats()
+
+        tic1 = perf_counter()
+        items = config.search_backend().search(
+            geom, _date_query(start_date, end_date), stats=search_stats
+        )
+        tic2 = perf_counter()
+
+        return _process_period(
+            config,
+            context.target_array,
+            self.tile_index,
+            date.year,
+            date.month,
+            items,
             start_time=start_time,
             search_duration=tic2 - tic1,
-            load_duration=tic3 - tic2,
-            write_duration=tic4 - tic3,
-            region=os.environ.get("MODAL_REGION", None),
-            cloud_provider=os.environ.get("MODAL_CLOUD_PROVIDER", None),
+            search_stats=search_stats,
+            cold_start=cold_start,
+            setup_duration=setup_duration,
+            overviews=context.overviews,
         )
 
 
-def optimize_coord_encoding(values, dx):
-    dx_all = np.diff(values)
-    # dx = dx_all[0]
-    np.testing.assert_allclose(dx_all, dx), "must be regularly spaced"
+@dataclass(frozen=True)
+class TileProcessingJob:
+    """
+    All the time periods for a single tile.
 
-    offset_codec = zarr.FixedScaleOffset(
-        offset=values[0], scale=1 / dx, dtype=values.dtype, astype="i8"
-    )
-    delta_codec = zarr.Delta("i8", "i2")
-    compressor = zarr.Blosc(cname="zstd")
+    The tile is searched once for the whole time range and the items are split
+    up by period in memory, so search and worker setup are paid once per tile
+    rather than once per chunk.
+    """
 
-    enc0 = offset_codec.encode(values)
-    # everything should be offset by 1 at this point
-    np.testing.assert_equal(np.unique(np.diff(enc0)), [1])
-    enc1 = delta_codec.encode(enc0)
-    # now we should be able to compress the shit out of this
-    enc2 = compressor.encode(enc1)
-    decoded = offset_codec.decode(delta_codec.decode(compressor.decode(enc2)))
+    tile_index: tuple[int, int]
+    time_indexes: tuple[int, ...]
 
-    # will produce numerical precision differences
-    # np.testing.assert_equal(values, decoded)
-    np.testing.assert_allclose(values, decoded)
+    def process(
+        self,
+        context: JobContext,
+        debug: bool = False,
+    ) -> list[ChunkProcessingResult]:
+        cold_start, setup_duration = init_worker(debug)
+
+        config = context.config
+        geobox = config.tiles[self.tile_index]
+        geom = geobox.geographic_extent
+
+        dates = [config.full_time_data[t] for t in self.time_indexes]
+        period_dates = [config.period_dates(d.year, d.month) for d in dates]
+        search_stats = SearchStats()
+
+        tic1 = perf_counter()
+        all_items = config.search_backend().search(
+            geom,
+            _date_query(period_dates[0][0], period_dates[-1][1]),
+            stats=search_stats,
+        )
+        tic2 = perf_counter()
+        # spread the cost of the single search over all the outputs
+        search_duration = (tic2 - tic1) / len(dates)
+
+        results = []
+        for date, (start_date, end_date) in zip(dates, period_dates, strict=True):
+            items = [
+                item
+                for item in all_items
+                if start_date.date() <= item.datetime.date() <= end_date.date()
+            ]
+            results.append(
+                _process_period(
+                    config,
+                    context.target_array,
+                    self.tile_index,
+                    date.year,
+                    date.month,
+                    items,
+                    start_time=time(),
+                    search_duration=search_duration,
+                    # only the first period pays for setup and the search
+                    search_stats=SearchStats() if results else search_stats,
+                    cold_start=cold_start and not results,
+                    setup_duration=0.0 if results else setup_duration,
+                    overviews=context.overviews,
+                )
+            )
+
+        return results
 
-    return {"compressor": compressor, "filters": (offset_codec, delta_codec)}
 
+def read_time_axis(storage) -> pd.DatetimeIndex:
+    """The time coordinate of an existing cube."""
+    ds = xr.open_zarr(
+        storage.get_zarr_store(),
+        zarr_version=storage.zarr_version,
+        consolidated=False,
+    )
+    return ds.indexes["time"]
+
+
+def flatten_results(
+    results: Iterable[ChunkProcessingResult | list[ChunkProcessingResult] | None],
+) -> Generator[ChunkProcessingResult | None, None, None]:
+    """Tile-major jobs return a list of results; unpack them as they arrive."""
+    for r in results:
+        if isinstance(r, list):
+            yield from r
+        else:
+            yield r
 
-def save_output_log(results: list[ChunkProcessingResult], fname: str) -> None:
+
+def save_output_log(
+    results: list[ChunkProcessingResult],
+    fname: str,
+    tile_info: pd.DataFrame | None = None,
+    grid: str | None = None,
+) -> None:
+    """
+    Write the results as Parquet. Extra per-tile columns (with ``tile_y`` and
+    ``tile_x``) can be joined on from ``tile_info``, and ``grid`` (see
+    ``JobConfig.grid``) says which tiles ``tile_y`` and ``tile_x`` refer to.
+    """
     fields = (
+        "tile_y",
+        "tile_x",
+        "year",
+        "month",
         "success",
         "num_scenes",
         "start_time",
@@ -313,10 +994,76 @@ def save_output_log(results: list[ChunkProcessingResult], fname: str) -> None:
         "write_duration",
         "region",
         "cloud_provider",
+        "search_cache_hits",
+        "search_cache_misses",
+        "num_pruned",
+        "pruned_bytes_estimate",
+        "num_scenes_read",
+        "rgb_blocks_read",
+        "rgb_blocks_total",
+        "cold_start",
+        "setup_duration",
+        "search_seconds",
+        "metadata_seconds",
+        "read_seconds",
+        "mask_seconds",
+        "reduce_seconds",
+        "encode_seconds",
+        "upload_seconds",
+        "search_pages",
+        "bytes_read",
+        "bytes_written",
+        "http_requests",
+        "peak_rss_bytes",
+        "cpu_seconds",
+        "load_block_size",
+        "compute_threads",
+        "tuning_source",
+        "worker_cpus",
+        "worker_memory_bytes",
+        "overview_chunks",
+        "overview_duration",
+        "compression_threads",
+        "memory_estimate_bytes",
+        "scratch_estimate_bytes",
+        "sub_windows",
     )
 
     df = pd.DataFrame(
         [[getattr(r, f) for f in fields] for r in results if r is not None],
         columns=fields,
     )
-    df.to_csv(fname, index=False)
+    if tile_info is not None:
+        df = df.merge(tile_info, on=["tile_y", "tile_x"], how="left")
+    if grid is not None:
+        df["grid"] = grid
+    df.to_parquet(fname, index=False)
+
+
+def read_output_log(fname: str) -> pd.DataFrame:
+    """A run log written by ``save_output_log``; older runs wrote CSV."""
+    if fname.endswith(".csv"):
+        return pd.read_csv(fname)
+    return pd.read_parquet(fname)
+
+
+def start_latency_summary(results: list[ChunkProcessingResult]) -> pd.DataFrame:
+    """
+    Per-chunk latency (setup + search + load + write) of jobs that ran on a
+    fresh worker vs. a warm one, which can differ a lot on serverless backends.
+    """
+    df = pd.DataFrame(
+        [
+            {
+                "start": "cold" if r.cold_start else "warm",
+                "latency": r.setup_duration
+                + r.search_duration
+                + r.load_duration
+                + r.write_duration,
+            }
+            for r in results
+            if r is not None
+        ],
+        columns=["start", "latency"],
+    )
+    return df.groupby("start").latency.describe(percentiles=[0.5, 0.9])
@@ -1,27 +1,103 @@
+import pickle
+from collections.abc import Container, Generator
+
 import lithops
-import zarr
-from lib import ChunkProcessingJob, ChunkProcessingResult
+from lithops.storage.utils import CloudObject
+from lithops.wait import ANY_COMPLETED
+
+from bundling import JobBundle
+from lib import (
+    ChunkProcessingJob,
+    ChunkProcessingResult,
+    JobContext,
+    TileProcessingJob,
+    flatten_results,
+    pack_context,
+)
+from runtime import cached_context
+from speculation import LatencyTracker, run_speculatively
+from tuning import Resources
+
+# Lambda gets a vCPU per 1769 MB of memory; heavy jobs go to the largest size
+WORKER_MEMORY_MB = 16 * 256
+LARGE_WORKER_MEMORY_MB = 10240
+# Lambda's /tmp, unless raised with ephemeral_storage in .lithops_config
+WORKER_SCRATCH_MB = 512
+WORKER = Resources(
+    cpus=2,
+    memory_bytes=WORKER_MEMORY_MB * 2**20,
+    scratch_bytes=WORKER_SCRATCH_MB * 2**20,
+)
+LARGE_WORKER = Resources(
+    cpus=6,
+    memory_bytes=LARGE_WORKER_MEMORY_MB * 2**20,
+    scratch_bytes=WORKER_SCRATCH_MB * 2**20,
+)
 
 
 def process_chunk(
-    job: ChunkProcessingJob, array: zarr.Array, debug: bool
-) -> ChunkProcessingResult:
-    return job.process(array, debug=debug)
+    job: ChunkProcessingJob | TileProcessingJob | JobBundle,
+    context_key: str,
+    context_object: CloudObject,
+    debug: bool,
+    storage,
+) -> ChunkProcessingResult | list[ChunkProcessingResult]:
+    # lithops passes in its storage client because of the argument name
+    context = cached_context(
+        context_key, lambda: pickle.loads(storage.get_cloudobject(context_object))
+    )
+    return job.process(context, debug=debug)
 
 
 def spawn_lithops_jobs(
-    jobs: list[ChunkProcessingJob], array: zarr.Array, debug: bool
-) -> list[ChunkProcessingResult | None]:
+    jobs: list[ChunkProcessingJob | TileProcessingJob | JobBundle],
+    context: JobContext,
+    debug: bool,
+    tracker: LatencyTracker | None = None,
+    max_inflight: int = 1000,
+    large_jobs: Container = frozenset(),
+) -> Generator[ChunkProcessingResult | None, None, None]:
     base_fexec = lithops.FunctionExecutor(
-        runtime="serverless-datacube", runtime_memory=16 * 256
+        runtime="serverless-datacube", runtime_memory=WORKER_MEMORY_MB
     )
     retry_fexec = lithops.RetryingFunctionExecutor(base_fexec)
+    # upload the context once; each job only carries a reference to it
+    context_key, payload = pack_context(context)
+    context_object = base_fexec.storage.put_cloudobject(payload)
+    args = (context_key, context_object, debug)
+
+    def size(job) -> dict:
+        # jobs predicted to need more memory than the default get the most
+        return {"runtime_memory": LARGE_WORKER_MEMORY_MB} if job in large_jobs else {}
+
+    if tracker is not None:
+        # plain futures; run_speculatively takes care of retries
+        yield from run_speculatively(
+            jobs,
+            submit=lambda job: base_fexec.call_async(
+                process_chunk, (job, *args), **size(job)
+            ),
+            wait=lambda fs, timeout: base_fexec.wait(
+                fs,
+                throw_except=False,
+                return_when=ANY_COMPLETED,
+                timeout=timeout,
+                show_progressbar=False,
+            )[0],
+            result=lambda f: f.result(throw_except=True),
+            tracker=tracker,
+            max_inflight=max_inflight,
+        )
+        return
+
     futures = [
         lithops.retries.RetryingFuture(
-            base_fexec.call_async(process_chunk, (job, array, debug)),
+            base_fexec.call_async(process_chunk, (job, *args), **size(job)),
             process_chunk,
-            (job, array, debug),
+            (job, *args),
             retries=5,
+            # retries go to the same size
+            **size(job),
         )
         for job in jobs
     ]
@@ -29,10 +105,15 @@ def spawn_lithops_jobs(
     # use longer wait period for large number of futures
     wait_dur_sec = 10 if len(futures) > 3000 else 1
 
-    retrying_done, retrying_pending = retry_fexec.wait(
-        futures, throw_except=False, wait_dur_sec=wait_dur_sec
-    )
-    assert len(retrying_pending) == 0
-
-    result = [r.response_future.result(throw_except=False) for r in retrying_done]
-    return result
+    # hand back results as they finish rather than waiting for all of them
+    pending = futures
+    while pending:
+        retrying_done, pending = retry_fexec.wait(
+            pending,
+            throw_except=False,
+            return_when=ANY_COMPLETED,
+            wait_dur_sec=wait_dur_sec,
+        )
+        yield from flatten_results(
+            r.response_future.result(throw_except=False) for r in retrying_done
+        )
@@ -0,0 +1,150 @@
+import logging
+import multiprocessing
+import os
+from collections import deque
+from collections.abc import Generator, Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from bundling import JobBundle
+from lib import (
+    COMPUTE_THREADS_ENV,
+    ChunkProcessingJob,
+    ChunkProcessingResult,
+    JobContext,
+    TileProcessingJob,
+)
+from speculation import LatencyTracker, run_speculatively
+from tuning import WORKERS_PER_MACHINE_ENV
+
+logger = logging.getLogger(__name__)
+
+# set once per worker process by the pool initializer,
+# so the context doesn't have to be pickled along with every job
+_context: JobContext | None = None
+_debug: bool = False
+
+
+def _init_worker(
+    context: JobContext,
+    debug: bool,
+    threads_per_worker: int | None,
+    num_workers: int,
+) -> None:
+    global _context, _debug
+    _context = context
+    _debug = debug
+    # the workers share the machine, so each tunes for its share of it
+    os.environ[WORKERS_PER_MACHINE_ENV] = str(num_workers)
+    if threads_per_worker is not None:
+        os.environ[COMPUTE_THREADS_ENV] = str(threads_per_worker)
+
+
+def process_chunk(
+    job: ChunkProcessingJob | TileProcessingJob | JobBundle,
+) -> ChunkProcessingResult | list[ChunkProcessingResult]:
+    return job.process(_context, debug=_debug)
+
+
+def spawn_local_jobs(
+    jobs: Iterable[ChunkProcessingJob | TileProcessingJob | JobBundle],
+    context: JobContext,
+    debug: bool,
+    max_workers: int | None = None,
+    threads_per_worker: int | None = None,
+    retries: int = 5,
+    tracker: LatencyTracker | None = None,
+) -> Generator[ChunkProcessingResult | None, None, None]:
+    """
+    Run jobs on a local process pool, yielding results as they complete.
+
+    Failed jobs are resubmitted up to ``retries`` times; a job that still fails
+    yields ``None``, like the Lithops backend. With a ``tracker``, stragglers
+    are run again speculatively.
+    """
+    # fork doesn't mix well with the threads GDAL and dask start up
+    ctx = multiprocessing.get_context("spawn")
+    num_workers = max_workers or os.cpu_count()
+    initargs = (context, debug, threads_per_worker, num_workers)
+
+    def new_executor() -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=initargs,
+        )
+
+    executor = new_executor()
+
+    def submit(job: ChunkProcessingJob | TileProcessingJob | JobBundle) -> Future:
+        nonlocal executor
+        try:
+            return executor.submit(process_chunk, job)
+        except BrokenProcessPool:
+            # a worker died (killed for running out of memory, a crash in
+            # GDAL), taking the pool with it: start a new one. The jobs that
+            # were running on the old one come back failed, and are retried
+            # like any other failure.
+            logger.warning("Worker pool broke; restarting it")
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = new_executor()
+            return executor.submit(process_chunk, job)
+
+    if tracker is not None:
+        try:
+            yield from run_speculatively(
+                jobs,
+                submit=submit,
+                wait=lambda fs, timeout: (
+                    wait(fs, timeout=timeout, return_when=FIRST_COMPLETED).done
+                ),
+                result=lambda f: f.result(),
+                tracker=tracker,
+                # one job per worker, so duplicates don't queue behind the rest
+                max_inflight=num_workers,
+                retries=retries,
+            )
+        finally:
+            # don't block on the losing copies of duplicated jobs
+            executor.shutdown(wait=False, cancel_futures=True)
+        return
+
+    # (job, attempt) waiting to be submitted
+    queue = deque((job, 0) for job in jobs)
+    pending: dict[
+        Future, tuple[ChunkProcessingJob | TileProcessingJob | JobBundle, int]
+    ] = {}
+    try:
+        while queue or pending:
+            # one job per worker, so that when the pool breaks the only jobs
+            # that fail with it, and use up a retry, are the ones running
+            while queue and len(pending) < num_workers:
+                job, attempt = queue.popleft()
+                pending[submit(job)] = (job, attempt)
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, attempt = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    if attempt < retries:
+                        logger.warning(
+                            "Retrying job for tile %s", job.tile_index, exc_info=True
+                        )
+                        queue.append((job, attempt + 1))
+                        continue
+                    logger.exception(
+                        "Job for tile %s failed after %d retries",
+                        job.tile_index,
+                        retries,
+                    )
+                    result = None
+
+                if isinstance(result, list):
+                    yield from result
+                else:
+                    yield result
+    finally:
+        executor.shutdown()
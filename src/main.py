@@ -1,12 +1,96 @@
+from dataclasses import replace
 from datetime import datetime
+from functools import partial
 
 import click
+import shapely
 import zarr
+
+from bundling import (
+    BUNDLE_RETRIES,
+    DEFAULT_TARGET_SECONDS,
+    JobFailure,
+    RuntimeModel,
+    bundle_jobs,
+    retry_bundles,
+)
+from coiled_app import WORKER as COILED_WORKER
 from coiled_app import spawn_coiled_jobs
-from lib import JobConfig, save_output_log
+from encoding import Encoding
+from lib import (
+    JobConfig,
+    JobContext,
+    read_time_axis,
+    save_output_log,
+    start_latency_summary,
+)
+from lithops_app import WORKER as LITHOPS_WORKER
 from lithops_app import spawn_lithops_jobs
+from local_app import spawn_local_jobs
 from modal_app import spawn_modal_jobs
+from pyramid import Pyramid
+from runlog import RunManifest
+from scheduling import (
+    footprint_scenes,
+    heavy_tiles,
+    order_jobs,
+    predict_scenes,
+    predictions_table,
+    with_predictions,
+)
+from speculation import LatencyTracker
 from storage import ArraylakeStorage, ZarrFSSpecStorage
+from tuning import TUNING_MODES
+
+
+def load_aoi(path: str) -> shapely.Geometry:
+    with open(path) as f:
+        return shapely.from_geojson(f.read())
+
+
+# default worker size of the backends that have a larger one to route to
+WORKER_SIZES = {"lithops": LITHOPS_WORKER, "coiled": COILED_WORKER}
+
+
+def stored_time_origin(storage) -> datetime | None:
+    """The first time step of the cube in ``storage``, None if there's no cube."""
+    try:
+        time_axis = read_time_axis(storage)
+    except FileNotFoundError:
+        return None
+    return time_axis[0].to_pydatetime()
+
+
+def prepare_append(job_config: JobConfig, storage, rerun: bool = False) -> JobConfig:
+    """
+    Point job_config at the periods after the end of the existing cube
+    and extend the cube's time axis to make room for them.
+
+    With ``rerun`` (resuming an append that was cut short, say), periods
+    already on the axis are fine: they're processed where they are.
+    """
+    time_axis = read_time_axis(storage)
+    job_config = replace(job_config, time_origin=time_axis[0].to_pydatetime())
+    existing = {(t.year, t.month) for t in time_axis}
+    new_dates = [t for t in job_config.time_data if (t.year, t.month) not in existing]
+    if not new_dates:
+        if rerun:
+            return job_config
+        raise click.UsageError("No new time periods to append")
+
+    job_config = replace(job_config, start_date=new_dates[0].to_pydatetime())
+    # the new periods have to continue the existing axis with no gaps
+    first_index = job_config.time_index(new_dates[0].year, new_dates[0].month)
+    same_axis = job_config.full_time_data[: len(time_axis)].equals(time_axis)
+    if first_index != len(time_axis) or not same_axis:
+        raise click.UsageError(
+            f"Appended periods must start right after {time_axis[-1]:%Y-%m} "
+            "and use the same --time-frequency-months"
+        )
+
+    click.echo(f"Appending {len(new_dates)} time periods to the existing cube")
+    job_config.extend_time_axis(storage)
+    return job_config
 
 
 @click.command()
@@ -29,6 +113,12 @@ from storage import ArraylakeStorage, ZarrFSSpecStorage
     help="Bounding box for the data cube in lat/lon. "
     "(min_lon, min_lat, max_lon, max_lat)",
 )
+@click.option(
+    "--aoi",
+    type=click.Path(exists=True, dir_okay=False),
+    help="GeoJSON file with an area of interest in lat/lon. "
+    "Tiles that don't intersect it are skipped.",
+)
 @click.option(
     "--time-frequency-months",
     default=1,
@@ -62,6 +152,128 @@ from storage import ArraylakeStorage, ZarrFSSpecStorage
     show_default=True,
     help="The name of the variable to use in the Zarr data cube.",
 )
+@click.option(
+    "--reducer",
+    type=click.Choice(["dask", "streaming"]),
+    default="dask",
+    show_default=True,
+    help="How to compute the median. 'streaming' uses an exact histogram-based "
+    "median that holds only a few scenes in memory at a time, and spills them "
+    "all to local disk ($DATACUBE_SCRATCH_DIR, or the temp dir).",
+)
+@click.option(
+    "--scl-classes",
+    multiple=True,
+    type=int,
+    default=[4, 5],
+    show_default=True,
+    help="Sentinel-2 scene classification (SCL) classes to keep; "
+    "everything else is masked as cloud.",
+)
+@click.option(
+    "--mask-closing-radius",
+    type=int,
+    default=5,
+    show_default=True,
+    help="Radius in pixels of the morphological closing of the cloud mask.",
+)
+@click.option(
+    "--mask-opening-radius",
+    type=int,
+    default=5,
+    show_default=True,
+    help="Radius in pixels of the morphological opening of the cloud mask.",
+)
+@click.option(
+    "--max-cloud-cover",
+    type=click.FloatRange(0, 100),
+    help="Skip scenes with a higher eo:cloud_cover percentage.",
+)
+@click.option(
+    "--max-nodata",
+    type=click.FloatRange(0, 100),
+    help="Skip scenes with a higher s2:nodata_pixel_percentage.",
+)
+@click.option(
+    "--min-scene-overlap",
+    type=click.FloatRange(0, 1),
+    default=0.0,
+    show_default=True,
+    help="Skip scenes whose footprint covers less than this fraction of the tile.",
+)
+@click.option(
+    "--max-scenes",
+    type=int,
+    help="Use at most this many scenes per chunk, best first.",
+)
+@click.option(
+    "--dedupe-scenes/--no-dedupe-scenes",
+    default=False,
+    show_default=True,
+    help="Only use the latest processing baseline of each acquisition.",
+)
+@click.option(
+    "--adaptive-min-clear",
+    type=click.IntRange(1),
+    help="Read scenes in batches, best first, and stop once enough pixels "
+    "have this many clear observations.",
+)
+@click.option(
+    "--adaptive-target-fraction",
+    type=click.FloatRange(0, 1),
+    default=0.95,
+    show_default=True,
+    help="Fraction of pixels that need --adaptive-min-clear clear observations.",
+)
+@click.option(
+    "--adaptive-batch-size",
+    type=click.IntRange(1),
+    default=8,
+    show_default=True,
+    help="Number of scenes read per batch in adaptive mode.",
+)
+@click.option(
+    "--two-phase-load",
+    is_flag=True,
+    default=False,
+    help="Load the SCL band first (nearest resampling) and only fetch the RGB "
+    "blocks of each scene that have usable pixels.",
+)
+@click.option(
+    "--tuning",
+    type=click.Choice(TUNING_MODES),
+    default="auto",
+    show_default=True,
+    help="How to pick the dask block size and compute threads. 'auto' sizes "
+    "them for the tile and the worker's CPUs and memory; 'fixed' uses 600 "
+    "pixel blocks and 16 threads. The chosen values are in the run log.",
+)
+@click.option(
+    "--load-block-size",
+    type=int,
+    help="Dask block size in pixels, instead of the tuned one.",
+)
+@click.option(
+    "--compute-threads",
+    type=int,
+    help="Threads to load and compute each chunk with, instead of the tuned number.",
+)
+@click.option(
+    "--overview-levels",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="Levels of 2x downsampled overviews to build as chunks are written. "
+    "Needs an even chunk size.",
+)
+@click.option(
+    "--encoding",
+    "encoding_file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON encoding of the data array, as saved by "
+    "benchmarks/codec_tuning.py. Defaults to Blosc zstd level 5 with byte "
+    "shuffle, bands interleaved.",
+)
 @click.option(
     "--epsg",
     type=click.Choice(["4326"]),
@@ -72,7 +284,19 @@ from storage import ArraylakeStorage, ZarrFSSpecStorage
 @click.option(
     "--serverless-backend",
     required=True,
-    type=click.Choice(["coiled", "modal", "lithops"]),
+    type=click.Choice(["coiled", "modal", "lithops", "local"]),
+)
+@click.option(
+    "--local-workers",
+    type=int,
+    help="Number of worker processes for the local backend. "
+    "Defaults to the number of CPUs.",
+)
+@click.option(
+    "--local-threads",
+    type=int,
+    help="Threads per worker process for the local backend. Defaults to "
+    "tuning them like on any other worker.",
 )
 @click.option(
     "--storage-backend",
@@ -86,17 +310,135 @@ from storage import ArraylakeStorage, ZarrFSSpecStorage
     help="Name of the Arraylake repo to use for storage.",
 )
 @click.option("--fsspec-uri")
+@click.option(
+    "--stac-catalog",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Search a static STAC catalog on disk instead of Earth Search.",
+)
+@click.option(
+    "--search-cache",
+    help="Local directory or fsspec uri for caching STAC search results.",
+)
+@click.option(
+    "--search-cache-ttl",
+    type=float,
+    help="Maximum age of cached search results in seconds.",
+)
 @click.option(
     "--limit",
     type=int,
     help="Limit the number of chunks to process.",
 )
+@click.option(
+    "--tile-major",
+    is_flag=True,
+    default=False,
+    help="Process all time periods of a tile in a single job, "
+    "with one STAC search per tile.",
+)
+@click.option(
+    "--bundle-seconds",
+    type=float,
+    help="Pack jobs into invocations expected to run for about this many "
+    "seconds. 0 disables bundling. Defaults to a per-backend target.",
+)
+@click.option(
+    "--bundle-concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of jobs to run at the same time within a bundle.",
+)
+@click.option(
+    "--prior-logs",
+    default="logs/*.parquet",
+    show_default=True,
+    help="Glob of previous run logs to estimate job runtimes from; only runs "
+    "of the same grid (CRS, bounds, dx and chunk size) are used.",
+)
+@click.option(
+    "--longest-first",
+    is_flag=True,
+    default=False,
+    help="Dispatch the jobs expected to take longest first.",
+)
+@click.option(
+    "--predict-from-stac",
+    is_flag=True,
+    default=False,
+    help="Estimate scenes per tile for --longest-first and --large-workers from a "
+    "STAC search over the whole cube, for tiles that aren't in the prior logs.",
+)
+@click.option(
+    "--large-workers/--no-large-workers",
+    default=True,
+    show_default=True,
+    help="Send the jobs predicted not to fit in a worker's memory to larger "
+    "workers (Lithops and Coiled). Otherwise, and on the other backends, "
+    "workers compute such chunks in sub-windows.",
+)
+@click.option(
+    "--speculate",
+    is_flag=True,
+    default=False,
+    help="Launch a duplicate of jobs that run much longer than the others, "
+    "and take whichever copy finishes first.",
+)
+@click.option(
+    "--straggler-percentile",
+    type=click.FloatRange(0, 100),
+    default=95.0,
+    show_default=True,
+    help="Percentile of finished job durations to compare running jobs to.",
+)
+@click.option(
+    "--straggler-multiple",
+    type=click.FloatRange(min=1),
+    default=2.0,
+    show_default=True,
+    help="A job running longer than this multiple of the percentile is duplicated.",
+)
+@click.option(
+    "--max-inflight",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Maximum number of jobs running at once with --speculate "
+    "(the local backend uses one per worker).",
+)
 @click.option(
     "--debug",
     is_flag=True,
     default=False,
     help="Enable debug logging.",
 )
+@click.option(
+    "--run-manifest",
+    type=click.Path(dir_okay=False),
+    help="File to record each finished chunk in as the run progresses. "
+    "Defaults to a new file in logs/.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Only process chunks not already recorded as done in --run-manifest. "
+    "Implies --no-initialize.",
+)
+@click.option(
+    "--skip-existing",
+    is_flag=True,
+    default=False,
+    help="Only process chunks that are missing from the target array. "
+    "Implies --no-initialize.",
+)
+@click.option(
+    "--append",
+    is_flag=True,
+    default=False,
+    help="Extend the time axis of an existing cube and only process the new "
+    "time periods. Implies --no-initialize.",
+)
 @click.option(
     "--initialize/--no-initialize",
     is_flag=True,
@@ -107,20 +449,64 @@ def main(
     start_date: datetime,
     end_date: datetime,
     bbox: tuple[float, float, float, float],
+    aoi: str | None,
     time_frequency_months: int,
     resolution: float,
     chunk_size: int,
     bands: list[str],
     varname: str,
+    reducer: str,
+    scl_classes: list[int],
+    mask_closing_radius: int,
+    mask_opening_radius: int,
+    max_cloud_cover: float | None,
+    max_nodata: float | None,
+    min_scene_overlap: float,
+    max_scenes: int | None,
+    dedupe_scenes: bool,
+    adaptive_min_clear: int | None,
+    adaptive_target_fraction: float,
+    adaptive_batch_size: int,
+    two_phase_load: bool,
+    tuning: str,
+    load_block_size: int | None,
+    compute_threads: int | None,
+    overview_levels: int,
+    encoding_file: str | None,
     epsg: str,
     serverless_backend: str,
+    local_workers: int | None,
+    local_threads: int | None,
     storage_backend: str,
     arraylake_repo_name: str | None,
     fsspec_uri: str | None,
+    stac_catalog: str | None,
+    search_cache: str | None,
+    search_cache_ttl: float | None,
     limit: int | None,
+    tile_major: bool,
+    bundle_seconds: float | None,
+    bundle_concurrency: int,
+    prior_logs: str,
+    longest_first: bool,
+    predict_from_stac: bool,
+    large_workers: bool,
+    speculate: bool,
+    straggler_percentile: float,
+    straggler_multiple: float,
+    max_inflight: int,
+    run_manifest: str | None,
+    resume: bool,
+    skip_existing: bool,
+    append: bool,
     initialize: bool,
     debug: bool,
 ):
+    if overview_levels and chunk_size % 2:
+        raise click.BadParameter(
+            "must be even to build overviews", param_hint="--chunk-size"
+        )
+
     job_config = JobConfig(
         dx=resolution,
         epsg=int(epsg),
@@ -131,6 +517,28 @@ def main(
         bands=bands,
         varname=varname,
         chunk_size=chunk_size,
+        aoi=load_aoi(aoi) if aoi else None,
+        stac_catalog=stac_catalog,
+        search_cache_uri=search_cache,
+        search_cache_ttl=search_cache_ttl,
+        reducer=reducer,
+        scl_valid_classes=tuple(scl_classes),
+        mask_closing_radius=mask_closing_radius,
+        mask_opening_radius=mask_opening_radius,
+        max_cloud_cover=max_cloud_cover,
+        max_nodata=max_nodata,
+        min_scene_overlap=min_scene_overlap,
+        max_scenes=max_scenes,
+        dedupe_scenes=dedupe_scenes,
+        adaptive_min_clear=adaptive_min_clear,
+        adaptive_target_fraction=adaptive_target_fraction,
+        adaptive_batch_size=adaptive_batch_size,
+        two_phase_load=two_phase_load,
+        tuning=tuning,
+        load_block_size=load_block_size,
+        compute_threads=compute_threads,
+        overview_levels=overview_levels,
+        encoding=Encoding.load(encoding_file) if encoding_file else Encoding(),
     )
 
     if storage_backend == "arraylake":
@@ -138,15 +546,80 @@ def main(
     elif storage_backend == "fsspec":
         storage = ZarrFSSpecStorage(uri=fsspec_uri)
 
-    if initialize:
+    if append:
+        job_config = prepare_append(job_config, storage, rerun=resume or skip_existing)
+    elif resume or skip_existing or not initialize:
+        # the cube may start before --start-date (it was appended to, say), and
+        # chunks have to go where it has their periods
+        job_config = replace(job_config, time_origin=stored_time_origin(storage))
+
+    run_id = f"{int(datetime.now().timestamp())}-{serverless_backend}"
+    if resume:
+        if not run_manifest:
+            raise click.UsageError("--resume requires --run-manifest")
+        done = RunManifest.completed(run_manifest)
+        click.echo(f"Resuming; {len(done)} chunks already done")
+    else:
+        done = set()
+        run_manifest = run_manifest or f"logs/{run_id}-manifest.jsonl"
+
+    if skip_existing:
+        existing = job_config.populated_chunks(storage)
+        click.echo(f"Skipping {len(existing)} chunks already in the store")
+        done |= existing
+
+    if initialize and not (resume or skip_existing or append):
         job_config.create_dataset_schema(storage)
 
     with click.progressbar(
-        job_config.generate_jobs(limit=(limit or 0)),
-        label=f"Computing {job_config.num_tiles} tile intersections with land mask",
-        length=job_config.num_jobs,
+        job_config.generate_jobs(limit=(limit or 0), tile_major=tile_major, done=done),
+        label=f"Generating jobs for {job_config.num_tiles} tiles",
+        length=job_config.num_tiles if tile_major else job_config.num_jobs,
     ) as job_gen:
         jobs = list(job_gen)
+    num_jobs = len(jobs)
+    unbundled = jobs
+
+    model = RuntimeModel.from_log_glob(prior_logs, grid=job_config.grid)
+    tile_info = None
+    route_heavy = large_workers and serverless_backend in WORKER_SIZES
+    if longest_first or route_heavy:
+        footprints = None
+        if predict_from_stac:
+            footprints = footprint_scenes(job_config, job_config.search_backend())
+        predictions = predict_scenes(
+            job_config, {job.tile_index for job in jobs}, model, footprints
+        )
+    if longest_first:
+        model = with_predictions(model, predictions)
+        tile_info = predictions_table(predictions, model)
+        jobs = order_jobs(jobs, model)
+
+    heavy_jobs = []
+    heavy = set()
+    if route_heavy:
+        heavy = heavy_tiles(job_config, predictions, WORKER_SIZES[serverless_backend])
+        heavy_jobs = [job for job in jobs if job.tile_index in heavy]
+        jobs = [job for job in jobs if job.tile_index not in heavy]
+        if heavy_jobs:
+            click.echo(f"Sending {len(heavy_jobs)} heavy jobs to larger workers")
+
+    if bundle_seconds is None:
+        bundle_seconds = DEFAULT_TARGET_SECONDS[serverless_backend]
+    if bundle_seconds > 0:
+        # heavy jobs are bundled on their own, to keep the rest on small workers
+        heavy_jobs = bundle_jobs(
+            heavy_jobs, bundle_seconds, model=model, concurrency=bundle_concurrency
+        )
+        jobs = bundle_jobs(
+            jobs, bundle_seconds, model=model, concurrency=bundle_concurrency
+        )
+        click.echo(
+            f"Bundled {num_jobs} jobs into {len(jobs) + len(heavy_jobs)} invocations"
+        )
+    # heaviest first, as they take longest
+    large_jobs = set(heavy_jobs)
+    jobs = heavy_jobs + jobs
 
     if serverless_backend == "lithops":
         spawn = spawn_lithops_jobs
@@ -154,27 +627,109 @@ def main(
         spawn = spawn_coiled_jobs
     elif serverless_backend == "modal":
         spawn = spawn_modal_jobs
+    elif serverless_backend == "local":
+        spawn = partial(
+            spawn_local_jobs,
+            max_workers=local_workers,
+            threads_per_worker=local_threads,
+        )
     else:
         raise NotImplementedError
 
+    spawn_kwargs = {}
+    if speculate:
+        spawn_kwargs["tracker"] = LatencyTracker(
+            percentile=straggler_percentile, multiple=straggler_multiple
+        )
+        if serverless_backend != "local":
+            spawn_kwargs["max_inflight"] = max_inflight
+    if large_jobs:
+        spawn_kwargs["large_jobs"] = large_jobs
+
     target_array = zarr.open(storage.get_zarr_store(), path=job_config.varname)
+    overviews = None
+    if overview_levels:
+        # tiles done in an earlier run already added themselves
+        tiles = {job.tile_index for job in unbundled} | {key[:2] for key in done}
+        overviews = Pyramid(
+            storage.get_zarr_store(),
+            storage.zarr_version,
+            job_config.varname,
+            overview_levels,
+            job_config.chunk_shape,
+            tiles,
+        )
+    context = JobContext(
+        config=job_config, target_array=target_array, overviews=overviews
+    )
 
     # click.echo(f"Spawning {len(jobs)} jobs")
 
-    with click.progressbar(
-        jobs,
-        label=f"Spawning {len(jobs)} jobs",
-        length=len(jobs),
-    ) as jobs_progress:
+    with (
+        click.progressbar(
+            jobs,
+            label=f"Spawning {len(jobs)} jobs",
+            length=len(jobs),
+        ) as jobs_progress,
+        RunManifest(run_manifest) as manifest,
+    ):
         # all the work happens here
-        results = spawn(jobs_progress, target_array, debug=debug)
+        # results are recorded as they arrive so a crash doesn't lose them
+        results = []
+
+        def record(outputs) -> list[JobFailure]:
+            failures = []
+            for result in outputs:
+                if isinstance(result, JobFailure):
+                    failures.append(result)
+                    continue
+                if result is not None:
+                    manifest.append(result)
+                results.append(result)
+            return failures
+
+        failures = record(spawn(jobs_progress, context, debug=debug, **spawn_kwargs))
+
+        # bundles hand back the jobs that failed in them rather than failing
+        # as a whole, so the backend doesn't retry them
+        for _ in range(BUNDLE_RETRIES):
+            if not failures:
+                break
+            click.echo(f"Retrying {len(failures)} jobs that failed in bundles")
+            heavy_retries, retries = retry_bundles(
+                failures,
+                bundle_seconds,
+                model=model,
+                concurrency=bundle_concurrency,
+                heavy=heavy,
+            )
+            if heavy_retries:
+                spawn_kwargs["large_jobs"] = set(heavy_retries)
+            failures = record(
+                spawn(heavy_retries + retries, context, debug=debug, **spawn_kwargs)
+            )
+
+    num_failed = sum(r is None for r in results) + sum(f.num_chunks for f in failures)
+    if num_failed:
+        click.echo(
+            f"{num_failed} chunks failed; retry them with "
+            f"--run-manifest {run_manifest} --resume"
+        )
+
+    if overviews is not None:
+        # parents still waiting on chunks that failed
+        click.echo(f"Finished {overviews.finish(storage)} overview chunks")
 
     # commit changes only of successful
-    storage.commit(f"Processed {len(jobs)} chunks")
+    # tile-major jobs yield a result per chunk
+    num_chunks = sum(r is not None for r in results)
+    storage.commit(f"Processed {num_chunks} chunks")
 
     # save logs
-    log_fname = f"logs/{int(datetime.now().timestamp())}-{serverless_backend}.csv"
-    save_output_log(results, log_fname)
+    log_fname = f"logs/{run_id}.parquet"
+    save_output_log(results, log_fname, tile_info=tile_info, grid=job_config.grid)
+    click.echo("Chunk latency (s), cold vs. warm workers:")
+    click.echo(start_latency_summary(results).to_string())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+"""
+Cloud masking of Sentinel-2 scenes from the scene classification (SCL) band.
+
+The class lookup, morphological cleanup and band erasure are fused into a
+single kernel that runs once per (scene, spatial block), instead of a chain of
+whole-array xarray / dask operations each producing its own temporaries.
+
+Beyond the edges of the tile everything counts as clear, as it does in odc's
+``mask_cleanup``, so the opening erodes clouds touching the edge.
+"""
+
+import threading
+from functools import partial
+
+import dask.array
+import dask.base
+import numpy as np
+import xarray as xr
+from dask.highlevelgraph import HighLevelGraph
+from scipy import ndimage
+
+VEGETATION = 4
+NOT_VEGETATED = 5
+DEFAULT_VALID_CLASSES = (VEGETATION, NOT_VEGETATED)
+
+_buffers = threading.local()
+
+
+def _distance_buffer(shape: tuple[int, int]) -> np.ndarray:
+    # one scratch array per worker thread, reused across blocks of the same shape
+    buf = getattr(_buffers, "distances", None)
+    if buf is None or buf.shape != shape:
+        buf = _buffers.distances = np.empty(shape, dtype="float64")
+    return buf
+
+
+def _dilate(mask: np.ndarray, radius: int, dist: np.ndarray) -> np.ndarray:
+    ndimage.distance_transform_edt(~mask, distances=dist)
+    return np.less_equal(dist, radius, out=mask)
+
+
+def _erode(mask: np.ndarray, radius: int, dist: np.ndarray) -> np.ndarray:
+    ndimage.distance_transform_edt(mask, distances=dist)
+    return np.greater(dist, radius, out=mask)
+
+
+def _clean(
+    bad: np.ndarray, closing_radius: int, opening_radius: int, dist: np.ndarray
+) -> np.ndarray:
+    """Morphological closing then opening of a 2D mask, in place."""
+    if closing_radius > 0:
+        bad = _erode(_dilate(bad, closing_radius, dist), closing_radius, dist)
+    if opening_radius > 0:
+        bad = _dilate(_erode(bad, opening_radius, dist), opening_radius, dist)
+    return bad
+
+
+def _valid_lut(valid_classes: tuple[int, ...]) -> np.ndarray:
+    valid_lut = np.zeros(256, dtype=bool)
+    valid_lut[list(valid_classes)] = True
+    return valid_lut
+
+
+def _reach(closing_radius: int, opening_radius: int) -> int:
+    # the cleaned mask at a pixel depends on the raw mask this far away
+    return 2 * (closing_radius + opening_radius)
+
+
+def _pad_clear(a: np.ndarray, width: int, valid_classes: tuple[int, ...]) -> np.ndarray:
+    """``a`` (..., y, x) with ``width`` pixels of a clear class on every side."""
+    pad = [(0, 0)] * (a.ndim - 2) + [(width, width)] * 2
+    return np.pad(a, pad, constant_values=min(valid_classes, default=0))
+
+
+def clean_cloud_mask(
+    scl: np.ndarray,
+    valid_classes: tuple[int, ...] = DEFAULT_VALID_CLASSES,
+    closing_radius: int = 5,
+    opening_radius: int = 5,
+) -> np.ndarray:
+    """
+    The cleaned cloud mask (True = bad) for a (time, y, x) SCL array in memory.
+    Same as what ``fused_cloud_mask`` applies.
+    """
+    valid_lut = _valid_lut(valid_classes)
+    w = _reach(closing_radius, opening_radius)
+    padded = _pad_clear(scl, w, valid_classes)
+    dist = _distance_buffer(padded.shape[1:])
+    bad = np.empty(scl.shape, dtype=bool)
+    for t in range(scl.shape[0]):
+        clean = _clean(~valid_lut[padded[t]], closing_radius, opening_radius, dist)
+        bad[t] = clean[w : w + scl.shape[1], w : w + scl.shape[2]]
+    return bad
+
+
+def _mask_block(
+    bands: np.ndarray,
+    scl: np.ndarray,
+    *,
+    valid_lut: np.ndarray,
+    closing_radius: int,
+    opening_radius: int,
+    fill,
+    dtype,
+) -> np.ndarray:
+    """
+    bands: (time, band, y, x), scl: (time, 1, y, x).
+
+    Pixels that are cloudy after cleanup, or zero (nodata), are set to ``fill``.
+    """
+    out = np.empty(bands.shape, dtype=dtype)
+    dist = _distance_buffer(bands.shape[2:])
+    for t in range(bands.shape[0]):
+        bad = _clean(~valid_lut[scl[t, 0]], closing_radius, opening_radius, dist)
+        keep = np.logical_and(~bad, bands[t] > 0)
+        out[t] = fill
+        np.copyto(out[t], bands[t], where=keep, casting="unsafe")
+    return out
+
+
+def fused_cloud_mask(
+    scl: xr.DataArray,
+    bands: xr.Dataset,
+    valid_classes: tuple[int, ...] = DEFAULT_VALID_CLASSES,
+    closing_radius: int = 5,
+    opening_radius: int = 5,
+    nan_fill: bool = True,
+) -> xr.DataArray:
+    """
+    Mask out everything but ``valid_classes`` in the SCL band, after a
+    morphological closing then opening of the cloud mask, and erase those pixels
+    from ``bands``.
+
+    Returns a (time, band, y, x) array. With ``nan_fill`` it is float32 with NaN
+    for masked / nodata pixels (ready for a nan-skipping median); otherwise it
+    keeps the band dtype with 0 for masked pixels.
+    """
+    valid_lut = _valid_lut(valid_classes)
+
+    stack = bands.to_dataarray(dim="band").transpose("time", "band", ...)
+    dtype = np.dtype("float32") if nan_fill else stack.dtype
+    kernel = partial(
+        _mask_block,
+        valid_lut=valid_lut,
+        closing_radius=closing_radius,
+        opening_radius=opening_radius,
+        fill=np.nan if nan_fill else 0,
+        dtype=dtype,
+    )
+
+    scl_data = scl.transpose("time", ...).data[:, None].astype("uint8")
+    stack_data = stack.data
+    depth = _reach(closing_radius, opening_radius)
+    if isinstance(stack_data, dask.array.Array):
+        # every band of a block shares one mask computation
+        stack_data = stack_data.rechunk({1: -1})
+        # the tile edges are padded with a clear class; the bands padding is
+        # trimmed off again with everything else
+        data = dask.array.map_overlap(
+            kernel,
+            stack_data,
+            scl_data,
+            depth={2: depth, 3: depth},
+            boundary=min(valid_classes, default=0),
+            dtype=dtype,
+            trim=True,
+        )
+    else:
+        ny, nx = stack_data.shape[2:]
+        data = kernel(
+            _pad_clear(stack_data, depth, valid_classes),
+            _pad_clear(scl_data, depth, valid_classes),
+        )[..., depth : depth + ny, depth : depth + nx]
+
+    return stack.copy(data=data)
+
+
+def _erase_block(bands: np.ndarray, bad: np.ndarray, fill, dtype) -> np.ndarray:
+    out = np.full(bands.shape, fill, dtype=dtype)
+    keep = np.logical_and(~bad[:, None], bands > 0)
+    np.copyto(out, bands, where=keep, casting="unsafe")
+    return out
+
+
+def erase_usable_blocks(
+    bands: xr.Dataset, bad: np.ndarray, nan_fill: bool = True
+) -> tuple[xr.DataArray, int, int]:
+    """
+    Apply a precomputed cloud mask ``bad`` (time, y, x) to lazily loaded
+    ``bands``, without reading the blocks that are entirely masked.
+
+    Only the blocks of the dask graph with at least one usable pixel depend on
+    the input; the rest are filled with constants, so their data is never
+    fetched. Returns the (time, band, y, x) array and the number of blocks
+    read / total.
+    """
+    stack = bands.to_dataarray(dim="band").transpose("time", "band", ...)
+    dtype = np.dtype("float32") if nan_fill else stack.dtype
+    fill = np.nan if nan_fill else 0
+    src = stack.data.rechunk({1: -1})
+
+    name = "erase-usable-" + dask.base.tokenize(src, bad, nan_fill)
+    dsk = {}
+    t_offsets = np.cumsum((0,) + src.chunks[0])
+    y_offsets = np.cumsum((0,) + src.chunks[2])
+    x_offsets = np.cumsum((0,) + src.chunks[3])
+    num_read = 0
+    for ti, tc in enumerate(src.chunks[0]):
+        for yi, yc in enumerate(src.chunks[2]):
+            for xi, xc in enumerate(src.chunks[3]):
+                block_bad = bad[
+                    t_offsets[ti] : t_offsets[ti] + tc,
+                    y_offsets[yi] : y_offsets[yi] + yc,
+                    x_offsets[xi] : x_offsets[xi] + xc,
+                ]
+                key = (name, ti, 0, yi, xi)
+                if block_bad.all():
+                    shape = (tc, src.shape[1], yc, xc)
+                    dsk[key] = (np.full, shape, fill, dtype)
+                else:
+                    num_read += 1
+                    dsk[key] = (
+                        _erase_block,
+                        (src.name, ti, 0, yi, xi),
+                        block_bad,
+                        fill,
+                        dtype,
+                    )
+
+    graph = HighLevelGraph.from_collections(name, dsk, dependencies=[src])
+    data = dask.array.Array(graph, name, chunks=src.chunks, dtype=dtype)
+    return stack.copy(data=data), num_read, len(dsk)
@@ -0,0 +1,92 @@
+"""
+Peak memory of computing a chunk, from the number of scenes and the tile
+shape, and splitting a chunk that won't fit into sub-windows.
+
+Memory grows with scenes x tile area x bands, so on a fixed worker size the
+heavy tiles (overlapping orbits, high latitudes) ran out of it and were
+retried until they gave up. Now the driver sends the tiles predicted to be
+heavy to larger workers where the backend has them (see
+``scheduling.heavy_tiles``), and a worker that finds after the search that a
+chunk still won't fit computes it in sub-windows, one after the other, and
+writes the assembled chunk.
+
+The streaming median also spills every scene to scratch disk, which splitting
+bounds the same way.
+"""
+
+import math
+from dataclasses import dataclass
+
+from reducers import scratch_bytes
+from tuning import LoadSettings, chunk_working_bytes
+
+# interpreter, libraries and GDAL's block cache
+BASE_BYTES = 512 * 2**20
+# share of the worker memory a plan may use
+MEMORY_HEADROOM = 0.85
+# most sub-windows per side a chunk is split into
+MAX_SPLITS = 8
+
+
+@dataclass(frozen=True)
+class MemoryPlan:
+    # the chunk is computed as splits x splits sub-windows
+    splits: int
+    # how each sub-window is loaded, and the estimated peak of one
+    settings: LoadSettings
+    estimate_bytes: int
+    # scratch disk taken by one sub-window
+    scratch_bytes: int = 0
+
+
+def estimate_peak_bytes(
+    tile_shape: tuple[int, int],
+    num_bands: int,
+    settings: LoadSettings,
+    scenes_in_memory: int,
+    scenes_kept: int = 0,
+    mask_scenes: int = 0,
+) -> int:
+    """
+    Rough peak memory of computing a chunk of ``tile_shape`` pixels.
+
+    ``scenes_in_memory`` are reduced at once per block (see ``tuning.tune``),
+    ``scenes_kept`` whole scenes are held as float32 at the same time (the
+    adaptive loader) and ``mask_scenes`` SCL scenes are cleaned up front (the
+    two-phase loader).
+    """
+    ny, nx = tile_shape
+    pixels = ny * nx
+    b = settings.block_size
+    num_blocks = math.ceil(ny / b) * math.ceil(nx / b)
+    working = chunk_working_bytes(
+        b, settings.threads, num_blocks, num_bands, scenes_in_memory
+    )
+    # the stack and the copy made reducing it
+    kept = 2 * scenes_kept * pixels * num_bands * 4
+    # SCL classes and the cleaned mask
+    mask = mask_scenes * pixels * 2
+    # float64 median and the uint16 chunk
+    output = pixels * num_bands * (8 + 2)
+    return BASE_BYTES + working + kept + mask + output
+
+
+def estimate_scratch_bytes(
+    tile_shape: tuple[int, int], num_bands: int, scenes_spilled: int
+) -> int:
+    """Scratch disk of computing a chunk that spills ``scenes_spilled`` scenes."""
+    return scratch_bytes(tuple(tile_shape) + (num_bands,), scenes_spilled)
+
+
+def fits(estimate_bytes: int, memory_bytes: int | None) -> bool:
+    # None is a resource that isn't limiting
+    return memory_bytes is None or estimate_bytes <= MEMORY_HEADROOM * memory_bytes
+
+
+def split_windows(shape: tuple[int, int], splits: int) -> list[tuple[slice, slice]]:
+    """(y, x) slices of ``shape`` cut into ``splits`` x ``splits`` windows."""
+    edges = [[round(i * n / splits) for i in range(splits + 1)] for n in shape]
+    ys, xs = (
+        [slice(e0, e1) for e0, e1 in zip(e[:-1], e[1:], strict=True)] for e in edges
+    )
+    return [(y, x) for y in ys for x in xs]
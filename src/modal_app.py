@@ -1,10 +1,25 @@
 import os
+import pickle
+from collections.abc import Generator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import modal
-import zarr
-from lib import ChunkProcessingJob, ChunkProcessingResult
+
+from bundling import JobBundle
+from lib import (
+    ChunkProcessingJob,
+    ChunkProcessingResult,
+    JobContext,
+    TileProcessingJob,
+    flatten_results,
+    pack_context,
+)
+from runtime import cached_context
+from speculation import LatencyTracker, run_speculatively
 
 stub = modal.Stub("serverless-datacube")
+# pickled job contexts, written once per run and read once per container
+stub.contexts = modal.Dict.new()
 
 image = (
     modal.Image.micromamba(python_version="3.10")
@@ -36,30 +51,84 @@ image = (
         modal.Secret.from_name("ryan-aws-secret"),
         modal.Secret.from_name("arraylake-token"),
     ],
-    mounts=[modal.Mount.from_local_python_packages("lib")],
+    mounts=[
+        modal.Mount.from_local_python_packages(
+            "bundling",
+            "encoding",
+            "lib",
+            "masking",
+            "memory",
+            "profiling",
+            "pruning",
+            "pyramid",
+            "reducers",
+            "runtime",
+            "schema",
+            "search",
+            "speculation",
+            "tiling",
+            "tuning",
+        )
+    ],
 )
 def process_chunk(
-    job: ChunkProcessingJob, array: zarr.Array, debug: bool
-) -> ChunkProcessingResult | None:
+    job: ChunkProcessingJob | TileProcessingJob | JobBundle,
+    context_key: str,
+    debug: bool,
+) -> ChunkProcessingResult | list[ChunkProcessingResult] | None:
     #  work around modal env bug with httpx
     os.environ.pop("SSL_CERT_DIR", None)
-    return job.process(array, debug=debug)
+    context = cached_context(
+        context_key, lambda: pickle.loads(stub.contexts[context_key])
+    )
+    return job.process(context, debug=debug)
 
 
 def spawn_modal_jobs(
-    jobs: list[ChunkProcessingJob], array: zarr.Array, debug: bool
-) -> list[ChunkProcessingResult]:
+    jobs: list[ChunkProcessingJob | TileProcessingJob | JobBundle],
+    context: JobContext,
+    debug: bool,
+    tracker: LatencyTracker | None = None,
+    max_inflight: int = 1000,
+) -> Generator[ChunkProcessingResult | None, None, None]:
+    context_key, payload = pack_context(context)
     with stub.run():
+        stub.contexts[context_key] = payload
+
+        if tracker is not None:
+            # map can't relaunch stragglers, so make one blocking call per
+            # job from a local thread pool instead
+            executor = ThreadPoolExecutor(max_inflight)
+            try:
+                yield from run_speculatively(
+                    jobs,
+                    submit=lambda job: executor.submit(
+                        process_chunk.remote, job, context_key, debug
+                    ),
+                    wait=lambda fs, timeout: (
+                        wait(fs, timeout=timeout, return_when=FIRST_COMPLETED).done
+                    ),
+                    result=lambda f: f.result(),
+                    tracker=tracker,
+                    max_inflight=max_inflight,
+                )
+            finally:
+                # don't block on the losing copies of duplicated jobs
+                executor.shutdown(wait=False, cancel_futures=True)
+            return
         # need to iterate to trigger execution
         # if the function still fails after all retries, it will return an exception
-        # need to decide what to do with this
-        results = [
-            r
+        # we report those as None, like the other backends
+        results = (
+            None if isinstance(r, Exception) else r
             for r in process_chunk.map(
-                jobs, kwargs={"array": array, "debug": debug}, return_exceptions=True
+                jobs,
+                kwargs={"context_key": context_key, "debug": debug},
+                return_exceptions=True,
+                order_outputs=False,
             )
-        ]
-    return results
+        )
+        yield from flatten_results(results)
 
 
 @stub.function(image=image)
@@ -0,0 +1,218 @@
+"""
+Cheap per-chunk instrumentation: time spent in each stage of the pipeline,
+bytes and requests, peak memory and CPU time.
+
+Dask stages are timed with a scheduler callback, from when each task is handed
+to a compute thread until its result is back, so the numbers are summed over
+the threads (thread-seconds), not wall time.
+"""
+
+import copy
+import json
+import resource
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
+import zarr
+from dask.callbacks import Callback
+
+try:
+    from osgeo import gdal
+except ImportError:
+    # rasterio wheels bundle their own GDAL; without the bindings we can't get
+    # at its network statistics
+    gdal = None
+
+STAGES = ("search", "metadata", "read", "mask", "reduce", "encode", "upload")
+
+# dask layers that are part of the cloud mask, by name prefix
+_MASK_LAYERS = ("erase-usable", "_mask_block", "overlap", "_trim")
+
+
+class Profile:
+    """Stage timings and counters for one chunk. Safe to update from any thread."""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.search_pages = 0
+        # only known when the GDAL python bindings are around
+        self.bytes_read: int | None = None
+        self.bytes_written = 0
+        self.http_requests = 0
+        self.peak_rss_bytes = 0
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+        # process-wide, so concurrent jobs in one worker see each other's usage
+        _reset_peak_rss()
+        if gdal is not None:
+            gdal.NetworkStatsReset()
+        self._cpu = process_time()
+
+    def finish(self) -> None:
+        """Record resource usage since the profile was created."""
+        self.cpu_seconds = process_time() - self._cpu
+        self.peak_rss_bytes = _peak_rss_bytes()
+        cog_stats = _cog_network_stats()
+        if cog_stats is not None:
+            self.http_requests += cog_stats[0]
+            self.bytes_read = cog_stats[1]
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    def count_write(self, num_bytes: int) -> None:
+        with self._lock:
+            self.bytes_written += num_bytes
+            self.http_requests += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        tic = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - tic)
+
+    def add_search_pages(self, num_pages: int) -> None:
+        with self._lock:
+            self.search_pages += num_pages
+            self.http_requests += num_pages
+
+    def columns(self) -> dict:
+        """Flat fields for ChunkProcessingResult."""
+        return {f"{stage}_seconds": s for stage, s in self.seconds.items()} | {
+            "search_pages": self.search_pages,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "http_requests": self.http_requests,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "cpu_seconds": self.cpu_seconds,
+        }
+
+
+class DaskStages(Callback):
+    """
+    Add the run time of every dask task to the stage it belongs to.
+
+    Pass it to each compute (``callbacks=[stages._callback]``) rather than
+    entering it: dask's global callbacks are shared by every thread, so
+    concurrent jobs in a worker would time each other's tasks.
+    """
+
+    def __init__(self, profile: Profile, bands: list[str], rest: str = "reduce"):
+        super().__init__()
+        self.profile = profile
+        self.read_layers = {"open", "cfg", "scl", *bands}
+        # dask fuses tasks and names them after the last one, so whatever
+        # isn't recognisably a read or the mask goes here
+        self.rest = rest
+        # the scheduler starts a whole batch of tasks before any finishes
+        self._starts: dict = {}
+
+    def _stage(self, key) -> str:
+        name = key[0] if isinstance(key, tuple) else key
+        # odc-stac names its layers "<band>-<token>", "open-<band>-<token>", ...
+        if name.split("-", 1)[0] in self.read_layers:
+            return "read"
+        if name.startswith(_MASK_LAYERS):
+            return "mask"
+        return self.rest
+
+    def _pretask(self, key, dask, state):
+        self._starts[key] = perf_counter()
+
+    def _posttask(self, key, result, dask, state, id):
+        self.profile.add(self._stage(key), perf_counter() - self._starts.pop(key))
+
+
+class _TimedStore(MutableMapping):
+    """Passes chunk writes through to ``store``, timing them as uploads."""
+
+    def __init__(self, store, profile: Profile):
+        self.store = store
+        self.profile = profile
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def __setitem__(self, key, value):
+        with self.profile.stage("upload"):
+            self.store[key] = value
+        self.profile.count_write(len(value))
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getattr__(self, name):
+        # anything else the store has, zarr uses as is
+        if name == "store":
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+
+class _TimedBatchStore(_TimedStore):
+    """
+    A ``_TimedStore`` for stores that write (and read) many keys at once, such
+    as FSStore concurrently, which zarr only does when the store has these.
+    """
+
+    def setitems(self, values):
+        with self.profile.stage("upload"):
+            self.store.setitems(values)
+        for value in values.values():
+            self.profile.count_write(len(value))
+
+    def getitems(self, keys, **kwargs):
+        return self.store.getitems(keys, **kwargs)
+
+
+def timed_array(array: zarr.Array, profile: Profile) -> zarr.Array:
+    """
+    A view of ``array`` whose chunk writes are timed, so the time spent writing
+    can be split into encoding (everything else) and the upload itself.
+    """
+    timed = copy.copy(array)
+    store = array.chunk_store
+    wrapper = _TimedBatchStore if hasattr(store, "setitems") else _TimedStore
+    timed._chunk_store = wrapper(store, profile)
+    return timed
+
+
+def _reset_peak_rss() -> None:
+    # resets the high-water mark, so the peak is for this chunk only (Linux)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # never reset, so this is the peak of the whole process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _cog_network_stats() -> tuple[int, int] | None:
+    """(GET requests, bytes downloaded) by GDAL since the last reset, if known."""
+    if gdal is None:
+        return None
+    stats = json.loads(gdal.NetworkStatsGetAsSerializedJSON() or "{}")
+    get = stats.get("methods", {}).get("GET", {})
+    return get.get("count", 0), get.get("downloaded_bytes", 0)
@@ -0,0 +1,102 @@
+"""
+Drop low-value scenes using only their STAC metadata, before any pixels are read.
+"""
+
+from dataclasses import dataclass
+
+import shapely
+import shapely.geometry
+
+
+@dataclass(frozen=True)
+class PruneStats:
+    num_pruned: int
+    # rough estimate of bytes not read: uncompressed pixels at output resolution
+    bytes_avoided: int
+
+
+def _overlap_fraction(item, tile: shapely.Geometry) -> float:
+    footprint = shapely.geometry.shape(item.geometry)
+    return shapely.area(shapely.intersection(footprint, tile)) / shapely.area(tile)
+
+
+def _dedupe_key(item) -> tuple:
+    props = item.properties
+    grid = props.get("grid:code", props.get("s2:mgrs_tile"))
+    orbit = props.get("sat:relative_orbit")
+    if grid is None:
+        # can't tell what's a duplicate, so treat every item as unique
+        return (item.id,)
+    return (grid, orbit, item.datetime.strftime("%Y-%m-%dT%H:%M"))
+
+
+def score(item, overlap: float) -> float:
+    """Expected fraction of the tile this scene contributes usable pixels to."""
+    props = item.properties
+    cloud = props.get("eo:cloud_cover", 0.0) / 100
+    nodata = props.get("s2:nodata_pixel_percentage", 0.0) / 100
+    return overlap * (1 - cloud) * (1 - nodata)
+
+
+def prune_items(
+    items,
+    tile_geom,
+    tile_pixels: int,
+    num_bands: int,
+    max_cloud_cover: float | None = None,
+    max_nodata: float | None = None,
+    min_overlap: float = 0.0,
+    max_scenes: int | None = None,
+    dedupe: bool = False,
+) -> tuple[list, PruneStats]:
+    """
+    Filter ``items`` for the tile ``tile_geom`` (anything with a
+    ``__geo_interface__``, in the same CRS as the item footprints).
+
+    - ``max_cloud_cover`` / ``max_nodata``: percentage thresholds on
+      ``eo:cloud_cover`` / ``s2:nodata_pixel_percentage``
+    - ``min_overlap``: minimum fraction of the tile covered by the footprint
+    - ``dedupe``: keep only the latest processing baseline of the same
+      acquisition (same grid square, relative orbit and time)
+    - ``max_scenes``: keep at most this many, best ``score`` first
+
+    Returns the kept items, best first, and stats about the pruned ones.
+    """
+    tile = shapely.geometry.shape(tile_geom)
+    shapely.prepare(tile)
+
+    overlaps = {item.id: _overlap_fraction(item, tile) for item in items}
+    kept = []
+    for item in items:
+        props = item.properties
+        if max_cloud_cover is not None and (
+            props.get("eo:cloud_cover", 0.0) > max_cloud_cover
+        ):
+            continue
+        if max_nodata is not None and (
+            props.get("s2:nodata_pixel_percentage", 0.0) > max_nodata
+        ):
+            continue
+        if overlaps[item.id] <= 0 or overlaps[item.id] < min_overlap:
+            continue
+        kept.append(item)
+
+    if dedupe:
+        latest = {}
+        for item in kept:
+            key = _dedupe_key(item)
+            baseline = item.properties.get("s2:processing_baseline", "")
+            if key not in latest or baseline > latest[key][0]:
+                latest[key] = (baseline, item)
+        kept = [item for _, item in latest.values()]
+
+    kept.sort(key=lambda item: score(item, overlaps[item.id]), reverse=True)
+    if max_scenes is not None:
+        kept = kept[:max_scenes]
+
+    kept_ids = {item.id for item in kept}
+    pruned = [item for item in items if item.id not in kept_ids]
+    bytes_avoided = sum(
+        int(overlaps[item.id] * tile_pixels * num_bands * 2) for item in pruned
+    )
+    return kept, PruneStats(num_pruned=len(pruned), bytes_avoided=bytes_avoided)
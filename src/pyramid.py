@@ -0,0 +1,197 @@
+"""
+Multiscale overviews of the cube, built by the workers as chunks are written.
+
+Level ``n`` halves the resolution of level ``n - 1`` (level 0 is the cube
+itself) and lives next to it in the store as ``<varname>_overview_<n>``, with
+the same chunk shape in pixels. A worker that has just computed a chunk
+averages it down 2x and writes that as one chunk of half the size into
+``<varname>_overview_<n>_partial``, which has the grid of level ``n``. The
+parent chunk of level ``n`` covers four of those; whichever worker finds all
+of the parent's children landed reads them back, writes the parent and
+carries on up a level. If two siblings finish at once both may assemble the
+parent, which is harmless, as both write the same thing.
+
+Children that never land (failed jobs) are caught up by ``Pyramid.finish`` on
+the driver at the end of the run.
+"""
+
+import math
+from collections.abc import Iterable
+from functools import cached_property
+
+import numpy as np
+import zarr
+
+from encoding import threaded_array
+
+
+def overview_path(varname: str, level: int) -> str:
+    return f"{varname}_overview_{level}"
+
+
+def partial_path(varname: str, level: int) -> str:
+    return f"{overview_path(varname, level)}_partial"
+
+
+def level_shape(shape: tuple[int, int], level: int) -> tuple[int, int]:
+    """(y, x) size of the grid at ``level``."""
+    return tuple(math.ceil(n / 2**level) for n in shape)
+
+
+def downsample(data: np.ndarray) -> np.ndarray:
+    """
+    Average (y, x, band) uint16 data over 2x2 blocks, ignoring 0 (no data).
+    Odd edges are padded with no data.
+    """
+    ny, nx, nb = data.shape
+    padded = np.zeros((ny + ny % 2, nx + nx % 2, nb), dtype=data.dtype)
+    padded[:ny, :nx] = data
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2, nb)
+    valid = blocks > 0
+    total = blocks.sum(axis=(1, 3), dtype="uint32")
+    count = valid.sum(axis=(1, 3), dtype="uint8")
+    out = np.zeros(total.shape, dtype=data.dtype)
+    np.divide(total + count // 2, count, out=out, where=count > 0, casting="unsafe")
+    return out
+
+
+class Pyramid:
+    """
+    The overview levels of a cube, for adding chunks as they are computed.
+
+    ``tiles`` are the (y, x) indexes of every tile of the cube that gets
+    processed, so that a parent knows how many children to wait for.
+    """
+
+    def __init__(
+        self,
+        store,
+        zarr_version: int,
+        varname: str,
+        levels: int,
+        chunk_shape: tuple[int, int],
+        tiles: Iterable[tuple[int, int]],
+    ):
+        if any(n % 2 for n in chunk_shape):
+            raise ValueError("Overviews need an even chunk size")
+        self.store = store
+        self.zarr_version = zarr_version
+        self.varname = varname
+        self.levels = levels
+        self.chunk_shape = chunk_shape
+        tiles = set(tiles)
+        # tiles expected at each level, level 0 being the cube
+        self._expected = [
+            {(y >> level, x >> level) for y, x in tiles} for level in range(levels + 1)
+        ]
+
+    def _open(self, path: str) -> zarr.Array:
+        # a parent can't tell an empty child that was never written from one
+        # that hasn't landed yet
+        array = zarr.open_array(
+            self.store,
+            mode="r+",
+            path=path,
+            zarr_version=self.zarr_version,
+            write_empty_chunks=True,
+        )
+        # other jobs in the process may be compressing with Blosc threads
+        return threaded_array(array)
+
+    @cached_property
+    def _arrays(self) -> list[zarr.Array | None]:
+        return [None] + [
+            self._open(overview_path(self.varname, level))
+            for level in range(1, self.levels + 1)
+        ]
+
+    @cached_property
+    def _partials(self) -> list[zarr.Array | None]:
+        return [None] + [
+            self._open(partial_path(self.varname, level))
+            for level in range(1, self.levels + 1)
+        ]
+
+    def _children(self, level: int, py: int, px: int) -> list[tuple[int, int]]:
+        expected = self._expected[level - 1]
+        return [
+            (cy, cx)
+            for cy in (2 * py, 2 * py + 1)
+            for cx in (2 * px, 2 * px + 1)
+            if (cy, cx) in expected
+        ]
+
+    def _landed(self, level: int, time_index: int, children) -> bool:
+        partial = self._partials[level]
+        return all(
+            partial._chunk_key((time_index, cy, cx, 0)) in partial.chunk_store
+            for cy, cx in children
+        )
+
+    def _write_partial(
+        self, level: int, time_index: int, child: tuple[int, int], data: np.ndarray
+    ) -> None:
+        partial = self._partials[level]
+        small = downsample(data)
+        cy, cx = child
+        hy, hx = (n // 2 for n in self.chunk_shape)
+        y0, x0 = cy * hy, cx * hx
+        ny = min(small.shape[0], partial.shape[1] - y0)
+        nx = min(small.shape[1], partial.shape[2] - x0)
+        partial[time_index, y0 : y0 + ny, x0 : x0 + nx] = small[:ny, :nx]
+
+    def _assemble(self, level: int, time_index: int, py: int, px: int) -> np.ndarray:
+        """Write the parent chunk from its children; returns its data."""
+        cy, cx = self.chunk_shape
+        region = (
+            time_index,
+            slice(py * cy, (py + 1) * cy),
+            slice(px * cx, (px + 1) * cx),
+        )
+        data = self._partials[level][region]
+        self._arrays[level][region] = data
+        return data
+
+    def add(
+        self, time_index: int, tile_index: tuple[int, int], data: np.ndarray
+    ) -> int:
+        """
+        Add a freshly computed (y, x, band) chunk of the cube (None if it had
+        no data). Returns the number of overview chunks written.
+        """
+        if data is None:
+            data = np.zeros(self.chunk_shape + (self._arrays[1].shape[3],), "uint16")
+        written = 0
+        child = tile_index
+        for level in range(1, self.levels + 1):
+            self._write_partial(level, time_index, child, data)
+            parent = (child[0] // 2, child[1] // 2)
+            if not self._landed(level, time_index, self._children(level, *parent)):
+                break
+            data = self._assemble(level, time_index, *parent)
+            written += 1
+            child = parent
+        return written
+
+    def finish(self, storage) -> int:
+        """
+        Assemble the parents that never got all of their children, because
+        some jobs failed, from whatever did land. Returns the number of
+        overview chunks written.
+        """
+        written = 0
+        for level in range(1, self.levels + 1):
+            path = overview_path(self.varname, level)
+            done = {idx[:3] for idx in storage.list_chunks(path)}
+            pending = {
+                (t, y // 2, x // 2)
+                for t, y, x, *_ in storage.list_chunks(
+                    partial_path(self.varname, level)
+                )
+            }
+            for t, py, px in sorted(pending - done):
+                data = self._assemble(level, t, py, px)
+                written += 1
+                if level < self.levels:
+                    self._write_partial(level + 1, t, (py, px), data)
+        return written
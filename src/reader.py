@@ -0,0 +1,349 @@
+"""
+Read the finished cube: pixel time series and bounding box windows.
+
+Every query through xarray fetches and decompresses whole chunks, even for a
+single pixel, and the next query over the same tile does it all again. Here
+decoded chunks are kept in an LRU cache (in memory, optionally spilling to
+local disk), the chunks a query needs are fetched concurrently, and queries
+are addressed on the grid of the cube's ``JobConfig``.
+
+    reader = CubeReader(storage, config, cache=ChunkCache(disk_dir="/tmp/chunks"))
+    series = reader.point(-72.5, 44.0, start="2020-03", end="2020-09")
+    window = reader.bbox((-72.6, 43.9, -72.4, 44.1))
+    print(reader.cache.stats())
+
+The disk tier is meant for finished cubes; clear it when a cube is rewritten.
+"""
+
+import contextlib
+import hashlib
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from odc.geo.xr import xr_coords
+from xarray.coding.times import decode_cf_datetime
+
+from lib import JobConfig
+from storage import AbstractStorage
+
+DEFAULT_CACHE_BYTES = 2**30
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    hits: int
+    disk_hits: int
+    misses: int
+    evictions: int
+    # decoded bytes currently held
+    memory_bytes: int
+    disk_bytes: int
+
+
+class ChunkCache:
+    """
+    Thread-safe LRU cache of decoded chunks, holding at most ``max_bytes`` in
+    memory. With ``disk_dir``, chunks are also written there (up to
+    ``max_disk_bytes``, oldest first out), so they outlive the process and
+    whatever falls out of memory can be loaded back without a fetch.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_CACHE_BYTES,
+        disk_dir: str | None = None,
+        max_disk_bytes: int | None = None,
+    ):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[Hashable, np.ndarray] = OrderedDict()
+        self._memory_bytes = 0
+        # file name -> size, least recently written first
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            entries = sorted(
+                (e for e in os.scandir(disk_dir) if e.name.endswith(".npy")),
+                key=lambda e: e.stat().st_mtime,
+            )
+            for entry in entries:
+                self._disk[entry.name] = entry.stat().st_size
+                self._disk_bytes += entry.stat().st_size
+
+    @staticmethod
+    def _file_name(key: Hashable) -> str:
+        return hashlib.sha256(repr(key).encode()).hexdigest()[:32] + ".npy"
+
+    def get(self, key: Hashable) -> np.ndarray | None:
+        with self._lock:
+            chunk = self._memory.get(key)
+            if chunk is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return chunk
+            name = self._file_name(key)
+            on_disk = name in self._disk
+
+        if on_disk:
+            try:
+                chunk = np.load(os.path.join(self.disk_dir, name))
+            except (OSError, ValueError):
+                # removed or half written by another process
+                chunk = None
+            if chunk is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, chunk)
+                return chunk
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: Hashable, chunk: np.ndarray) -> None:
+        # cached chunks are shared between queries
+        chunk.setflags(write=False)
+        with self._lock:
+            self._remember(key, chunk)
+        if self.disk_dir is not None:
+            self._write_disk(key, chunk)
+
+    def _remember(self, key: Hashable, chunk: np.ndarray) -> None:
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key).nbytes
+        self._memory[key] = chunk
+        self._memory_bytes += chunk.nbytes
+        while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def _write_disk(self, key: Hashable, chunk: np.ndarray) -> None:
+        name = self._file_name(key)
+        path = os.path.join(self.disk_dir, name)
+        # write then rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, chunk)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+
+        to_remove = []
+        with self._lock:
+            self._disk_bytes += size - self._disk.pop(name, 0)
+            self._disk[name] = size
+            while (
+                self.max_disk_bytes is not None
+                and self._disk_bytes > self.max_disk_bytes
+                and len(self._disk) > 1
+            ):
+                old, old_size = self._disk.popitem(last=False)
+                self._disk_bytes -= old_size
+                to_remove.append(old)
+        for old in to_remove:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.disk_dir, old))
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self.hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                memory_bytes=self._memory_bytes,
+                disk_bytes=self._disk_bytes,
+            )
+
+    def clear(self) -> None:
+        """Drop everything held in memory; the disk tier is left alone."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+
+class CubeReader:
+    """
+    Point and window queries on a cube written with ``config``, through a
+    ``ChunkCache`` (its own by default, or one shared between readers).
+    """
+
+    def __init__(
+        self,
+        storage: AbstractStorage,
+        config: JobConfig,
+        cache: ChunkCache | None = None,
+        max_workers: int = 16,
+    ):
+        self.config = config
+        self.cache = cache or ChunkCache()
+        store = storage.get_zarr_store()
+        self.array = zarr.open_array(
+            store, mode="r", path=config.varname, zarr_version=storage.zarr_version
+        )
+        self._time_array = zarr.open_array(
+            store, mode="r", path="time", zarr_version=storage.zarr_version
+        )
+        # chunk keys are namespaced, so readers of different cubes can share
+        # a cache
+        self._namespace = (storage.uri, config.varname)
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="reader")
+        self._inflight: dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+
+    @cached_property
+    def time(self) -> pd.DatetimeIndex:
+        """The time axis of the cube, as stored (it may have been appended to)."""
+        attrs = self._time_array.attrs
+        dates = decode_cf_datetime(
+            self._time_array[:],
+            attrs["units"],
+            attrs.get("calendar", "proleptic_gregorian"),
+        )
+        return pd.DatetimeIndex(dates)
+
+    def _time_slice(self, start, end) -> slice:
+        return self.time.slice_indexer(start, end)
+
+    def _window(self, bounds: tuple[float, float, float, float]) -> tuple[slice, slice]:
+        """Rows and columns of the pixels intersecting ``bounds`` (lon / lat)."""
+        min_x, min_y, max_x, max_y = bounds
+        inverse = ~self.config.geobox.affine
+        cols, rows = zip(
+            *(inverse * corner for corner in product((min_x, max_x), (min_y, max_y))),
+            strict=True,
+        )
+        ny, nx = self.config.geobox.shape
+        y0, y1 = max(math.floor(min(rows)), 0), min(math.ceil(max(rows)), ny)
+        x0, x1 = max(math.floor(min(cols)), 0), min(math.ceil(max(cols)), nx)
+        if y0 >= y1 or x0 >= x1:
+            raise ValueError(f"{bounds} is outside the cube")
+        return slice(y0, y1), slice(x0, x1)
+
+    def _fetch(self, idx: tuple[int, ...]) -> np.ndarray:
+        selection = tuple(
+            slice(i * c, min((i + 1) * c, n))
+            for i, c, n in zip(idx, self.array.chunks, self.array.shape, strict=True)
+        )
+        chunk = self.array[selection]
+        self.cache.put((self._namespace, idx), chunk)
+        return chunk
+
+    def _chunks(self, indices: Iterable[tuple[int, ...]]) -> dict:
+        """Decoded chunks by index: from the cache, or fetched concurrently."""
+        chunks, waiting = {}, {}
+        for idx in indices:
+            cached = self.cache.get((self._namespace, idx))
+            if cached is not None:
+                chunks[idx] = cached
+                continue
+            with self._lock:
+                # don't fetch a chunk another query is already fetching
+                future = self._inflight.get(idx)
+                if future is None:
+                    future = self._inflight[idx] = self._pool.submit(self._fetch, idx)
+                    future.add_done_callback(
+                        lambda _, idx=idx: self._inflight.pop(idx, None)
+                    )
+            waiting[idx] = future
+        for idx, future in waiting.items():
+            chunks[idx] = future.result()
+        return chunks
+
+    def read(self, t: slice, y: slice, x: slice) -> np.ndarray:
+        """The (time, y, x, band) block of the cube at these (step 1) slices."""
+        region = (t, y, x, slice(0, self.array.shape[3]))
+        region = tuple(
+            slice(*s.indices(n)[:2])
+            for s, n in zip(region, self.array.shape, strict=True)
+        )
+        out = np.zeros(tuple(s.stop - s.start for s in region), dtype=self.array.dtype)
+        ranges = [
+            range(s.start // c, (s.stop - 1) // c + 1) if s.stop > s.start else ()
+            for s, c in zip(region, self.array.chunks, strict=True)
+        ]
+        indices = list(product(*ranges))
+        chunks = self._chunks(indices)
+        for idx in indices:
+            chunk = chunks[idx]
+            src, dst = [], []
+            for i, c, s in zip(idx, self.array.chunks, region, strict=True):
+                lo, hi = max(s.start, i * c), min(s.stop, (i + 1) * c)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - s.start, hi - s.start))
+            out[tuple(dst)] = chunk[tuple(src)]
+        return out
+
+    def point(self, lon: float, lat: float, start=None, end=None) -> xr.DataArray:
+        """
+        Time series (time, band) of the pixel at ``lon`` / ``lat``, between
+        ``start`` and ``end`` (inclusive; anything pandas can parse as a date).
+        0 is no data.
+        """
+        col, row = ~self.config.geobox.affine * (lon, lat)
+        row, col = math.floor(row), math.floor(col)
+        ny, nx = self.config.geobox.shape
+        if not (0 <= row < ny and 0 <= col < nx):
+            raise ValueError(f"({lon}, {lat}) is outside the cube")
+        t = self._time_slice(start, end)
+        data = self.read(t, slice(row, row + 1), slice(col, col + 1))[:, 0, 0]
+        ydim, xdim = self.config.geobox.dimensions
+        coords = xr_coords(self.config.geobox[row : row + 1, col : col + 1])
+        return xr.DataArray(
+            data,
+            dims=("time", "band"),
+            coords={
+                "time": self.time[t],
+                "band": self.config.bands,
+                ydim: coords[ydim].values[0],
+                xdim: coords[xdim].values[0],
+            },
+            name=self.config.varname,
+            attrs={"nodata": 0},
+        )
+
+    def bbox(
+        self, bounds: tuple[float, float, float, float], start=None, end=None
+    ) -> xr.DataArray:
+        """
+        All pixels intersecting ``bounds`` (min_lon, min_lat, max_lon, max_lat)
+        between ``start`` and ``end``, as (time, y, x, band). 0 is no data.
+        """
+        y, x = self._window(bounds)
+        t = self._time_slice(start, end)
+        data = self.read(t, y, x)
+        ydim, xdim = self.config.geobox.dimensions
+        coords = xr_coords(self.config.geobox[y, x])
+        return xr.DataArray(
+            data,
+            dims=("time", ydim, xdim, "band"),
+            coords={"time": self.time[t], "band": self.config.bands, **coords},
+            name=self.config.varname,
+            attrs={"nodata": 0},
+        )
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    def __enter__(self) -> "CubeReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
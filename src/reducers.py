@@ -0,0 +1,168 @@
+"""
+Reducers that collapse a stack of scenes into a single median composite.
+"""
+
+import errno
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# where the streaming median spills scenes; the default temp dir otherwise
+SCRATCH_DIR_ENV = "DATACUBE_SCRATCH_DIR"
+
+# bytes of working memory needed per output pixel (y, x, band) while selecting:
+# coarse / fine uint16 histograms, int32 cumulative counts and a bool comparison
+_BYTES_PER_PIXEL = 256 * (2 + 2 + 4 + 1)
+
+
+class StreamingMedian:
+    """
+    Exact per-pixel median of uint16 data, fed one scene at a time.
+
+    Scenes are appended to a scratch file on local disk as they arrive. The
+    median is then found with a two-pass radix select over 8-bit per-pixel
+    histograms (high byte, then low byte within the bin holding the middle
+    ranks), one block of rows at a time. Peak memory is set by
+    ``max_memory_bytes``, not by the number of scenes.
+
+    Disk is, though: ``scratch_bytes`` grows with every scene (about 8.6 MB
+    each for a 1200 x 1200 RGB tile), and Lambda only has 512 MB of ``/tmp``
+    by default. Given ``num_scenes`` up front, a scratch dir without room for
+    them raises before anything is read.
+
+    Zeros are treated as missing, and pixels with no valid observations come
+    out as zero. For an even number of observations the result is the mean of
+    the two middle values, rounded down, which matches
+    ``da.where(da > 0).median("time").astype("uint16")``.
+    """
+
+    def __init__(
+        self,
+        shape: tuple[int, ...],
+        max_memory_bytes: int = 64 * 2**20,
+        scratch_dir: str | None = None,
+        num_scenes: int | None = None,
+    ):
+        self.shape = tuple(shape)
+        self.max_memory_bytes = max_memory_bytes
+        self.num_scenes = 0
+        scratch_dir = scratch_dir or get_scratch_dir()
+        if num_scenes is not None:
+            needed = scratch_bytes(self.shape, num_scenes)
+            free = shutil.disk_usage(scratch_dir).free
+            if needed > free:
+                raise OSError(
+                    errno.ENOSPC,
+                    f"{num_scenes} scenes need {needed / 2**20:.0f} MiB of scratch "
+                    f"space, {free / 2**20:.0f} MiB free",
+                    scratch_dir,
+                )
+        self._file = tempfile.NamedTemporaryFile(  # noqa: SIM115
+            dir=scratch_dir, prefix="median-", suffix=".u16"
+        )
+
+    def add(self, scene: np.ndarray) -> None:
+        if scene.shape != self.shape:
+            raise ValueError(f"expected shape {self.shape}, got {scene.shape}")
+        self._file.write(np.ascontiguousarray(scene, dtype="uint16").tobytes())
+        self.num_scenes += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _rows_per_block(self) -> int:
+        row_pixels = int(np.prod(self.shape[1:]))
+        return max(1, self.max_memory_bytes // (_BYTES_PER_PIXEL * row_pixels))
+
+    def result(self) -> np.ndarray:
+        out = np.zeros(self.shape, dtype="uint16")
+        if self.num_scenes == 0:
+            return out
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        data = np.memmap(
+            self._file.name,
+            dtype="uint16",
+            mode="r",
+            shape=(self.num_scenes,) + self.shape,
+        )
+
+        nrows = self.shape[0]
+        step = self._rows_per_block()
+        for r0 in range(0, nrows, step):
+            r1 = min(r0 + step, nrows)
+            out[r0:r1] = _block_median(data[:, r0:r1]).reshape(out[r0:r1].shape)
+
+        del data
+        return out
+
+
+def get_scratch_dir() -> str:
+    return os.environ.get(SCRATCH_DIR_ENV) or tempfile.gettempdir()
+
+
+def scratch_bytes(shape: tuple[int, ...], num_scenes: int) -> int:
+    """Disk used by a ``StreamingMedian`` of ``shape`` fed ``num_scenes``."""
+    return int(np.prod(shape)) * 2 * num_scenes
+
+
+def _select(hist: np.ndarray, rank: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    For each row of ``hist``, the bin containing the 0-based ``rank``-th value
+    and the rank of that value within the bin.
+    """
+    cum = hist.cumsum(axis=1, dtype=np.int32)
+    bins = (cum > rank[:, None]).argmax(axis=1)
+    pix = np.arange(hist.shape[0])
+    below = cum[pix, bins] - hist[pix, bins]
+    return bins, rank - below
+
+
+def _block_median(data: np.ndarray) -> np.ndarray:
+    """Median over the first axis of ``data``, flattened over the other axes."""
+    n = data.shape[0]
+    px = int(np.prod(data.shape[1:]))
+
+    # pass 1: histogram of the high byte of every valid value
+    # each pixel appears once per scene, so plain fancy-index increments are safe
+    # (and much faster than np.add.at)
+    coarse = np.zeros((px, 256), dtype="uint16")
+    for i in range(n):
+        v = np.asarray(data[i]).reshape(-1)
+        valid = np.flatnonzero(v)
+        coarse[valid, v[valid] >> 8] += 1
+
+    count = coarse.sum(axis=1, dtype=np.int32)
+    lo_rank = (count - 1) // 2
+    hi_rank = count // 2
+    lo_bin, lo_rank = _select(coarse, lo_rank)
+    hi_bin, hi_rank = _select(coarse, hi_rank)
+
+    # pass 2: histogram of the low byte, only for values in the selected bins
+    fine_lo = coarse
+    fine_lo[:] = 0
+    fine_hi = np.zeros_like(coarse)
+    for i in range(n):
+        v = np.asarray(data[i]).reshape(-1)
+        high = v >> 8
+        low = v & 0xFF
+        valid = v > 0
+        for fine, bins in ((fine_lo, lo_bin), (fine_hi, hi_bin)):
+            m = np.flatnonzero(valid & (high == bins))
+            fine[m, low[m]] += 1
+
+    lo_val = (lo_bin << 8) | _select(fine_lo, lo_rank)[0]
+    hi_val = (hi_bin << 8) | _select(fine_hi, hi_rank)[0]
+
+    median = (lo_val.astype("uint32") + hi_val) // 2
+    median[count == 0] = 0
+    return median.astype("uint16")
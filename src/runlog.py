@@ -0,0 +1,68 @@
+"""
+Durable, append-only record of a run, so that a crashed run can be resumed.
+"""
+
+import dataclasses
+import json
+import os
+
+from lib import ChunkProcessingResult
+
+# a chunk is identified by (tile_y, tile_x, year, month)
+ChunkKey = tuple[int, int, int, int]
+
+
+def result_key(result: ChunkProcessingResult) -> ChunkKey:
+    return (result.tile_y, result.tile_x, result.year, result.month)
+
+
+class RunManifest:
+    """
+    One JSON record per finished chunk, appended (and fsynced) as results
+    arrive rather than at the end of the run.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a")  # noqa: SIM115
+
+    def append(self, result: ChunkProcessingResult) -> None:
+        record = dataclasses.asdict(result)
+        # no scenes isn't an error, there's just nothing to write
+        record["status"] = "success" if result.success else "no_data"
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def read(path: str) -> list[dict]:
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line may be truncated if we crashed mid-write
+                    continue
+        return records
+
+    @classmethod
+    def completed(cls, path: str) -> set[ChunkKey]:
+        """Keys of all the chunks that don't need to be processed again."""
+        return {
+            (r["tile_y"], r["tile_x"], r["year"], r["month"])
+            for r in cls.read(path)
+            if r["status"] in ("success", "no_data")
+        }
@@ -0,0 +1,103 @@
+"""
+Per-process worker state, set up once and reused by every job the process runs.
+
+Serverless containers are reused between invocations (Modal, Coiled with
+``keepalive``, Lithops), so anything that doesn't depend on the job - GDAL
+config, logging, the STAC client and its connection pool, the compute thread
+pool, the job context - is created on the first job only.
+"""
+
+import logging
+import os
+import sys
+import warnings
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from time import perf_counter
+from typing import Any
+
+import odc.stac
+import pystac_client
+from pystac_client.stac_api_io import StacApiIO
+from requests.adapters import HTTPAdapter
+
+# enough connections for every compute thread to have one open
+HTTP_POOL_SIZE = 64
+
+_initialized = False
+_debug_handler: logging.Handler | None = None
+_contexts: dict[str, Any] = {}
+
+
+def init_worker(debug: bool = False) -> tuple[bool, float]:
+    """
+    Make sure the worker process is set up.
+
+    Returns whether this was a cold start, and how long the setup took.
+    """
+    global _initialized
+    tic = perf_counter()
+    if debug:
+        _enable_debug_logging()
+    if _initialized:
+        return False, perf_counter() - tic
+
+    warnings.filterwarnings("ignore")  # suppress warnings from rasterio
+    # lets profiling count COG requests and bytes (if the GDAL bindings are there)
+    os.environ["CPL_VSIL_NETWORK_STATS_ENABLED"] = "YES"
+    odc.stac.configure_rio(
+        cloud_defaults=True,
+        aws={"aws_unsigned": True},
+        # reuse connections to the same host across COG reads
+        GDAL_HTTP_MULTIPLEX="YES",
+        GDAL_HTTP_VERSION="2",
+        GDAL_HTTP_TCP_KEEPALIVE="YES",
+    )
+    _initialized = True
+    return True, perf_counter() - tic
+
+
+def _enable_debug_logging() -> None:
+    global _debug_handler
+    # containers are reused, so only ever add the handler once
+    if _debug_handler is not None:
+        return
+    logger = logging.getLogger("arraylake")
+    logger.setLevel(logging.DEBUG)
+    _debug_handler = logging.StreamHandler(sys.stderr)
+    _debug_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    )
+    logger.addHandler(_debug_handler)
+
+
+@cache
+def stac_client(url: str) -> pystac_client.Client:
+    """
+    A STAC API client shared by all jobs in this process. The landing page is
+    only fetched once, and requests go through one pooled HTTP session.
+    """
+    stac_io = StacApiIO()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=5
+    )
+    stac_io.session.mount("http://", adapter)
+    stac_io.session.mount("https://", adapter)
+    return pystac_client.Client.open(url, stac_io=stac_io)
+
+
+@cache
+def compute_pool(num_threads: int) -> ThreadPoolExecutor:
+    """The thread pool dask computes chunks on, kept alive between jobs."""
+    return ThreadPoolExecutor(num_threads, thread_name_prefix="compute")
+
+
+def cached_context(key: str, load: Callable[[], Any]) -> Any:
+    """
+    The job context with this key, calling ``load`` to fetch it only the first
+    time this process sees the key.
+    """
+    if key not in _contexts:
+        _contexts[key] = load()
+    return _contexts[key]
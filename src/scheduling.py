@@ -0,0 +1,163 @@
+"""
+Dispatch the most expensive jobs first.
+
+Jobs otherwise go out in raster order, so a band of heavy tiles (lots of
+overlapping orbits, high latitudes) can be the last thing to start and set the
+wall-clock time of the whole run. Sorting longest-expected first is the classic
+LPT heuristic for a shorter makespan on a fixed number of workers.
+
+The expected number of scenes per chunk comes from, in order of preference:
+the logs of previous runs, footprint density from a STAC search, or a
+latitude model (Sentinel-2 orbits overlap more towards the poles).
+"""
+
+import math
+from collections.abc import Iterable
+from dataclasses import dataclass, replace
+
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.geometry
+
+from bundling import RuntimeModel
+from lib import ChunkProcessingJob, JobConfig, TileProcessingJob, _date_query
+from search import AbstractSearch
+from tiling import tile_boxes
+from tuning import Resources
+
+
+@dataclass(frozen=True)
+class Prediction:
+    scenes: float
+    # where the estimate came from: "log", "footprints" or "latitude"
+    source: str
+
+
+def _tile_latitudes(config: JobConfig) -> np.ndarray:
+    centers = shapely.centroid(tile_boxes(config.geobox, config.chunk_shape))
+    return shapely.get_y(centers)
+
+
+def _sec(lat: np.ndarray) -> np.ndarray:
+    # don't let tiles right at the poles blow up
+    return 1 / np.maximum(np.cos(np.radians(lat)), 0.1)
+
+
+def footprint_scenes(
+    config: JobConfig, searcher: AbstractSearch
+) -> dict[tuple[int, int], float]:
+    """
+    Scenes per chunk for every tile, from how many footprints intersect it in
+    one search over the whole cube for its first time period.
+    """
+    start_date = config.time_data[0]
+    query = _date_query(*config.period_dates(start_date.year, start_date.month))
+    items = searcher.search(config.geobox.geographic_extent, query)
+    if not len(items):
+        return {}
+
+    boxes = tile_boxes(config.geobox, config.chunk_shape)
+    footprints = shapely.STRtree(
+        [shapely.geometry.shape(item.geometry) for item in items]
+    )
+    tile_idx, _ = footprints.query(boxes.ravel(), predicate="intersects")
+    counts = np.bincount(tile_idx, minlength=boxes.size).reshape(boxes.shape)
+    ys, xs = np.nonzero(counts)
+    return {(int(y), int(x)): float(counts[y, x]) for y, x in zip(ys, xs, strict=True)}
+
+
+def predict_scenes(
+    config: JobConfig,
+    tiles: Iterable[tuple[int, int]],
+    model: RuntimeModel,
+    footprints: dict[tuple[int, int], float] | None = None,
+) -> dict[tuple[int, int], Prediction]:
+    """Expected scenes per chunk for each tile, best available source first."""
+    lat = _tile_latitudes(config)
+    # calibrate scenes = k * sec(latitude) on the tiles we've seen, if any;
+    # logs of another grid can have tiles outside this one
+    ny, nx = lat.shape
+    seen = [(y, x) for y, x in model.tile_scenes if 0 <= y < ny and 0 <= x < nx]
+    if seen:
+        k = np.mean([model.tile_scenes[t] / _sec(lat[t]) for t in seen])
+    else:
+        k = model.scenes_per_chunk / np.mean(_sec(lat))
+
+    footprints = footprints or {}
+    predictions = {}
+    for tile in tiles:
+        tile = tuple(tile)
+        if tile in model.tile_scenes:
+            predictions[tile] = Prediction(model.tile_scenes[tile], "log")
+        elif tile in footprints:
+            predictions[tile] = Prediction(footprints[tile], "footprints")
+        else:
+            predictions[tile] = Prediction(float(k * _sec(lat[tile])), "latitude")
+    return predictions
+
+
+def heavy_tiles(
+    config: JobConfig,
+    predictions: dict[tuple[int, int], Prediction],
+    worker: Resources,
+) -> set[tuple[int, int]]:
+    """
+    Tiles whose chunks are predicted not to fit on ``worker`` in one piece, so
+    they are better off on a larger one than split up (see memory.py).
+    """
+    # plans only depend on the tile shape and the scenes
+    plans = {}
+    heavy = set()
+    for tile, p in predictions.items():
+        key = (tuple(config.tiles[tile].shape), math.ceil(p.scenes))
+        if key not in plans:
+            plans[key] = config.memory_plan(*key, worker)
+        if plans[key].splits > 1:
+            heavy.add(tile)
+    return heavy
+
+
+def with_predictions(
+    model: RuntimeModel, predictions: dict[tuple[int, int], Prediction]
+) -> RuntimeModel:
+    """``model`` with the predicted scenes per chunk filled in for every tile."""
+    return replace(
+        model, tile_scenes={tile: p.scenes for tile, p in predictions.items()}
+    )
+
+
+def order_jobs(
+    jobs: Iterable[ChunkProcessingJob | TileProcessingJob], model: RuntimeModel
+) -> list[ChunkProcessingJob | TileProcessingJob]:
+    """``jobs`` sorted by expected runtime, longest first."""
+    # sort is stable, so equal jobs keep their raster order
+    return sorted(jobs, key=model.job_seconds, reverse=True)
+
+
+def predictions_table(
+    predictions: dict[tuple[int, int], Prediction], model: RuntimeModel
+) -> pd.DataFrame:
+    """
+    The predictions as columns to store next to the results in the run log, so
+    later runs can check (and learn from) them.
+    """
+    return pd.DataFrame(
+        [
+            {
+                "tile_y": tile[0],
+                "tile_x": tile[1],
+                "predicted_scenes": p.scenes,
+                "predicted_seconds": model.chunk_seconds(tile),
+                "prediction_source": p.source,
+            }
+            for tile, p in predictions.items()
+        ],
+        columns=[
+            "tile_y",
+            "tile_x",
+            "predicted_scenes",
+            "predicted_seconds",
+            "prediction_source",
+        ],
+    )
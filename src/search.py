@@ -0,0 +1,213 @@
+"""
+Abstraction over where STAC search results come from: the Earth Search API, a
+static catalog on local disk, or a cache in front of either of those.
+"""
+
+import hashlib
+import json
+import posixpath
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import cache
+from time import time
+
+import fsspec
+import pystac
+import shapely
+import shapely.geometry
+
+from runtime import stac_client
+
+EARTH_SEARCH_URL = "https://earth-search.aws.element84.com/v1"
+COLLECTION = "sentinel-2-c1-l2a"
+
+
+@dataclass
+class SearchStats:
+    """
+    What a single search cost. Counted per call, as the backend is shared by
+    every job in the process.
+    """
+
+    # only caching backends count these
+    hits: int = 0
+    misses: int = 0
+    # pages fetched from a STAC API
+    pages: int = 0
+
+
+class AbstractSearch(ABC):
+    @abstractmethod
+    def search(
+        self,
+        geom,
+        date_query: str,
+        collection: str = COLLECTION,
+        stats: SearchStats | None = None,
+    ) -> pystac.ItemCollection:
+        """
+        All items in ``collection`` intersecting ``geom`` (anything with a
+        ``__geo_interface__``) within ``date_query`` ("YYYY-MM-DD/YYYY-MM-DD").
+        What it cost is added to ``stats``.
+        """
+        pass
+
+
+class EarthSearch(AbstractSearch):
+    def __init__(self, url: str = EARTH_SEARCH_URL):
+        self.url = url
+
+    def search(self, geom, date_query, collection=COLLECTION, stats=None):
+        search = stac_client(self.url).search(
+            intersects=geom,
+            collections=[collection],
+            datetime=date_query,
+            limit=400,
+        )
+        items = []
+        for page in search.pages():
+            if stats is not None:
+                stats.pages += 1
+            items.extend(page.items)
+        return pystac.ItemCollection(items)
+
+
+def _parse_date_query(date_query: str) -> tuple[datetime, datetime]:
+    start, end = date_query.split("/")
+    # the end date is inclusive
+    return (
+        datetime.fromisoformat(start),
+        datetime.fromisoformat(end) + timedelta(days=1),
+    )
+
+
+class LocalCatalogSearch(AbstractSearch):
+    """
+    Search a static STAC catalog on disk, with no network access.
+
+    ``path`` is either a ``catalog.json`` / ``collection.json`` (all child items
+    are loaded recursively) or a single ItemCollection / FeatureCollection file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._items = None
+        self._index = None
+
+    def _load(self) -> None:
+        with open(self.path) as f:
+            d = json.load(f)
+        if d.get("type") == "FeatureCollection":
+            items = list(pystac.ItemCollection.from_dict(d))
+        else:
+            catalog = pystac.read_file(self.path)
+            items = list(catalog.get_items(recursive=True))
+        self._items = items
+        self._index = shapely.STRtree(
+            [shapely.geometry.shape(item.geometry) for item in items]
+        )
+
+    def search(self, geom, date_query, collection=COLLECTION, stats=None):
+        if self._items is None:
+            self._load()
+        start, end = _parse_date_query(date_query)
+        query_geom = shapely.geometry.shape(geom)
+        matches = sorted(self._index.query(query_geom, predicate="intersects"))
+        items = []
+        for n in matches:
+            item = self._items[n]
+            if item.datetime is None or item.collection_id != collection:
+                continue
+            if start <= item.datetime.replace(tzinfo=None) < end:
+                items.append(item)
+        return pystac.ItemCollection(items)
+
+
+class CachedSearch(AbstractSearch):
+    """
+    Content-addressed cache of search results in front of another search.
+
+    Results are stored as serialized ItemCollections under ``uri``, which can
+    be a local directory or any fsspec location. Entries older than ``ttl``
+    seconds are treated as missing and refreshed; ``evict`` cleans them up.
+    """
+
+    def __init__(self, backend: AbstractSearch, uri: str, ttl: float | None = None):
+        self.backend = backend
+        self.uri = uri
+        self.ttl = ttl
+        self._fs, self._root = fsspec.core.url_to_fs(uri)
+
+    @staticmethod
+    def cache_key(geom, date_query: str, collection: str) -> str:
+        geom = shapely.normalize(shapely.geometry.shape(geom))
+        h = hashlib.sha256()
+        h.update(collection.encode())
+        h.update(shapely.to_wkb(geom, hex=True).encode())
+        h.update(date_query.encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return posixpath.join(self._root, key[:2], f"{key}.json")
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time() - created > self.ttl
+
+    def search(self, geom, date_query, collection=COLLECTION, stats=None):
+        stats = stats if stats is not None else SearchStats()
+        path = self._path(self.cache_key(geom, date_query, collection))
+        try:
+            with self._fs.open(path, "r") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            entry = None
+
+        if entry is not None and not self._expired(entry["created"]):
+            stats.hits += 1
+            return pystac.ItemCollection.from_dict(entry["items"])
+
+        stats.misses += 1
+        items = self.backend.search(
+            geom, date_query, collection=collection, stats=stats
+        )
+        entry = {"created": time(), "items": items.to_dict()}
+        self._fs.makedirs(posixpath.dirname(path), exist_ok=True)
+        with self._fs.open(path, "w") as f:
+            json.dump(entry, f)
+        return items
+
+    def evict(self, max_entries: int | None = None) -> int:
+        """
+        Remove expired entries, then the oldest ones beyond ``max_entries``.
+        Returns the number of entries removed.
+        """
+        paths = self._fs.glob(posixpath.join(self._root, "*", "*.json"))
+        created = {}
+        for path in paths:
+            with self._fs.open(path, "r") as f:
+                created[path] = json.load(f)["created"]
+
+        to_remove = [p for p, c in created.items() if self._expired(c)]
+        remaining = sorted(
+            (p for p in created if p not in to_remove), key=created.get, reverse=True
+        )
+        if max_entries is not None:
+            to_remove += remaining[max_entries:]
+
+        if to_remove:
+            self._fs.rm(to_remove)
+        return len(to_remove)
+
+
+# one per process, so warm workers reuse the client / loaded catalog
+@cache
+def get_search_backend(
+    catalog: str | None = None,
+    cache_uri: str | None = None,
+    cache_ttl: float | None = None,
+) -> AbstractSearch:
+    backend = LocalCatalogSearch(catalog) if catalog else EarthSearch()
+    if cache_uri:
+        backend = CachedSearch(backend, cache_uri, ttl=cache_ttl)
+    return backend
@@ -0,0 +1,149 @@
+"""
+Speculative re-execution of straggler jobs.
+
+A single hung COG read can hold up a whole run. While jobs are running we keep
+track of how long the finished ones took, and once a job has been running
+longer than a multiple of a percentile of that, a duplicate is launched and
+whichever copy finishes first wins. Each job writes whole, distinct Zarr
+chunks, so running one twice is harmless.
+
+The scheduling loop is shared by all backends; they only provide how to submit
+a job, wait for some handles to finish and get a result.
+"""
+
+import logging
+from collections.abc import Callable, Generator, Hashable, Iterable
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any
+
+import numpy as np
+
+from lib import ChunkProcessingResult, flatten_results
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Running distribution of job durations, and the straggler cutoff."""
+
+    def __init__(
+        self, percentile: float = 95.0, multiple: float = 2.0, min_samples: int = 20
+    ):
+        self.percentile = percentile
+        self.multiple = multiple
+        self.min_samples = min_samples
+        self.durations: list[float] = []
+
+    def add(self, seconds: float) -> None:
+        self.durations.append(seconds)
+
+    def threshold(self) -> float | None:
+        """Seconds after which a job counts as a straggler, once we know enough."""
+        if len(self.durations) < self.min_samples:
+            return None
+        return self.multiple * float(np.percentile(self.durations, self.percentile))
+
+
+@dataclass
+class _JobState:
+    job: Any
+    attempts: int = 0
+    duplicated: bool = False
+    handles: set = field(default_factory=set)
+
+
+def run_speculatively(
+    jobs: Iterable,
+    submit: Callable[[Any], Hashable],
+    wait: Callable[[list, float], Iterable],
+    result: Callable[[Hashable], Any],
+    tracker: LatencyTracker | None = None,
+    max_inflight: int = 1000,
+    retries: int = 5,
+    poll_seconds: float = 5.0,
+) -> Generator[ChunkProcessingResult | None, None, None]:
+    """
+    Run ``jobs``, yielding flattened results as they complete.
+
+    - ``submit(job)`` starts a job and returns a handle
+    - ``wait(handles, timeout)`` returns the handles that are done, or an empty
+      collection after ``timeout`` seconds
+    - ``result(handle)`` returns the job output or raises its error
+
+    At most ``max_inflight`` jobs are submitted at a time, so that time since
+    submission is close to time spent running. Failed jobs are resubmitted up
+    to ``retries`` times and then yield ``None``, like the other backends.
+    """
+    tracker = tracker or LatencyTracker()
+    queue = iter(enumerate(jobs))
+    states: dict[int, _JobState] = {}
+    # handle -> (job id, submission time)
+    running: dict[Hashable, tuple[int, float]] = {}
+    num_duplicates = 0
+
+    def launch(job_id: int) -> None:
+        state = states[job_id]
+        handle = submit(state.job)
+        state.handles.add(handle)
+        running[handle] = (job_id, monotonic())
+
+    def fill() -> None:
+        while len(states) < max_inflight:
+            try:
+                job_id, job = next(queue)
+            except StopIteration:
+                return
+            states[job_id] = _JobState(job)
+            launch(job_id)
+
+    fill()
+    while running:
+        for handle in wait(list(running), poll_seconds):
+            if handle not in running:
+                # both copies finished in the same round; the first one won
+                continue
+            job_id, started = running.pop(handle)
+            state = states[job_id]
+            state.handles.discard(handle)
+            try:
+                output = result(handle)
+            except Exception:
+                if state.handles:
+                    # a duplicate is still going
+                    continue
+                if state.attempts < retries:
+                    logger.warning("Retrying job %s", state.job, exc_info=True)
+                    state.attempts += 1
+                    launch(job_id)
+                    continue
+                logger.exception("Job %s failed after %d retries", state.job, retries)
+                output = None
+            else:
+                tracker.add(monotonic() - started)
+
+            # stop waiting on the other copy, if there is one
+            for other in state.handles:
+                running.pop(other)
+            del states[job_id]
+            yield from flatten_results([output])
+
+        threshold = tracker.threshold()
+        if threshold is not None:
+            now = monotonic()
+            for job_id, started in list(running.values()):
+                state = states[job_id]
+                if not state.duplicated and now - started > threshold:
+                    logger.info(
+                        "Job %s running for %.0fs (cutoff %.0fs), starting a duplicate",
+                        state.job,
+                        now - started,
+                        threshold,
+                    )
+                    state.duplicated = True
+                    num_duplicates += 1
+                    launch(job_id)
+
+        fill()
+
+    logger.info("Launched %d speculative duplicates", num_duplicates)
@@ -2,13 +2,28 @@
 Abstraction to wrap both regular Zarr stores and Arraylake Zarr stores.
 """
 
+import re
 from abc import ABC, abstractmethod
 
 import arraylake
 import zarr
 
+# index of a single chunk within an array
+ChunkIndex = tuple[int, ...]
+
+
+def _parse_chunk_key(key: str, prefix: str = "") -> ChunkIndex | None:
+    """``"0.3.4.0"`` or ``"c0/3/4/0"`` -> ``(0, 3, 4, 0)``; None for metadata."""
+    parts = re.split(r"[./]", key.removeprefix(prefix).removeprefix("c"))
+    if not all(p.isdigit() for p in parts):
+        return None
+    return tuple(int(p) for p in parts)
+
 
 class AbstractStorage(ABC):
+    # where the cube lives, e.g. to key caches of its chunks by
+    uri: str
+
     @abstractmethod
     def initialize(self):
         pass
@@ -21,6 +36,14 @@ class AbstractStorage(ABC):
     def commit(self, message):
         pass
 
+    @abstractmethod
+    def list_chunks(self, path: str) -> set[ChunkIndex]:
+        """
+        Indices of all the chunks of the array at ``path`` that have been written,
+        from a bulk listing of the store rather than one request per chunk.
+        """
+        pass
+
 
 class ZarrFSSpecStorage(AbstractStorage):
     zarr_version = 2
@@ -40,12 +63,24 @@ class ZarrFSSpecStorage(AbstractStorage):
         # vanilla Zarr stores are not transactional
         pass
 
+    def list_chunks(self, path):
+        fs = self._store.fs
+        root = f"{self._store.path.rstrip('/')}/{path}/"
+        # find does a single recursive (paginated) listing of the prefix, which
+        # works for both "." and "/" dimension separators
+        return {
+            idx
+            for key in fs.find(root)
+            if (idx := _parse_chunk_key(key, prefix=root)) is not None
+        }
+
 
 class ArraylakeStorage(AbstractStorage):
     zarr_version = 3
 
     def __init__(self, repo_name: str):
         self._repo_name = repo_name
+        self.uri = f"arraylake://{repo_name}"
         self._client = arraylake.Client()
         self._repo = None
 
@@ -64,3 +99,13 @@ class ArraylakeStorage(AbstractStorage):
 
     def commit(self, message):
         self._repo.commit(message)
+
+    def list_chunks(self, path):
+        # chunk keys of v3 arrays live under data/root/<path>/c...
+        prefix = f"data/root/{path}/"
+        store = self.get_zarr_store()
+        return {
+            idx
+            for key in store.list_prefix(prefix)
+            if (idx := _parse_chunk_key(key, prefix=prefix)) is not None
+        }
@@ -0,0 +1,98 @@
+"""
+Summarize the log of a run: throughput, cost per tile and latency percentiles,
+per region / cloud provider.
+
+python src/summarize.py logs/1712345678-modal.parquet --usd-per-worker-hour 0.19
+"""
+
+import click
+import pandas as pd
+
+from lib import read_output_log
+from profiling import STAGES
+
+GROUP = ["region", "cloud_provider"]
+
+
+def _latency(df: pd.DataFrame) -> pd.Series:
+    return df.setup_duration + df.search_duration + df.load_duration + df.write_duration
+
+
+def throughput_table(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.assign(end_time=df.start_time + _latency(df))
+    grouped = df.groupby(GROUP)
+    wall = grouped.end_time.max() - grouped.start_time.min()
+    table = pd.DataFrame(
+        {
+            "chunks": grouped.size(),
+            "with_data": grouped.success.sum(),
+            "wall_seconds": wall,
+            "chunks_per_minute": 60 * grouped.size() / wall,
+            "MiB_read": grouped.bytes_read.sum() / 2**20,
+            "MiB_written": grouped.bytes_written.sum() / 2**20,
+            "http_requests": grouped.http_requests.sum(),
+        }
+    )
+    return table
+
+
+def cost_table(df: pd.DataFrame, usd_per_worker_hour: float) -> pd.DataFrame:
+    # serverless workers are billed for as long as they run, busy or not
+    df = df.assign(
+        cost=_latency(df) * usd_per_worker_hour / 3600,
+        cpu_hours=df.cpu_seconds / 3600,
+    )
+    grouped = df.groupby(GROUP)
+    return pd.DataFrame(
+        {
+            "usd_total": grouped.cost.sum(),
+            "usd_per_tile": grouped.cost.mean(),
+            "cpu_hours": grouped.cpu_hours.sum(),
+            "peak_rss_MiB_max": grouped.peak_rss_bytes.max() / 2**20,
+        }
+    )
+
+
+def latency_table(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.assign(latency=_latency(df))
+    table = (
+        df.groupby(GROUP)
+        .latency.quantile([0.5, 0.9, 0.99])
+        .unstack()
+        .rename(columns=lambda q: f"p{int(q * 100)}")
+    )
+    stages = [f"{s}_seconds" for s in STAGES if f"{s}_seconds" in df]
+    return table.join(df.groupby(GROUP)[stages].mean())
+
+
+@click.command()
+@click.argument("log", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--usd-per-worker-hour",
+    type=float,
+    default=0.0,
+    show_default=True,
+    help="Price of one worker for an hour, to estimate cost per tile.",
+)
+def main(log: str, usd_per_worker_hour: float):
+    df = read_output_log(log)
+    df[GROUP] = df[GROUP].fillna("unknown")
+    # logs from before the profiling columns existed
+    for column in ("setup_duration", "bytes_read", "bytes_written", "http_requests"):
+        if column not in df:
+            df[column] = 0
+    for column in ("cpu_seconds", "peak_rss_bytes"):
+        if column not in df:
+            df[column] = float("nan")
+
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        click.echo("Throughput\n")
+        click.echo(throughput_table(df).to_string())
+        click.echo("\nCost\n")
+        click.echo(cost_table(df, usd_per_worker_hour).to_string())
+        click.echo("\nLatency (s); stage columns are means\n")
+        click.echo(latency_table(df).to_string())
+
+
+if __name__ == "__main__":
+    main()
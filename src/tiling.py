@@ -0,0 +1,129 @@
+"""
+Tile planning: figure out which tiles of the output grid actually need processing.
+
+The land mask is evaluated for every tile in a single vectorized pass against a
+spatial index of the land polygons, and the result is cached on disk so that
+re-runs (and notebook exploration) don't pay for it again.
+"""
+
+import hashlib
+import os
+from functools import cache
+
+import numpy as np
+import shapely
+from cartopy.feature import NaturalEarthFeature
+from odc.geo.geobox import GeoBox
+
+CACHE_DIR = os.environ.get(
+    "DATACUBE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "serverless-datacube"),
+)
+
+# Natural Earth scale of the land polygons. cartopy's LAND scales with the
+# extent asked for, which is 10m for a single tile, but 110m for the whole
+# world, which misses coasts and small islands.
+LAND_SCALE = "10m"
+
+
+@cache
+def _land_index() -> shapely.STRtree:
+    # building the tree is the expensive bit, so only do it once per process
+    land = NaturalEarthFeature("physical", "land", LAND_SCALE)
+    return shapely.STRtree(list(land.geometries()))
+
+
+def tiles_shape(geobox: GeoBox, chunk_shape: tuple[int, int]) -> tuple[int, int]:
+    """Same as ``GeoboxTiles(geobox, chunk_shape).shape``."""
+    ny, nx = geobox.shape
+    cy, cx = chunk_shape
+    return (-(-ny // cy), -(-nx // cx))
+
+
+def tile_boxes(geobox: GeoBox, chunk_shape: tuple[int, int]) -> np.ndarray:
+    """Polygons for every tile of the grid, as an array of shape ``tiles_shape``."""
+    ny, nx = geobox.shape
+    cy, cx = chunk_shape
+    nty, ntx = tiles_shape(geobox, chunk_shape)
+    affine = geobox.affine
+
+    # pixel edges of each tile, clipped to the edge of the geobox
+    row_edges = np.minimum(np.arange(nty + 1) * cy, ny)
+    col_edges = np.minimum(np.arange(ntx + 1) * cx, nx)
+    x_edges = affine.c + col_edges * affine.a
+    y_edges = affine.f + row_edges * affine.e
+
+    x0, y0 = np.meshgrid(x_edges[:-1], y_edges[:-1])
+    x1, y1 = np.meshgrid(x_edges[1:], y_edges[1:])
+    return shapely.box(
+        np.minimum(x0, x1),
+        np.minimum(y0, y1),
+        np.maximum(x0, x1),
+        np.maximum(y0, y1),
+    )
+
+
+def _cache_key(
+    geobox: GeoBox, chunk_shape: tuple[int, int], aoi: shapely.Geometry | None
+) -> str:
+    h = hashlib.sha256()
+    h.update(LAND_SCALE.encode())
+    h.update(repr(tuple(geobox.affine)[:6]).encode())
+    h.update(repr(tuple(geobox.shape)).encode())
+    h.update(str(geobox.crs).encode())
+    h.update(repr(tuple(chunk_shape)).encode())
+    if aoi is not None:
+        h.update(shapely.to_wkb(aoi, hex=True).encode())
+    return h.hexdigest()[:16]
+
+
+def land_tile_mask(
+    geobox: GeoBox,
+    chunk_shape: tuple[int, int],
+    aoi: shapely.Geometry | None = None,
+    cache_dir: str | None = CACHE_DIR,
+) -> np.ndarray:
+    """
+    Boolean array with one element per tile; True where a tile intersects land
+    (and the optional area of interest).
+
+    Intersections are exact geometry tests, not envelope comparisons.
+    Pass ``cache_dir=None`` to disable the on-disk cache.
+    """
+    fname = None
+    if cache_dir:
+        key = _cache_key(geobox, chunk_shape, aoi)
+        fname = os.path.join(cache_dir, f"land-tiles-{key}.npy")
+        if os.path.exists(fname):
+            return np.load(fname)
+
+    boxes = tile_boxes(geobox, chunk_shape).ravel()
+    tile_idx, _ = _land_index().query(boxes, predicate="intersects")
+    mask = np.zeros(boxes.shape, dtype=bool)
+    mask[tile_idx] = True
+
+    if aoi is not None:
+        shapely.prepare(aoi)
+        mask &= shapely.intersects(boxes, aoi)
+
+    mask = mask.reshape(tiles_shape(geobox, chunk_shape))
+
+    if fname:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temp file first so a crash never leaves a truncated cache
+        tmp = f"{fname}.{os.getpid()}.tmp.npy"
+        np.save(tmp, mask)
+        os.replace(tmp, fname)
+
+    return mask
+
+
+def land_tiles(
+    geobox: GeoBox,
+    chunk_shape: tuple[int, int],
+    aoi: shapely.Geometry | None = None,
+    **kwargs,
+) -> list[tuple[int, int]]:
+    """Tile indices (in raster order) that need processing."""
+    mask = land_tile_mask(geobox, chunk_shape, aoi=aoi, **kwargs)
+    return [tuple(int(i) for i in idx) for idx in np.argwhere(mask)]
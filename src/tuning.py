@@ -0,0 +1,186 @@
+"""
+Dask block size and compute thread count for loading a chunk, from the tile
+shape, the number of bands and what the worker has to work with.
+
+The fixed 600 pixel blocks and 16 threads suit a 1200 pixel tile on a 4 CPU
+machine with plenty of memory. Bigger tiles then mean many more tasks than
+needed, and small workers (a 4 GB Lambda) can run out of memory reducing
+blocks of many scenes at once.
+"""
+
+import math
+import os
+import shutil
+from dataclasses import dataclass
+from functools import cache
+
+from reducers import get_scratch_dir
+
+# how chunks were loaded before tuning; also what "fixed" mode uses
+FIXED_BLOCK_SIZE = 600
+FIXED_THREADS = 16
+TUNING_MODES = ("auto", "fixed")
+
+# reads mostly wait on the network, so run several per core
+IO_THREADS_PER_CPU = 4
+MIN_THREADS = 4
+MAX_THREADS = 64
+# the cloud mask overlaps blocks by 20 pixels, so smaller ones are mostly overlap
+MIN_BLOCK_SIZE = 256
+MAX_BLOCK_SIZE = 2048
+# share of the worker memory a chunk may use; the rest is GDAL's block cache,
+# the zarr encode buffers and the interpreter
+MEMORY_BUDGET = 0.5
+# a block is decoded, masked and converted to float32, keeping each copy around
+READ_COPIES = 3
+
+# set by the local backend, whose worker processes share one machine
+WORKERS_PER_MACHINE_ENV = "DATACUBE_WORKERS_PER_MACHINE"
+
+
+@dataclass(frozen=True)
+class Resources:
+    cpus: int
+    memory_bytes: int
+    # free disk for the streaming median to spill to, None if not limiting
+    scratch_bytes: int | None = None
+
+
+@dataclass(frozen=True)
+class LoadSettings:
+    block_size: int
+    threads: int
+    # "auto" or "fixed", or "config" when both were set explicitly
+    source: str
+
+
+def _read_int(path: str) -> int | None:
+    try:
+        with open(path) as f:
+            value = f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def _cgroup_cpus() -> float | None:
+    # cgroup v2: "<quota> <period>", quota is "max" when unlimited
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    quota = _read_int("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_int("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period:
+        return quota / period
+    return None
+
+
+def _memory_limit() -> int:
+    physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limits = [
+        _read_int("/sys/fs/cgroup/memory.max"),
+        _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+    ]
+    # Lambda doesn't expose a cgroup limit, but does tell us its size
+    lambda_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if lambda_mb:
+        limits.append(int(lambda_mb) * 2**20)
+    # an unlimited cgroup v1 reports a huge number
+    return min([physical] + [limit for limit in limits if limit])
+
+
+@cache
+def detect_resources() -> Resources:
+    """CPUs, memory and scratch disk available to this worker process."""
+    cpus = len(os.sched_getaffinity(0))
+    quota = _cgroup_cpus()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    workers = int(os.environ.get(WORKERS_PER_MACHINE_ENV, 1))
+    return Resources(
+        cpus=max(1, cpus // workers),
+        memory_bytes=_memory_limit() // workers,
+        scratch_bytes=shutil.disk_usage(get_scratch_dir()).free // workers,
+    )
+
+
+def _block_candidates(edge: int) -> list[int]:
+    """Block sizes that split ``edge`` evenly, biggest first."""
+    if edge <= MIN_BLOCK_SIZE:
+        return [edge]
+    sizes = [
+        b
+        for b in range(min(edge, MAX_BLOCK_SIZE), MIN_BLOCK_SIZE - 1, -1)
+        if edge % b == 0
+    ]
+    # in case there's no good even split (a prime tile size, say), dask can
+    # have a ragged last block
+    if edge > FIXED_BLOCK_SIZE and FIXED_BLOCK_SIZE not in sizes:
+        sizes = sorted(sizes + [FIXED_BLOCK_SIZE], reverse=True)
+    return sizes
+
+
+def chunk_working_bytes(
+    block_size: int, threads: int, num_blocks: int, num_bands: int, scenes: int
+) -> int:
+    """Rough peak memory of loading and reducing a chunk."""
+    pixels = block_size * block_size
+    # every thread reading a block of one scene (bands and SCL), as float32
+    reading = threads * pixels * (num_bands + 1) * 4 * READ_COPIES
+    # and the median of a block needs all of its scenes in memory at once
+    reducing = min(threads, num_blocks) * scenes * pixels * num_bands * 4
+    return reading + reducing
+
+
+def tune(
+    tile_shape: tuple[int, int],
+    num_bands: int,
+    scenes_in_memory: int,
+    resources: Resources,
+    mode: str = "auto",
+    block_size: int | None = None,
+    threads: int | None = None,
+) -> LoadSettings:
+    """
+    Block size and threads for a chunk of ``tile_shape`` pixels, with
+    ``scenes_in_memory`` scenes reduced at a time. ``block_size`` / ``threads``
+    are used as given when set.
+
+    Blocks are as big as possible while there's still at least one per CPU to
+    reduce in parallel and the chunk fits in memory. Threads are a few per CPU,
+    as many as fit in memory with that block size.
+    """
+    source = "config" if block_size and threads else mode
+    if mode == "fixed":
+        return LoadSettings(
+            block_size or FIXED_BLOCK_SIZE, threads or FIXED_THREADS, source
+        )
+
+    budget = MEMORY_BUDGET * resources.memory_bytes
+    wanted = threads or min(
+        max(IO_THREADS_PER_CPU * resources.cpus, MIN_THREADS), MAX_THREADS
+    )
+
+    def fitting_threads(b: int) -> int:
+        num_blocks = math.ceil(tile_shape[0] / b) * math.ceil(tile_shape[1] / b)
+        for t in range(wanted, 0, -1):
+            if (
+                chunk_working_bytes(b, t, num_blocks, num_bands, scenes_in_memory)
+                <= budget
+            ):
+                return t
+        return 1
+
+    candidates = [block_size] if block_size else _block_candidates(min(tile_shape))
+    for b in candidates:
+        num_blocks = math.ceil(tile_shape[0] / b) * math.ceil(tile_shape[1] / b)
+        if num_blocks < resources.cpus and b != candidates[-1]:
+            continue
+        t = threads or fitting_threads(b)
+        if t >= min(wanted, MIN_THREADS):
+            break
+    return LoadSettings(block_size=b, threads=t, source=source)
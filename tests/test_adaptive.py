@@ -0,0 +1,73 @@
+"""
+Adaptive loading reads scenes in batches; once it has read them all, it must
+come out the same as reading them at once.
+"""
+
+import os
+import sys
+from dataclasses import replace
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from end_to_end import BANDS, CatalogParams, make_catalog  # noqa: E402
+
+from lib import JobConfig, _compute_median, _date_query  # noqa: E402
+from profiling import Profile  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def catalog(tmp_path_factory):
+    # overlapping granules, so a solar day is several items
+    params = CatalogParams(
+        tiles=1,
+        chunk_size=120,
+        dx=1 / 360,
+        scene_zoom=1,
+        granules=2,
+        overlap=0.3,
+        scenes=8,
+        periods=1,
+        cloudiness=0.4,
+        blocksize=128,
+    )
+    path = make_catalog(params, str(tmp_path_factory.mktemp("catalog")))
+    return params, path
+
+
+@pytest.mark.parametrize("reducer", ["dask", "streaming"])
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_adaptive_reading_everything_matches_plain_median(catalog, reducer, batch_size):
+    params, path = catalog
+    config = JobConfig(
+        dx=params.dx,
+        epsg=4326,
+        bounds=params.bounds,
+        start_date=datetime(2020, 1, 1),
+        end_date=datetime(2020, 1, 1),
+        time_frequency_months=1,
+        bands=BANDS,
+        varname="rgb_median",
+        chunk_size=params.chunk_size,
+        stac_catalog=path,
+        reducer=reducer,
+    )
+    geobox = config.tiles[0, 0]
+    items = config.search_backend().search(
+        geobox.geographic_extent, _date_query(*config.period_dates(2020, 1))
+    )
+    assert len(items) == 4 * params.scenes
+
+    plain, _ = _compute_median(items, geobox, config, Profile())
+    # more clear observations than there are scenes, so it reads them all
+    adaptive_config = replace(
+        config, adaptive_min_clear=params.scenes + 1, adaptive_batch_size=batch_size
+    )
+    adaptive, stats = _compute_median(items, geobox, adaptive_config, Profile())
+
+    assert stats.scenes_read == len(items)
+    np.testing.assert_array_equal(adaptive, plain)